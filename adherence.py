@@ -0,0 +1,159 @@
+import logging
+import sqlite3
+import statistics
+import threading
+import time
+from datetime import date, datetime, timedelta
+
+from storage import sqlite_connection
+
+log = logging.getLogger(__name__)
+
+# Stored as their index: a dose fired (the scheduler's dose_due), its meds were sent to the
+# dispenser, the patient said they took it, or it reached the end of its escalation chain.
+KINDS = ("fired", "dispensed", "taken", "missed")
+FIRED, DISPENSED, TAKEN, MISSED = range(len(KINDS))
+
+
+class AdherenceLog:
+    """An append-only log of dose events in SQLite, for adherence reports.
+
+    A row is (patient, dose slot, kind, when), all integers but the patient id, and rows are never
+    updated or deleted. record() only appends to an in-memory batch; a background thread writes
+    the batch every interval seconds, or as soon as it reaches batch_size, in one transaction,
+    so requests never wait on the disk. One covering index on (patient, slot, kind, at) keeps
+    each patient's events in time order, so a report over any date range reads one contiguous
+    stretch of the index and nothing else.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS adherence_events (
+            patient_id TEXT NOT NULL,
+            slot INTEGER NOT NULL,
+            kind INTEGER NOT NULL,
+            at INTEGER NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS adherence_patient_slot ON adherence_events (patient_id, slot, kind, at);
+    """
+
+    def __init__(self, path, batch_size=500, interval=1.0):
+        self.path = path
+        self.batch_size = batch_size
+        self.interval = interval
+        self._pending = []
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def _connect(self):
+        return sqlite_connection(self.path, self.SCHEMA)
+
+    def record(self, kind, patient_id, slot, at=None):
+        """Queues one event; kind is one of KINDS and slot the datetime of the dose it is about."""
+        slot = slot.replace(second=0, microsecond=0)
+        row = (patient_id, int(slot.timestamp()), KINDS.index(kind), int(at if at is not None else time.time()))
+        with self._lock:
+            self._pending.append(row)
+            full = len(self._pending) >= self.batch_size
+        if full:
+            self._wake.set()
+
+    def flush(self):
+        """Writes whatever is queued; returns how many events that was."""
+        with self._write_lock:
+            with self._lock:
+                batch, self._pending = self._pending, []
+            if not batch:
+                return 0
+            conn = self._connect()
+            try:
+                conn.execute("BEGIN IMMEDIATE")
+                conn.executemany("INSERT INTO adherence_events (patient_id, slot, kind, at) VALUES (?, ?, ?, ?)",
+                                 batch)
+                conn.execute("COMMIT")
+            except sqlite3.Error as e:
+                if conn.in_transaction:
+                    conn.execute("ROLLBACK")
+                # Put the batch back in front of anything queued since, to be retried on the next flush.
+                with self._lock:
+                    self._pending[:0] = batch
+                log.error("error writing adherence events", extra={"events": len(batch), "error": str(e)})
+                return 0
+        return len(batch)
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            self.flush()
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name="adherence", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=5):
+        self._stopped.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+        self.flush()
+
+    def doses(self, patient_id, start, end):
+        """One (slot, fired, dispensed, taken at or None, missed) row per dose slot in [start, end), in slot order.
+
+        Events still waiting in the batch are written first, so a report always includes them.
+        """
+        self.flush()
+        return self._connect().execute(
+            "SELECT slot, MAX(kind = ?), MAX(kind = ?), MIN(CASE WHEN kind = ? THEN at END), MAX(kind = ?) "
+            "FROM adherence_events WHERE patient_id = ? AND slot >= ? AND slot < ? GROUP BY slot ORDER BY slot",
+            (FIRED, DISPENSED, TAKEN, MISSED, patient_id, int(start.timestamp()), int(end.timestamp())),
+        ).fetchall()
+
+    def report(self, patient_id, first, last):
+        """Adherence for the doses fired between two dates, both included."""
+        start = datetime.combine(first, datetime.min.time())
+        end = datetime.combine(last + timedelta(days=1), datetime.min.time())
+        fired = taken = dispensed = escalated = streak = longest = 0
+        delays = []
+        days = {}
+        for slot, was_fired, was_dispensed, taken_at, was_missed in self.doses(patient_id, start, end):
+            dispensed += was_dispensed
+            if not was_fired:
+                # Dispensed by hand from /dispense, not a scheduled dose.
+                continue
+            fired += 1
+            escalated += was_missed
+            day = days.setdefault(date.fromtimestamp(slot), [0, 0])
+            day[0] += 1
+            if taken_at is None:
+                streak += 1
+                longest = max(longest, streak)
+                continue
+            taken += 1
+            day[1] += 1
+            streak = 0
+            delays.append(max(0, taken_at - slot) / 60)
+        return {
+            "patient": patient_id,
+            "start": first.isoformat(),
+            "end": last.isoformat(),
+            "doses": fired,
+            "taken": taken,
+            "dispensed": dispensed,
+            "missed": fired - taken,
+            # Doses whose escalation chain ran out, so the caregiver was told; some may have been taken late.
+            "escalated": escalated,
+            "adherence": round(taken / fired, 4) if fired else None,
+            "median_minutes_to_take": round(statistics.median(delays), 1) if delays else None,
+            "longest_missed_streak": longest,
+            "current_missed_streak": streak,
+            "days": [{"date": day.isoformat(), "doses": counts[0], "taken": counts[1]}
+                     for day, counts in sorted(days.items())],
+        }
@@ -1,143 +1,496 @@
 import os
-from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify
-import openpyxl
-import serial
-import time
-from twilio.rest import Client
-from apscheduler.schedulers.background import BackgroundScheduler
+import io
+import csv
+import dataclasses
+import hashlib
+import click
+from flask import Flask, Response, abort, g, make_response, render_template, request, redirect, url_for, flash, session, jsonify
 import atexit
-from datetime import datetime, timedelta
-import asyncio
-from notificationapi_python_server_sdk import notificationapi
-
-from credentials import (
-    LOGIN_USERNAME,
-    LOGIN_PASSWORD,
-    SECRET_KEY,
-    SECRET_KEY_FILE,
-    TWILIO_ACCOUNT_SID,
-    TWILIO_AUTH_TOKEN,
-    TWILIO_NUMBER,
-    RECIPIENT_NUMBER,
-    ARDUINO_PORT,
-    CALL_LANGUAGE,
-    PATIENT_USERNAME,
-    PATIENT_PASSWORD,
-    NOTIFICATIONAPI1D,
-    NOTIFICATIONAPI2D,
-    NOTIFICATIONAPIID,
-    CARE_NUMBER
+import logging
+import threading
+import time
+from datetime import date, datetime, timedelta
+
+from adherence import AdherenceLog
+from assets import COMPRESSIBLE, MIN_COMPRESS_SIZE, StaticAssets, choose_encoding, compress, tree_digest
+from dispenser import DispenseQueue, DispenserLink
+from dose_scheduler import DoseScheduler
+from escalation import DoseLedger, EscalationEngine, dose_slot
+from events import CAREGIVER, EventBus, EventLog, sse_response
+from inventory import Forecaster, Inventory
+from leader import LeaderElection, LeaderLock
+from metrics import REGISTRY, REQUEST_DURATION, configure_logging
+from notifier import Dispatcher, NotificationApiProvider, QueueFull, SharedNotificationGate, TwilioCallProvider
+from patients import DEFAULT_PATIENT, Patient, PatientRegistry, load_patients
+from recurrence import EXAMPLE, normalize_time, parse_rule
+from settings import CONFIG_FILE, RESTART_REQUIRED, ConfigStore, changed_fields, legacy_settings, secret_key
+from simulation import PERIODS, simulate
+from storage import ImportErrors, export_xlsx, import_xlsx, iter_csv, iter_json, read_csv, read_json, validated
+
+PATIENTS_FILE = "patients.json"
+PAGE_SIZE = 100
+EXPORT_FORMATS = {"csv": (iter_csv, "text/csv"), "json": (iter_json, "application/json")}
+SCHEDULER_LOCK_FILE = "scheduler.lock"
+ESCALATION_STEPS = ("reminder", "call", "caregiver")
+
+config_store = ConfigStore(CONFIG_FILE, legacy_settings)
+# Storage and the session key are set up once from the settings at startup (see RESTART_REQUIRED);
+# everything else reads config_store, per request or per scheduler tick.
+startup_settings = config_store.current()
+
+# static/ is served from memory by static_asset() below, so Flask's own static route is turned off.
+app = Flask(__name__, static_folder=None)
+
+app.secret_key = secret_key(startup_settings.secret_key_file)
+
+log = logging.getLogger("app")
+
+assets = StaticAssets(os.path.join(app.root_path, "static"))
+# Changes whenever a template or static file does, so a deploy invalidates every page ETag.
+BUILD_VERSION = tree_digest(os.path.join(app.root_path, "static"), os.path.join(app.root_path, "templates"))
+app.jinja_env.globals['asset_url'] = lambda name: url_for('static_asset', filename=assets.url_name(name))
+
+_twilio_client = None
+_twilio_client_lock = threading.Lock()
+
+def twilio_client():
+    """The shared Twilio client, built on first use so that importing the app (every worker, every
+    CLI command) doesn't load the Twilio SDK, and rebuilt after the Twilio credentials change."""
+    global _twilio_client
+    with _twilio_client_lock:
+        if _twilio_client is None:
+            from twilio.rest import Client
+            settings = config_store.current()
+            _twilio_client = Client(settings.twilio_account_sid, settings.twilio_auth_token)
+            if settings.twilio_api_url:
+                _twilio_client.api.base_url = settings.twilio_api_url
+        return _twilio_client
+
+BAUD_RATE = 115200
+
+def default_patient(settings):
+    return Patient(
+        id=DEFAULT_PATIENT,
+        name="Patient",
+        recipient_number=settings.recipient_number,
+        care_number=settings.care_number,
+        arduino_port=settings.arduino_port,
+        username=settings.patient_username,
+        password=settings.patient_password
+    )
+
+patients = PatientRegistry(
+    load_patients(PATIENTS_FILE, default_patient(startup_settings)),
+    startup_settings.storage_backend,
+    startup_settings.database_path,
+    lambda port: DispenserLink(port, BAUD_RATE)
 )
 
-notificationapi.init(NOTIFICATIONAPI1D, NOTIFICATIONAPI2D)
+# Events go through events.db, so a page sees them whichever worker its /events stream is on.
+bus = EventBus(log=EventLog(startup_settings.events_path))
 
-def get_secret_key():
-    if os.path.exists(SECRET_KEY_FILE):
-        with open(SECRET_KEY_FILE, 'r') as f:
-            return f.read().strip()
+dispatcher = Dispatcher(
+    TwilioCallProvider(twilio_client, startup_settings.twilio_number),
+    NotificationApiProvider(startup_settings.notificationapi1d, startup_settings.notificationapi2d,
+                            startup_settings.notificationapi_url),
+    # Shared with the other workers, so the scheduler tick and a /dispense served anywhere dedupe against each other.
+    gate=SharedNotificationGate(startup_settings.notify_gate_path, startup_settings.notify_dedupe_window,
+                                startup_settings.notify_rate_limit, startup_settings.notify_rate_period)
+)
+
+def medication_twiml(language):
+    if language == "English":
+        return '<Response><Say>Medication time, please take your meds. Medication time, please take your meds.Medication time, please take your meds. Medication time, please take your meds.</Say></Response>'
+    elif language == "Chinese":
+        return '<Response><Say language="zh-CN">服药时间到了，请吃药.服药时间到了，请吃药.服药时间到了，请吃药.</Say></Response>'
     else:
-        new_key = os.urandom(64).hex()
-        with open(SECRET_KEY_FILE, 'w') as f:
-            f.write(new_key)
-        return new_key
+        return '<Response><Say>Medication time, please take your meds.</Say></Response>'
 
-app = Flask(__name__)
+def current_patient():
+    """The patient the logged-in user is looking at: their own, or the one a caregiver selected."""
+    return patients.get(session.get('patient_id')) or patients.first()
 
-app.secret_key = get_secret_key()
+def caregiver_sms(message, care_number):
+    return {
+        "type": "medication",
+        "to": {
+            "id": config_store.current().notificationapiid,
+            "number": care_number
+        },
+        "sms": {
+            "message": message
+        }
+    }
 
-client = Client(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN)
-twilio_number = TWILIO_NUMBER
-recipient_number = RECIPIENT_NUMBER
-call_language = CALL_LANGUAGE
+def log_dispense_result(patient_id, record, future, logger=log, inventory=None):
+    """Logs one dispense command's outcome and, once it succeeded, takes its pills off the inventory.
 
-ARDUINO_PORT = ARDUINO_PORT
-BAUD_RATE = 115200
+    Returns whether the dispenser confirmed it.
+    """
+    error = future.exception()
+    if error:
+        logger.error("dispenser error", extra={"patient": patient_id, "med": record.name, "error": str(error)})
+        return False
+    logger.debug("dispensed", extra={"patient": patient_id, "med": record.name})
+    if inventory is not None:
+        left = inventory.take(patient_id, int(record.container), int(record.amount))
+        if left == 0:
+            logger.warning("container is empty", extra={"patient": patient_id, "container": record.container})
+    return True
 
-def get_sheet():
-    try:
-        wb = openpyxl.load_workbook("data.xlsx")
-        sheet = wb.active
-        
-        headers = [cell.value for cell in sheet[1]]
-        if "Container" not in headers:
-            sheet.cell(row=1, column=5, value="Container")
-            wb.save("data.xlsx")
-            
-        return wb, sheet
-    except FileNotFoundError:
-        return None, None
-
-def update_credentials_file(data):
-    """Writes the updated credentials to the credentials.py file."""
-    with open('credentials.py', 'w') as f:
-        f.write(f"LOGIN_USERNAME = \"{data['username']}\"\n")
-        f.write(f"LOGIN_PASSWORD = \"{data['password']}\"\n")
-        f.write(f"PATIENT_USERNAME = \"{data['patient_username']}\"\n")
-        f.write(f"PATIENT_PASSWORD = \"{data['patient_password']}\"\n")
-        f.write(f"SECRET_KEY = \"{get_secret_key()}\"\n")
-        f.write("SECRET_KEY_FILE = 'secret_key.txt'\n")
-        f.write(f"TWILIO_ACCOUNT_SID = \"{data['twilio_sid']}\"\n")
-        f.write(f"TWILIO_AUTH_TOKEN = \"{data['twilio_token']}\"\n")
-        f.write(f"TWILIO_NUMBER = \"{data['twilio_number']}\"\n")
-        f.write(f"RECIPIENT_NUMBER = \"{data['recipient_number']}\"\n")
-        f.write(f"CARE_NUMBER = \"{data['care_number']}\"\n")
-        f.write(f"ARDUINO_PORT = \"{data['arduino_port']}\"\n")
-        f.write(f"CALL_LANGUAGE = \"{data['call_language']}\"\n")
-        f.write(f"NOTIFICATIONAPI1D = \"{NOTIFICATIONAPI1D}\"\n")
-        f.write(f"NOTIFICATIONAPI2D = \"{NOTIFICATIONAPI2D}\"\n")
-        f.write(f"NOTIFICATIONAPIID = \"{NOTIFICATIONAPIID}\"\n")
-
-def dispense_medication_job():
-    print("Checking for scheduled medication at:", datetime.now().strftime("%H:%M"))
-    wb, sheet = get_sheet()
-    if not sheet:
-        print("Error: data.xlsx not found.")
+def dispense_records(context, records, logger=log, inventory=None, adherence=None, slot=None, events=None):
+    """Sends every record's container/quantity to the patient's dispenser without waiting for the replies.
+
+    With an inventory, each container's count goes down once the dispenser confirms the pills are out.
+    With an adherence log, the dose at slot is recorded as dispensed once every one of its records
+    was confirmed; a NAK, a timeout or a record that couldn't be sent leaves it out. With an event
+    bus, the open pages are told "dispensed" at that same point.
+    """
+    dispenser = context.dispenser
+    if dispenser is None:
+        logger.warning("no dispenser configured", extra={"patient": context.id})
         return
-    
-    current_time_str = datetime.now().strftime("%H:%M")
-    
-    meds_to_dispense = []
-    for row_num in range(2, sheet.max_row + 1):
-        med_time = str(sheet.cell(row=row_num, column=1).value)
-        if med_time == current_time_str:
-            meds_to_dispense.append(sheet.cell(row=row_num, column=2).value)
-
-    if meds_to_dispense:
-        print("Scheduled dispensing triggered for:", current_time_str)
-        
-        if CALL_LANGUAGE == "English":
-            twiml_message = '<Response><Say>Medication time, please take your meds. Medication time, please take your meds.Medication time, please take your meds. Medication time, please take your meds.</Say></Response>'
-        elif CALL_LANGUAGE == "Chinese":
-            twiml_message = '<Response><Say language="zh-CN">服药时间到了，请吃药.服药时间到了，请吃药.服药时间到了，请吃药.</Say></Response>'
+    submitted = []
+    complete = True
+    for record in records:
+        try:
+            submitted.append((record, dispenser.submit(record.container, record.amount)))
+        except (TypeError, ValueError):
+            logger.warning("skipping med: container/quantity is not a number",
+                           extra={"patient": context.id, "med": record.name})
+            complete = False
+    outstanding = [len(submitted), complete]
+    lock = threading.Lock()
+
+    def done(record, future):
+        confirmed = log_dispense_result(context.id, record, future, logger, inventory)
+        with lock:
+            outstanding[0] -= 1
+            outstanding[1] = outstanding[1] and confirmed
+            finished = outstanding[0] == 0 and outstanding[1]
+        if finished and adherence is not None:
+            adherence.record("dispensed", context.id, slot)
+        if finished and events is not None:
+            events.publish("dispensed", {"time": slot.strftime("%H:%M"), "meds": [r.name for r, _ in submitted],
+                                         "patient": context.id}, patient=context.id)
+
+    # Callbacks only go on once every command is out, so one that resolves at once can't finish the dose early.
+    for record, future in submitted:
+        future.add_done_callback(lambda f, record=record: done(record, f))
+
+def slot_key(day, hhmm):
+    """Names a dose slot the same way for the scheduler and /dispense, so their notifications dedupe."""
+    return f"{day:%Y-%m-%d} {hhmm}"
+
+def medication_jobs(due_patients):
+    """One call per patient phone and one SMS per caregiver phone, however many of the patients share them."""
+    calls = {}
+    messages = {}
+    for patient in due_patients:
+        calls.setdefault(patient.recipient_number, patient)
+        messages.setdefault(patient.care_number, []).append(patient.name)
+    twiml = medication_twiml(config_store.current().call_language)
+    jobs = [("call", {"to": number, "twiml": twiml}) for number in calls]
+    for number, names in messages.items():
+        message = "Medication notification sent"
+        if len(names) > 1:
+            message += " for " + ", ".join(names)
+        jobs.append(("sms", {"params": caregiver_sms(message, number)}))
+    return jobs
+
+def escalate_dose(dose, step):
+    """Sends one step of a dose's escalation chain; see EscalationEngine."""
+    context = patients.get(dose.patient_id)
+    if context is None:
+        return
+    patient = context.patient
+    hhmm = dose.slot.strftime("%H:%M")
+    meds = ", ".join(dose.meds)
+    # Each step gets its own slot key so the gate doesn't take the repeat call for a duplicate,
+    # and every step is urgent: a missed dose must reach someone whatever the rate limit says.
+    key = f"{slot_key(dose.slot, hhmm)} {step}"
+    try:
+        if step == "reminder":
+            dispatcher.submit("sms", slot=key, urgent=True, params=caregiver_sms(
+                f"Reminder: please take your {hhmm} medication ({meds})", patient.recipient_number))
+        elif step == "call":
+            dispatcher.submit("call", slot=key, urgent=True, to=patient.recipient_number,
+                              twiml=medication_twiml(config_store.current().call_language))
         else:
-            twiml_message = '<Response><Say>Medication time, please take your meds.</Say></Response>'
+            dispatcher.submit("sms", slot=key, urgent=True, params=caregiver_sms(
+                f"{patient.name} has not confirmed taking the {hhmm} medication ({meds})", patient.care_number))
+            bus.publish("dose_missed", {"time": hhmm, "meds": dose.meds, "patient": patient.id, "name": patient.name,
+                                        "dose": dose.id}, audience=(CAREGIVER,))
+            adherence.record("missed", patient.id, dose.slot)
+    except QueueFull as e:
+        log.error("error queueing escalation", extra={"dose": dose.id, "step": step, "error": str(e)})
+
+escalations = EscalationEngine(zip(startup_settings.escalation_minutes, ESCALATION_STEPS), escalate_dose,
+                               ledger=DoseLedger(startup_settings.escalation_path))
+
+adherence = AdherenceLog(startup_settings.adherence_path)
+
+inventory = Inventory(startup_settings.inventory_path)
+forecaster = Forecaster()
+# Containers listed in one low-stock SMS; the rest are counted.
+LOW_STOCK_LINES = 10
+
+def low_stock_jobs(rows):
+    """One SMS per caregiver phone, listing every low container of all their patients."""
+    messages = {}
+    for row in rows:
+        context = patients.get(row["patient"])
+        if context is None:
+            continue
+        patient = context.patient
+        messages.setdefault(patient.care_number, []).append(
+            f"{patient.name} container {row['container']} ({row['count']} left, runs out {row['runs_out']})")
+    jobs = []
+    for number, lines in messages.items():
+        message = "Refill soon: " + "; ".join(lines[:LOW_STOCK_LINES])
+        if len(lines) > LOW_STOCK_LINES:
+            message += f"; and {len(lines) - LOW_STOCK_LINES} more"
+        jobs.append(("sms", {"params": caregiver_sms(message, number)}))
+    return jobs
+
+def check_stock(day):
+    """Forecasts every tracked container and sends one batched alert for those running low; returns their rows."""
+    forecast = forecaster.forecast(inventory.levels(), {context.id: context.store for context in patients}, day)
+    low = [forecast.row(i) for i in forecast.low(config_store.current().low_stock_days)]
+    if not low:
+        return low
+    # Each container is reported once a day, in inventory.db so later slots and restarts see it; one
+    # that newly runs low is reported right away, along with the rest that are still low.
+    containers = sorted((row["patient"], row["container"]) for row in low)
+    claimed = inventory.claim_alerts(day, containers)
+    if not claimed:
+        return low
+    key = f"low-stock {day:%Y-%m-%d} {hashlib.sha1(repr(containers).encode()).hexdigest()[:12]}"
+    try:
+        log.info("low stock", extra={"containers": len(low), "jobs": dispatcher.submit_batch(low_stock_jobs(low), key)})
+    except QueueFull as e:
+        inventory.release_alerts(day, claimed)
+        log.error("error queueing the low-stock alert", extra={"error": str(e)})
+    return low
+
+def notify_medication_time(patient, slot):
+    """Queues the patient call and caregiver SMS; returns the job ids."""
+    return dispatcher.submit_batch(medication_jobs([patient]), slot)
+
+def apply_settings(old, new):
+    """Rebuilds only what the changed settings feed into, so a saved configuration applies without a restart.
+
+    Jobs already queued or running finish on the providers they started with.
+    """
+    global _twilio_client
+    changed = changed_fields(old, new)
+    log.info("configuration changed", extra={"fields": sorted(changed)})
+    if changed & {"twilio_account_sid", "twilio_auth_token", "twilio_api_url"}:
+        with _twilio_client_lock:
+            _twilio_client = None
+    if changed & {"twilio_account_sid", "twilio_auth_token", "twilio_api_url", "twilio_number"}:
+        dispatcher.replace_provider("call", TwilioCallProvider(twilio_client, new.twilio_number))
+    if changed & {"notificationapi1d", "notificationapi2d", "notificationapi_url"}:
+        dispatcher.replace_provider("sms", NotificationApiProvider(new.notificationapi1d, new.notificationapi2d,
+                                                                   new.notificationapi_url))
+    if changed & {"notify_dedupe_window", "notify_rate_limit", "notify_rate_period"}:
+        dispatcher.gate.configure(new.notify_dedupe_window, new.notify_rate_limit, new.notify_rate_period)
+    if "escalation_minutes" in changed:
+        escalations.set_steps(zip(new.escalation_minutes, ESCALATION_STEPS))
+    # With a patients.json, the default patient's details live there rather than in the settings.
+    if (changed & {"recipient_number", "care_number", "arduino_port", "patient_username", "patient_password"}
+            and not os.path.exists(PATIENTS_FILE)):
+        patients.update_patient(default_patient(new))
+    if changed & RESTART_REQUIRED:
+        log.warning("configuration change needs a restart", extra={"fields": sorted(changed & RESTART_REQUIRED)})
+
+config_store.add_listener(apply_settings)
+
+def run_dose_slot(slot, registry, notifier, events, logger=log, escalation=None, adherence=None, inventory=None):
+    """Dispenses and notifies for every patient due at slot; returns the (context, records) that were due.
+
+    The scheduler runs it against the live registry, dispatcher and bus, the simulator against its own.
+    With an escalation engine, every dispensed dose is tracked until the patient acknowledges it;
+    with an adherence log, every dose is recorded as fired, and as dispensed once the dispenser
+    confirms it; with an inventory, the pills dispensed come off the containers' counts.
+    """
+    current_time_str = slot.strftime("%H:%M")
+    logger.debug("checking for scheduled medication", extra={"slot": current_time_str})
+    due = registry.due_at(current_time_str, slot.date())
+    if not due:
+        return due
 
+    logger.info("scheduled dispensing triggered", extra={"slot": current_time_str, "patients": len(due)})
+    for context, records in due:
+        meds_to_dispense = [record.name for record in records]
+        data = {"time": current_time_str, "meds": meds_to_dispense, "patient": context.id}
+        if escalation is not None:
+            data["dose"] = escalation.track(context.id, slot, meds_to_dispense)
+        events.publish("dose_due", data, patient=context.id)
+        if adherence is not None:
+            adherence.record("fired", context.id, slot)
+        dispense_records(context, records, logger, inventory, adherence, slot)
+
+    jobs = medication_jobs([context.patient for context, _ in due])
+    try:
+        logger.info("notifications queued", extra={
+            "slot": current_time_str,
+            "jobs": notifier.submit_batch(jobs, slot_key(slot, current_time_str))
+        })
+    except QueueFull as e:
+        logger.error("error queueing the calls", extra={"slot": current_time_str, "error": str(e)})
+    return due
+
+def dispense_medication_job(slot=None):
+    # Picks up a configuration saved through another worker.
+    config_store.refresh()
+    slot = slot or datetime.now()
+    run_dose_slot(slot, patients, dispatcher, bus, escalation=escalations, adherence=adherence, inventory=inventory)
+    check_stock(slot.date())
+
+# run_dose_slot's logger during a simulation. It isn't registered with logging.getLogger, so
+# disabling it mutes the simulated doses without muting anything else in the process.
+SIMULATION_LOG = logging.Logger("app.simulation")
+SIMULATION_LOG.disabled = True
+
+def run_simulated_period(period, start=None, lag_minutes=0, fail_rate=0.0):
+    """Replays `period` ("day", "week" or "month") of every patient's schedule in virtual time."""
+    start = start or datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    settings = config_store.current()
+    return simulate(
+        patients,
+        lambda slot, registry, notifier, events: run_dose_slot(slot, registry, notifier, events, SIMULATION_LOG),
+        start,
+        start + PERIODS[period],
+        lag=timedelta(minutes=lag_minutes),
+        fail_rate=fail_rate,
+        gate_settings=(settings.notify_dedupe_window, settings.notify_rate_limit, settings.notify_rate_period)
+    )
+
+def report_missed_dose(slot):
+    log.warning("missed scheduled dose (too late to catch up)", extra={"slot": slot.strftime("%Y-%m-%d %H:%M")})
+
+def save_scheduler_state(last_run):
+    election.lock.write(last_run.isoformat())
+
+dispense_requests = DispenseQueue(startup_settings.dispense_queue_path)
+
+def dispense_request(patient_id, slot):
+    """Dispenses a /dispense request put by any worker. Only the leader runs this, so only it opens the ports."""
+    context = patients.get(patient_id)
+    if context is None:
+        return
+    due = context.store.due_at(slot.strftime("%H:%M"), slot.date())
+    if due:
+        dispense_records(context, due, inventory=inventory, adherence=adherence, slot=slot, events=bus)
+
+def start_scheduler():
+    # Carry on from where the previous leader got to, so doses due during a failover still fire.
+    state = election.lock.read()
+    if state:
         try:
-            call = client.calls.create(
-                twiml=twiml_message,
-                to=recipient_number,
-                from_=twilio_number
-            )
-            print("Call ID:", call.sid)
-
-            async def send_notification():
-                response = await notificationapi.send({
-                "type": "medication",
-                "to": {
-                    "id": NOTIFICATIONAPIID,
-                    "number": CARE_NUMBER
-                },
-                    "sms": {
-                        "message": "Medication notification sent"
-                    }
-                })
-
-            asyncio.run(send_notification())
-
-            time.sleep(2)
-
-        except Exception as e:
-            print("Error making the call:", str(e))
+            scheduler.last_run = datetime.fromisoformat(state)
+        except ValueError:
+            log.warning("ignoring unreadable scheduler state", extra={"state": state})
+    # ...and so do the escalation chains of the doses it fired.
+    escalations.resume()
+    dispense_requests.start(dispense_request, on_schedule_changed=scheduler.rearm)
+    scheduler.start()
+
+def stop_scheduler():
+    scheduler.stop()
+    dispense_requests.stop()
+
+def schedule_changed():
+    # The leader may be another worker: it rearms when it sees the version in dispense.db move.
+    scheduler.rearm()
+    dispense_requests.schedule_changed()
+
+scheduler = DoseScheduler(patients.times, dispense_medication_job, on_missed=report_missed_dose,
+                          on_run=save_scheduler_state)
+for context in patients:
+    context.store.add_listener(schedule_changed)
+
+election = LeaderElection(LeaderLock(SCHEDULER_LOCK_FILE), start_scheduler, stop_scheduler)
+services_started = False
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.before_request
+def load_settings():
+    # One snapshot per request: a save landing mid-request doesn't change what this request sees.
+    g.settings = config_store.refresh()
+
+@app.after_request
+def record_request_duration(response):
+    started = g.get('request_started')
+    if started is not None:
+        REQUEST_DURATION.observe(time.perf_counter() - started, request.endpoint or "unmatched",
+                                 request.method, response.status_code)
+    return response
+
+@app.after_request
+def compress_response(response):
+    """gzip- or brotli-compresses text responses; streamed ones (exports, /events) are left alone."""
+    if (response.status_code != 200 or response.is_streamed or response.direct_passthrough
+            or 'Content-Encoding' in response.headers or response.mimetype not in COMPRESSIBLE):
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = choose_encoding(request.accept_encodings)
+    data = response.get_data()
+    if encoding is None or len(data) < MIN_COMPRESS_SIZE:
+        return response
+    response.set_data(compress(data, encoding))
+    response.headers['Content-Encoding'] = encoding
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        # Same content, different bytes: only a weak ETag still holds.
+        response.set_etag(etag, weak=True)
+    return response
+
+def page_etag(*parts):
+    """An ETag for a rendered page, from what it shows (schedule version, page number...), who is
+    looking and the deploy. None while a flash message is waiting: it is shown once, so that
+    response can't be reused."""
+    if session.get('_flashes'):
+        return None
+    key = "|".join(str(part) for part in (BUILD_VERSION, session.get('user_role'), session.get('patient_id'), *parts))
+    return hashlib.sha1(key.encode()).hexdigest()[:16]
+
+def cached_page(etag, template, **context):
+    """Renders template, or answers 304 without rendering if the client already has this etag."""
+    if etag is not None and request.if_none_match.contains_weak(etag):
+        response = app.response_class(status=304)
+    else:
+        response = make_response(render_template(template, **context))
+    if etag is not None:
+        response.set_etag(etag, weak=True)
+        response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+@app.route('/static/<path:filename>')
+def static_asset(filename):
+    found = assets.get(filename)
+    if found is None:
+        abort(404)
+    asset, hashed = found
+    encoding = choose_encoding(request.accept_encodings)
+    response = app.response_class(asset.encoded.get(encoding, asset.data), mimetype=asset.mimetype)
+    if encoding in asset.encoded:
+        response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    response.set_etag(asset.digest, weak=True)
+    if hashed:
+        response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    else:
+        response.headers['Cache-Control'] = 'no-cache'
+    return response.make_conditional(request)
+
+@app.route('/metrics')
+def metrics():
+    return Response(REGISTRY.render(), mimetype='text/plain; version=0.0.4')
 
 @app.route('/')
 def home():
@@ -154,7 +507,21 @@ def index():
     if session.get('user_role') != 'caregiver':
         flash('You do not have permission to access this page.')
         return redirect(url_for('patient_dashboard'))
-    return render_template('index.html')
+    return render_template('index.html', patients=list(patients), current=current_patient())
+
+@app.route('/select_patient', methods=['POST'])
+def select_patient():
+    if not session.get('logged_in') or session.get('user_role') != 'caregiver':
+        flash('You do not have permission to access this page.')
+        return redirect(url_for('index'))
+
+    context = patients.get(request.form['patient_id'])
+    if context is None:
+        flash("Error: Patient not found.")
+    else:
+        session['patient_id'] = context.id
+        flash(f"Now managing {context.patient.name}.")
+    return redirect(url_for('index'))
 
 @app.route('/landing_page')
 def landing_page():
@@ -170,53 +537,162 @@ def patient_dashboard():
         flash('You do not have permission to access this page.')
         return redirect(url_for('index'))
 
-    wb, sheet = get_sheet()
-    if not sheet:
+    store = current_patient().store
+    version = store.version()
+    page = request.args.get('page', 1, type=int)
+    records, pages = store.page(page, PAGE_SIZE)
+    if records is None:
         flash("Error: data.xlsx not found.")
         return redirect(url_for('index'))
+    page = min(max(1, page), pages)
 
-    all_data = []
-    meds_to_take_now = []
-    
-    current_time = datetime.now()
-    
-    for row in sheet.iter_rows(min_row=2, values_only=True):
-        if row[1]:
-            all_data.append(row[:4])
-            
-            try:
-                med_time_str = str(row[0])
-                med_hour = int(med_time_str.split(':')[0])
-                med_minute = int(med_time_str.split(':')[1])
-                med_datetime = current_time.replace(hour=med_hour, minute=med_minute, second=0, microsecond=0)
-                
-                time_difference = abs(current_time - med_datetime)
-                if time_difference <= timedelta(minutes=5):
-                    meds_to_take_now.append(row[1])
-            except (ValueError, IndexError):
-                continue
+    page_data = [record.as_row() for record in records]
+    meds_to_take_now = [record.name for record in store.due_near(datetime.now())]
                 
-    return render_template('patient_dashboard.html', data=all_data, meds_to_take_now=meds_to_take_now)
+    return cached_page(page_etag(version, page, pages, *meds_to_take_now), 'patient_dashboard.html',
+                       data=page_data, meds_to_take_now=meds_to_take_now, schedule_version=version, page=page,
+                       pages=pages)
+
+@app.route('/api/patient/due')
+def patient_due():
+    if not session.get('logged_in') or session.get('user_role') != 'patient':
+        return jsonify(error="forbidden"), 403
+
+    store = current_patient().store
+    version = store.version()
+    due = store.due_near(datetime.now())
+    if due is None:
+        return jsonify(error="data.xlsx not found"), 503
+
+    names = [record.name for record in due]
+    etag = hashlib.sha1(f"{version}|{'|'.join(names)}".encode()).hexdigest()[:16]
+    if request.if_none_match.contains_weak(etag):
+        response = app.response_class(status=304)
+    else:
+        response = jsonify(
+            version=version,
+            due=[{"name": r.name, "time": str(r.time), "amount": r.amount, "container": r.container} for r in due]
+        )
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
 
 @app.route('/taken_medication', methods=['POST'])
 def taken_medication():
-    print(f"Medication has been marked as taken.")
+    if not session.get('logged_in') or session.get('user_role') != 'patient':
+        return jsonify(error="forbidden"), 403
+
+    patient = current_patient().patient
+    # The dashboard sends the dose id from the dose_due event; without one, every pending dose counts.
+    dose = request.form.get('dose')
+    if dose:
+        # Only one of this patient's own doses can be acknowledged. One whose escalation chain has
+        # already run out, or never started (no escalation_minutes), is still taken, just late.
+        if dose.rpartition("@")[0] != patient.id or dose_slot(dose) is None:
+            return jsonify(success=False, error="unknown dose"), 404
+        if not escalations.acknowledge(dose):
+            log.info("dose taken after its escalation chain closed", extra={"patient": patient.id, "dose": dose})
+        taken = [dose]
+    else:
+        taken = escalations.acknowledge_patient(patient.id)
+    log.info("medication marked as taken", extra={"patient": patient.id, "doses": taken})
+    for slot in filter(None, map(dose_slot, taken)):
+        adherence.record("taken", patient.id, slot)
+    bus.publish("taken", {"time": datetime.now().strftime("%H:%M"), "patient": patient.id, "name": patient.name},
+                audience=(CAREGIVER,))
     
-    async def send_notification():
-        response = await notificationapi.send({
-        "type": "medication",
-        "to": {
-            "id": NOTIFICATIONAPIID,
-            "number": CARE_NUMBER
-        },
-            "sms": {
-                "message": "Medication has been taken"
-            }
-        })
+    try:
+        job_id = dispatcher.submit("sms", params=caregiver_sms("Medication has been taken", patient.care_number))
+    except QueueFull as e:
+        return jsonify(success=False, error=str(e)), 503
+    
+    return jsonify(success=True, job=job_id, doses=taken)
 
-    asyncio.run(send_notification())
+@app.route('/events')
+def events():
+    if not session.get('logged_in'):
+        return jsonify(error="forbidden"), 403
+
+    # In production the proxy sends /events to events_wsgi.py instead (see wsgi.py).
+    return sse_response(bus, session, request.headers.get('Last-Event-ID', type=int))
+
+@app.route('/notifications/<int:job_id>')
+def notification_status(job_id):
+    if not session.get('logged_in') or session.get('user_role') != 'caregiver':
+        return jsonify(error="forbidden"), 403
     
-    return jsonify(success=True)
+    status = dispatcher.status(job_id)
+    if status is None:
+        return jsonify(error="unknown job"), 404
+    return jsonify(status)
+
+@app.route('/stock')
+def stock():
+    if not session.get('logged_in') or session.get('user_role') != 'caregiver':
+        flash('You do not have permission to access this page.')
+        return redirect(url_for('index'))
+
+    context = current_patient()
+    forecast = forecaster.forecast(inventory.levels(context.id), {context.id: context.store}, date.today())
+    rows = {row["container"]: row for row in map(forecast.row, range(len(forecast)))}
+    return render_template('stock.html', containers=range(1, context.patient.containers + 1), rows=rows,
+                           low_days=g.settings.low_stock_days)
+
+@app.route('/refill', methods=['POST'])
+def refill():
+    if not session.get('logged_in') or session.get('user_role') != 'caregiver':
+        flash('You do not have permission to access this page.')
+        return redirect(url_for('index'))
+
+    context = current_patient()
+    container = request.form.get('container', type=int)
+    count = request.form.get('count', type=int)
+    if container is None or not 1 <= container <= context.patient.containers:
+        flash(f"Error: container must be a number from 1 to {context.patient.containers}.")
+    elif count is None or count < 0:
+        flash("Error: the pill count must be a whole number, 0 or more.")
+    else:
+        inventory.refill(context.id, container, count)
+        log.info("container refilled", extra={"patient": context.id, "container": container, "count": count})
+        flash(f"Container {container} now holds {count} pills.")
+    return redirect(url_for('stock'))
+
+def report_dates(args):
+    """The first and last day of an adherence report from ?start=&end= (YYYY-MM-DD); the last 30 days by default."""
+    end = date.fromisoformat(args['end']) if args.get('end') else date.today()
+    start = date.fromisoformat(args['start']) if args.get('start') else end - timedelta(days=29)
+    if start > end:
+        raise ValueError("start is after end")
+    return start, end
+
+@app.route('/adherence')
+def adherence_page():
+    if not session.get('logged_in') or session.get('user_role') != 'caregiver':
+        flash('You do not have permission to access this page.')
+        return redirect(url_for('index'))
+
+    try:
+        start, end = report_dates(request.args)
+    except ValueError as e:
+        flash(f"Error: invalid date range ({e}).")
+        start, end = report_dates({})
+    context = current_patient()
+    return render_template('adherence.html', name=context.patient.name,
+                           report=adherence.report(context.id, start, end))
+
+@app.route('/api/adherence')
+def adherence_report():
+    if not session.get('logged_in') or session.get('user_role') != 'caregiver':
+        return jsonify(error="forbidden"), 403
+
+    context = patients.get(request.args['patient']) if request.args.get('patient') else current_patient()
+    if context is None:
+        return jsonify(error="unknown patient"), 404
+    try:
+        start, end = report_dates(request.args)
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+    return jsonify(adherence.report(context.id, start, end))
 
 @app.route('/show_all')
 def show_all():
@@ -224,17 +700,77 @@ def show_all():
         flash('You do not have permission to access this page.')
         return redirect(url_for('index'))
 
-    wb, sheet = get_sheet()
-    if not sheet:
+    store = current_patient().store
+    # The version is read before the records, so a change in between can only make the ETag older, never stale.
+    version = store.version()
+    page = request.args.get('page', 1, type=int)
+    records, pages = store.page(page, PAGE_SIZE)
+    if records is None:
         flash("Error: data.xlsx not found.")
         return redirect(url_for('index'))
-    
-    all_data = []
-    for row in sheet.iter_rows(min_row=2, values_only=True):
-        if row[1]:
-            all_data.append(row[:4])
+    page = min(max(1, page), pages)
+
+    page_data = [record.as_row() for record in records]
             
-    return render_template('show_all.html', data=all_data)
+    return cached_page(page_etag(version, page, pages), 'show_all.html', data=page_data, page=page, pages=pages,
+                       formats=list(EXPORT_FORMATS))
+
+@app.route('/export/<fmt>')
+def export_schedule(fmt):
+    if not session.get('logged_in') or session.get('user_role') != 'caregiver':
+        flash('You do not have permission to access this page.')
+        return redirect(url_for('index'))
+    if fmt not in EXPORT_FORMATS:
+        flash(f"Error: unknown export format '{fmt}'.")
+        return redirect(url_for('show_all'))
+
+    context = current_patient()
+    records = context.store.records()
+    if records is None:
+        flash("Error: data.xlsx not found.")
+        return redirect(url_for('show_all'))
+
+    # The rows come from the store's cached in-memory snapshot, not from the backend: only the
+    # encoding is streamed, a chunk at a time, so the response is never built whole. The snapshot
+    # is immutable, so an edit made during the download doesn't change what it contains.
+    encode, mimetype = EXPORT_FORMATS[fmt]
+    return Response(encode(records), mimetype=mimetype,
+                    headers={'Content-Disposition': f'attachment; filename=schedule-{context.id}.{fmt}'})
+
+@app.route('/import', methods=['POST'])
+def import_schedule():
+    if not session.get('logged_in') or session.get('user_role') != 'caregiver':
+        flash('You do not have permission to access this page.')
+        return redirect(url_for('index'))
+
+    upload = request.files.get('schedule_file')
+    extension = os.path.splitext(upload.filename)[1].lower() if upload and upload.filename else ""
+    if extension not in (".csv", ".json"):
+        flash("Error: please choose a .csv or .json file.")
+        return redirect(url_for('edit_data'))
+
+    context = current_patient()
+    stream = io.TextIOWrapper(upload.stream, encoding='utf-8-sig', newline='')
+    rows = validated(read_csv(stream) if extension == ".csv" else read_json(stream), context.patient.containers)
+    try:
+        if request.form.get('mode') == 'replace':
+            count = context.store.replace_all(rows)
+        else:
+            count = context.store.add_many(rows)
+    except ImportErrors as e:
+        flash(f"Import failed, nothing was saved: {e.total} invalid row(s). " + " ".join(e.errors[:5]))
+        return redirect(url_for('edit_data'))
+    except (UnicodeDecodeError, ValueError, csv.Error) as e:
+        flash(f"Error: could not read {upload.filename}: {e}")
+        return redirect(url_for('edit_data'))
+
+    if count is None:
+        flash("Error: data.xlsx not found.")
+        return redirect(url_for('edit_data'))
+    else:
+        log.info("schedule imported", extra={"patient": context.id, "rows": count, "mode": request.form.get('mode')})
+        flash(f"Imported {count} medicines from {upload.filename}.")
+    return redirect(url_for('show_all'))
 
 @app.route('/login')
 def login():
@@ -247,14 +783,19 @@ def login_attempt():
     username = request.form['username']
     password = request.form['password']
 
-    if username == LOGIN_USERNAME and password == LOGIN_PASSWORD:
+    patient = patients.authenticate(username, password)
+
+    settings = g.settings
+    if settings.login_username and username == settings.login_username and password == settings.login_password:
         session['logged_in'] = True
         session['user_role'] = 'caregiver'
+        session['patient_id'] = patients.first().id
         flash('Login successful!')
         return redirect(url_for('index'))
-    elif username == PATIENT_USERNAME and password == PATIENT_PASSWORD:
+    elif patient:
         session['logged_in'] = True
         session['user_role'] = 'patient'
+        session['patient_id'] = patient.id
         flash('Login successful!')
         return redirect(url_for('patient_dashboard'))
     else:
@@ -265,6 +806,7 @@ def login_attempt():
 def logout():
     session.pop('logged_in', None)
     session.pop('user_role', None)
+    session.pop('patient_id', None)
     flash('You have been logged out.')
     return redirect(url_for('login'))
 
@@ -274,20 +816,17 @@ def edit_data():
         flash('You do not have permission to access this page.')
         return redirect(url_for('index'))
 
-    wb, sheet = get_sheet()
-    if not sheet:
+    context = current_patient()
+    version = context.store.version()
+    meds_existing = context.store.names()
+    if meds_existing is None:
         flash("Error: data.xlsx not found.")
         return redirect(url_for('edit_data'))
     
-    meds_existing = [sheet.cell(row=i, column=2).value for i in range(2, sheet.max_row + 1) if sheet.cell(row=i, column=2).value]
-    
-    used_containers = [sheet.cell(row=i, column=4).value for i in range(2, sheet.max_row + 1) if sheet.cell(row=i, column=4).value]
-    
-    all_containers = set(range(1, 11))
-    used_containers_set = {int(c) for c in used_containers if c and str(c).isdigit()}
-    available_containers = sorted(list(all_containers - used_containers_set))
+    available_containers = context.store.free_containers(context.patient.containers)
     
-    return render_template('edit_data.html', meds_existing=meds_existing, available_containers=available_containers)
+    return cached_page(page_etag(version, context.patient.containers), 'edit_data.html',
+                       meds_existing=meds_existing, available_containers=available_containers)
 
 @app.route('/config')
 def config():
@@ -295,22 +834,8 @@ def config():
         flash('You do not have permission to access this page.')
         return redirect(url_for('index'))
         
-    return render_template('config.html', 
-        LOGIN_USERNAME=LOGIN_USERNAME,
-        LOGIN_PASSWORD=LOGIN_PASSWORD,
-        PATIENT_USERNAME=PATIENT_USERNAME,
-        PATIENT_PASSWORD=PATIENT_PASSWORD,
-        TWILIO_ACCOUNT_SID=TWILIO_ACCOUNT_SID,
-        TWILIO_AUTH_TOKEN=TWILIO_AUTH_TOKEN,
-        TWILIO_NUMBER=TWILIO_NUMBER,
-        CARE_NUMBER=CARE_NUMBER,
-        RECIPIENT_NUMBER=RECIPIENT_NUMBER,
-        ARDUINO_PORT=ARDUINO_PORT,
-        CALL_LANGUAGE=CALL_LANGUAGE,
-        NOTIFICATIONAPI1D=NOTIFICATIONAPI1D,
-        NOTIFICATIONAPI2D=NOTIFICATIONAPI2D,
-        NOTIFICATIONAPIID=NOTIFICATIONAPIID
-    )
+    return render_template('config.html',
+        **{name.upper(): value for name, value in dataclasses.asdict(g.settings).items()})
 
 @app.route('/save_config', methods=['POST'])
 def save_config():
@@ -318,29 +843,40 @@ def save_config():
         flash('You do not have permission to access this page.')
         return redirect(url_for('index'))
         
-    new_credentials = {
-        'username': request.form['username'],
-        'password': request.form['password'],
-        'patient_username': request.form['patient_username'],
-        'patient_password': request.form['patient_password'],
-        'twilio_sid': request.form['twilio_sid'],
-        'twilio_token': request.form['twilio_token'],
-        'twilio_number': request.form['twilio_number'],
-        'recipient_number': request.form['recipient_number'],
-        'care_number': request.form['care_number'],
-        'arduino_port': request.form['arduino_port'],
-        'call_language': request.form['call_language'],
-        'notificationapi1d': request.form['notificationapi1d'],
-        'notificationapi2d': request.form['notificationapi2d'],
-        'notificationapiid': request.form['notificationapiid']
-    }
-    
-    update_credentials_file(new_credentials)
+    settings = dataclasses.replace(
+        g.settings,
+        login_username=request.form['username'],
+        login_password=request.form['password'],
+        patient_username=request.form['patient_username'],
+        patient_password=request.form['patient_password'],
+        twilio_account_sid=request.form['twilio_sid'],
+        twilio_auth_token=request.form['twilio_token'],
+        twilio_number=request.form['twilio_number'],
+        recipient_number=request.form['recipient_number'],
+        care_number=request.form['care_number'],
+        arduino_port=request.form['arduino_port'],
+        call_language=request.form['call_language'],
+        notificationapi1d=request.form['notificationapi1d'],
+        notificationapi2d=request.form['notificationapi2d'],
+        notificationapiid=request.form['notificationapiid'],
+        storage_backend=request.form.get('storage_backend', g.settings.storage_backend)
+    )
 
-    session.pop('logged_in', None)
-    flash("Configuration saved successfully! Please restart the Flask server to apply changes.")
-    
-    return redirect(url_for('login'))
+    try:
+        changed = config_store.save(settings)
+    except OSError as e:
+        log.error("error saving configuration", extra={"error": str(e)})
+        flash(f"Error saving configuration: {str(e)}")
+        return redirect(url_for('config'))
+
+    message = "Configuration saved and applied."
+    if changed & RESTART_REQUIRED:
+        message += " Restart the Flask server for the storage change to take effect."
+    flash(message)
+    if changed & {"login_username", "login_password"}:
+        session.pop('logged_in', None)
+        return redirect(url_for('login'))
+    return redirect(url_for('config'))
 
 @app.route('/confirm_add', methods=['POST'])
 def confirm_add():
@@ -353,6 +889,13 @@ def confirm_add():
     amount = request.form['med_amount']
     container = request.form['container']
 
+    repeat = request.form.get('med_repeat', '').strip()
+    rule = parse_rule(f"{time} {repeat}")
+    if rule is None:
+        flash(f"Error: '{repeat}' is not a valid repeat rule, e.g. '{EXAMPLE.split(' ', 1)[1]}'.")
+        return redirect(url_for('edit_data'))
+    time = rule.text
+
     return render_template('confirm_add.html', time=time, name=name, amount=amount, container=container)
 
 @app.route('/do_add_med', methods=['POST'])
@@ -361,11 +904,6 @@ def do_add_med():
         flash('You do not have permission to access this page.')
         return redirect(url_for('index'))
 
-    wb, sheet = get_sheet()
-    if not sheet:
-        flash("Error: data.xlsx not found.")
-        return redirect(url_for('edit_data'))
-
     med_details = [
         request.form['med_time'],
         request.form['med_name'],
@@ -373,8 +911,9 @@ def do_add_med():
         request.form['container']
     ]
     
-    sheet.append(med_details)
-    wb.save("data.xlsx")
+    if not current_patient().store.add(*med_details):
+        flash("Error: data.xlsx not found.")
+        return redirect(url_for('edit_data'))
     flash(f"Medicine '{med_details[1]}' was added successfully!")
     return redirect(url_for('edit_data'))
 
@@ -384,8 +923,8 @@ def confirm_edit():
         flash('You do not have permission to access this page.')
         return redirect(url_for('index'))
         
-    wb, sheet = get_sheet()
-    if not sheet:
+    store = current_patient().store
+    if store.version() is None:
         flash("Error: data.xlsx not found.")
         return redirect(url_for('edit_data'))
 
@@ -395,16 +934,10 @@ def confirm_edit():
     new_amount = request.form['new_amount']
     new_container = request.form['new_container']
     
-    old_data = []
-    for row_num in range(2, sheet.max_row + 1):
-        if sheet.cell(row=row_num, column=2).value == med_name_edit:
-            old_data.append(sheet.cell(row=row_num, column=1).value)
-            old_data.append(sheet.cell(row=row_num, column=2).value)
-            old_data.append(sheet.cell(row=row_num, column=3).value)
-            old_data.append(sheet.cell(row=row_num, column=4).value)
-            break
+    record = store.find(med_name_edit)
     
-    if old_data:
+    if record:
+        old_data = list(record.as_row())
         return render_template('confirm_edit.html', old_data=old_data, new_name=new_name, new_time=new_time, new_amount=new_amount, new_container=new_container)
     else:
         flash("Error: Medicine not found for editing.")
@@ -416,8 +949,8 @@ def do_edit_med():
         flash('You do not have permission to access this page.')
         return redirect(url_for('index'))
     
-    wb, sheet = get_sheet()
-    if not sheet:
+    store = current_patient().store
+    if store.version() is None:
         flash("Error: data.xlsx not found.")
         return redirect(url_for('edit_data'))
 
@@ -427,19 +960,7 @@ def do_edit_med():
     new_amount = request.form['new_amount']
     new_container = request.form['new_container']
 
-    for row_num in range(2, sheet.max_row + 1):
-        if sheet.cell(row=row_num, column=2).value == med_name_edit:
-            if new_time:
-                sheet.cell(row=row_num, column=1).value = new_time
-            if new_name:
-                sheet.cell(row=row_num, column=2).value = new_name
-            if new_amount:
-                sheet.cell(row=row_num, column=3).value = new_amount
-            if new_container:
-                sheet.cell(row=row_num, column=4).value = new_container
-            break
-    
-    wb.save("data.xlsx")
+    store.update(med_name_edit, time=new_time, new_name=new_name, amount=new_amount, container=new_container)
     flash(f"Medicine '{med_name_edit}' was updated successfully!")
     return redirect(url_for('edit_data'))
 
@@ -449,23 +970,16 @@ def confirm_delete():
         flash('You do not have permission to access this page.')
         return redirect(url_for('index'))
         
-    wb, sheet = get_sheet()
-    if not sheet:
+    store = current_patient().store
+    if store.version() is None:
         flash("Error: data.xlsx not found.")
         return redirect(url_for('edit_data'))
     
     med_name_delete = request.form['med_to_delete']
-    med_data = []
-
-    for row_num in range(2, sheet.max_row + 1):
-        if sheet.cell(row=row_num, column=2).value == med_name_delete:
-            med_data.append(sheet.cell(row=row_num, column=1).value)
-            med_data.append(sheet.cell(row=row_num, column=2).value)
-            med_data.append(sheet.cell(row=row_num, column=3).value)
-            med_data.append(sheet.cell(row=row_num, column=4).value)
-            break
+    record = store.find(med_name_delete)
     
-    if med_data:
+    if record:
+        med_data = list(record.as_row())
         return render_template('confirm_delete.html', med_data=med_data)
     else:
         flash("Error: Medicine not found.")
@@ -477,18 +991,13 @@ def delete_med():
         flash('You do not have permission to access this page.')
         return redirect(url_for('index'))
         
-    wb, sheet = get_sheet()
-    if not sheet:
+    store = current_patient().store
+    if store.version() is None:
         flash("Error: data.xlsx not found.")
         return redirect(url_for('edit_data'))
 
     med_name_delete = request.form['med_name_delete']
-    for row_num in range(2, sheet.max_row + 1):
-        if sheet.cell(row=row_num, column=2).value == med_name_delete:
-            sheet.delete_rows(row_num, 1)
-            break
-            
-    wb.save("data.xlsx")
+    store.delete(med_name_delete)
     flash(f"Medicine '{med_name_delete}' was deleted successfully!")
     return redirect(url_for('edit_data'))
 
@@ -498,14 +1007,40 @@ def run_simulation():
         flash('You do not have permission to access this page.')
         return redirect(url_for('index'))
         
-    wb, sheet = get_sheet()
-    if not sheet:
+    unique_times = current_patient().store.times()
+    if unique_times is None:
         flash("Error: data.xlsx not found.")
         return redirect(url_for('index'))
-
-    unique_times = sorted(list(set(str(row[0]) for row in sheet.iter_rows(min_row=2, values_only=True) if row[0])))
     
-    return render_template('run_simulation.html', unique_times=unique_times)
+    return render_template('run_simulation.html', unique_times=unique_times, periods=list(PERIODS))
+
+@app.route('/simulate', methods=['POST'])
+def simulate_period():
+    if not session.get('logged_in') or session.get('user_role') != 'caregiver':
+        flash('You do not have permission to access this page.')
+        return redirect(url_for('index'))
+
+    period = request.form.get('period', 'day')
+    if period not in PERIODS:
+        flash("Error: Unknown simulation period.")
+        return redirect(url_for('run_simulation'))
+    try:
+        lag_minutes = float(request.form.get('lag_minutes') or 0)
+        fail_rate = float(request.form.get('fail_percent') or 0) / 100
+    except ValueError:
+        flash("Error: Lag and failure rate must be numbers.")
+        return redirect(url_for('run_simulation'))
+    # Written this way round so NaN fails too; a lag longer than the period would only miss everything.
+    if not 0 <= lag_minutes <= PERIODS[period].total_seconds() / 60:
+        flash("Error: Lag must be between 0 and the length of the period.")
+        return redirect(url_for('run_simulation'))
+    if not 0 <= fail_rate <= 1:
+        flash("Error: Failure rate must be between 0 and 100%.")
+        return redirect(url_for('run_simulation'))
+
+    report = run_simulated_period(period, lag_minutes=lag_minutes, fail_rate=fail_rate)
+    return render_template('run_simulation.html', unique_times=current_patient().store.times() or (),
+                           periods=list(PERIODS), report=report.as_dict(), period=period)
 
 @app.route('/dispense', methods=['POST'])
 def dispense():
@@ -514,66 +1049,98 @@ def dispense():
         return redirect(url_for('index'))
         
     timing = request.form['timing']
-    wb, sheet = get_sheet()
-    if not sheet:
+    context = current_patient()
+    due = context.store.due_at(timing, date.today())
+    if due is None:
         flash("Error: data.xlsx not found.")
         return redirect(url_for('run_simulation'))
     
     meds_dispense = {}
-    for row_num in range(2, sheet.max_row + 1):
-        if str(sheet.cell(row=row_num, column=1).value) == timing:
-            meds_dispense[sheet.cell(row=row_num, column=2).value] = {
-                "quantity": sheet.cell(row=row_num, column=3).value,
-                "container": sheet.cell(row=row_num, column=4).value
-            }
-
-    print("Meds to dispense:")
-    for name, details in meds_dispense.items():
-        print(f"Name: {name}, Quantity: {details['quantity']}, Container: {details['container']}")
-
-    if CALL_LANGUAGE == "English":
-        twiml_message = '<Response><Say>Medication time, please take your meds. Medication time, please take your meds.Medication time, please take your meds. Medication time, please take your meds.</Say></Response>'
-    elif CALL_LANGUAGE == "Chinese":
-        twiml_message = '<Response><Say language="zh-CN">服药时间到了，请吃药.服药时间到了，请吃药.服药时间到了，请吃药.</Say></Response>'
-    else:
-        twiml_message = '<Response><Say>Medication time, please take your meds.</Say></Response>'
+    for record in due:
+        meds_dispense[record.name] = {
+            "quantity": record.amount,
+            "container": record.container
+        }
+
+    hhmm = normalize_time(timing)
+    if not hhmm:
+        flash(f"Error: {timing} is not a valid time.")
+        return redirect(url_for('run_simulation'))
+
+    log.info("meds to dispense", extra={"patient": context.id, "slot": timing, "meds": meds_dispense})
+    # The leader owns the dispenser's serial port; this worker only hands it the request. The leader
+    # publishes "dispensed" once the dispenser has confirmed every med.
+    dispense_requests.put(context.id, datetime.combine(date.today(), datetime.strptime(hhmm, "%H:%M").time()))
 
     try:
-        call = client.calls.create(
-            twiml=twiml_message,
-            to=recipient_number,
-            from_=twilio_number
-        )
-        print("Call ID:", call.sid)
+        jobs = notify_medication_time(context.patient, slot_key(datetime.now(), hhmm))
+        log.info("notifications queued", extra={"patient": context.id, "jobs": jobs})
+    except QueueFull as e:
+        log.error("error queueing the call", extra={"patient": context.id, "error": str(e)})
+        flash(f"Error queueing the call: {str(e)}")
 
-        async def send_notification():
-            response = await notificationapi.send({
-            "type": "medication",
-            "to": {
-                "id": NOTIFICATIONAPIID,
-                "number": CARE_NUMBER
-            },
-                "sms": {
-                    "message": "Medication notification sent"
-                }
-            })
+    flash(f"Dispensing for {timing} requested! You will be notified once the dispenser confirms it.")
+    return redirect(url_for('run_simulation'))
 
-        asyncio.run(send_notification())
+@app.cli.command("simulate")
+@click.option("--period", type=click.Choice(list(PERIODS)), default="day")
+@click.option("--start", type=click.DateTime(), default=None, help="Virtual start time (default: today 00:00).")
+@click.option("--lag", "lag_minutes", default=0.0, help="Minutes each scheduler wake runs late.")
+@click.option("--fail-rate", default=0.0, help="Fraction of dispense commands the fake dispenser fails.")
+def simulate_command(period, start, lag_minutes, fail_rate):
+    """Replay the schedule in virtual time with stub notifications and a fake dispenser."""
+    report = run_simulated_period(period, start, lag_minutes, fail_rate)
+    for key, value in report.as_dict().items():
+        print(f"{key:>18}: {value}")
 
-        time.sleep(2)
+def patient_store(patient_id):
+    context = patients.get(patient_id)
+    if context is None:
+        raise click.BadParameter(f"unknown patient {patient_id}", param_hint="--patient")
+    return context.store
 
-    except Exception as e:
-        print("Error making the call:", str(e))
-        flash(f"Error making the call: {str(e)}")
+@app.cli.command("import-xlsx")
+@click.argument("path", default="data.xlsx")
+@click.option("--patient", default=DEFAULT_PATIENT, help="Patient id from patients.json.")
+def import_xlsx_command(path, patient):
+    """Replace the stored schedule with the rows in an xlsx file."""
+    print(f"Imported {import_xlsx(patient_store(patient).backend, path)} rows from {path}")
 
-    flash(f"Dispensing for {timing} confirmed successfully! Check the console for details.")
-    return redirect(url_for('run_simulation'))
+@app.cli.command("export-xlsx")
+@click.argument("path", default="data.xlsx")
+@click.option("--patient", default=DEFAULT_PATIENT, help="Patient id from patients.json.")
+def export_xlsx_command(path, patient):
+    """Write the stored schedule out in the data.xlsx layout."""
+    print(f"Exported {export_xlsx(patient_store(patient).backend, path)} rows to {path}")
 
-if __name__ == '__main__':
-    scheduler = BackgroundScheduler()
-    scheduler.add_job(func=dispense_medication_job, trigger="interval", minutes=1)
-    scheduler.start()
+def shutdown():
+    election.stop()
+    bus.stop()
+    escalations.stop()
+    adherence.stop()
+    dispatcher.stop()
+    patients.close()
+
+def create_app():
+    """Starts this process's background services and returns the app (see wsgi.py).
 
-    app.run(host='0.0.0.0', port=5000, debug=True, use_reloader=False)
+    Every worker process runs its own notification dispatcher and event relay, but only the
+    one holding SCHEDULER_LOCK_FILE runs the dose scheduler and the escalation chains and
+    opens the dispensers' serial ports; /dispense on the other workers hands it the request.
+    If it exits, another worker takes over, chains and all.
+    """
+    global services_started
+    if not services_started:
+        services_started = True
+        configure_logging()
+        # The Twilio client logs every request's headers at INFO.
+        logging.getLogger("twilio.http_client").setLevel(logging.WARNING)
+        escalations.start()
+        adherence.start()
+        bus.start()
+        election.start()
+        atexit.register(shutdown)
+    return app
 
-    atexit.register(lambda: scheduler.shutdown())
\ No newline at end of file
+if __name__ == '__main__':
+    create_app().run(host='0.0.0.0', port=5000, debug=True, use_reloader=False)
\ No newline at end of file
@@ -0,0 +1,92 @@
+import gzip
+import hashlib
+import mimetypes
+import os
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSIBLE = {"text/html", "text/css", "text/plain", "text/csv", "text/javascript", "application/javascript",
+                "application/json"}
+# Below this, the compressed body plus the Content-Encoding header isn't worth the CPU.
+MIN_COMPRESS_SIZE = 512
+
+
+def choose_encoding(accepted):
+    """Picks br (if the brotli package is installed) or gzip from a request's Accept-Encoding, or None."""
+    if brotli is not None and accepted["br"]:
+        return "br"
+    if accepted["gzip"]:
+        return "gzip"
+    return None
+
+
+def compress(data, encoding, best=False):
+    """best=True is for bodies compressed once and served many times (static files)."""
+    if encoding == "br":
+        return brotli.compress(data, quality=11 if best else 4)
+    return gzip.compress(data, compresslevel=9 if best else 6)
+
+
+def tree_digest(*roots):
+    """A short hash of every file under roots, names and contents, to tell one deploy from the next."""
+    digest = hashlib.sha256()
+    for root in roots:
+        for directory, subdirs, files in os.walk(root):
+            subdirs.sort()
+            for name in sorted(files):
+                path = os.path.join(directory, name)
+                digest.update(os.path.relpath(path, root).encode())
+                with open(path, "rb") as f:
+                    digest.update(f.read())
+    return digest.hexdigest()[:12]
+
+
+class Asset:
+    __slots__ = ("data", "mimetype", "digest", "encoded")
+
+    def __init__(self, data, mimetype):
+        self.data = data
+        self.mimetype = mimetype
+        self.digest = hashlib.sha256(data).hexdigest()[:12]
+        self.encoded = {}
+        if mimetype in COMPRESSIBLE and len(data) >= MIN_COMPRESS_SIZE:
+            for encoding in ("gzip", "br") if brotli is not None else ("gzip",):
+                self.encoded[encoding] = compress(data, encoding, best=True)
+
+
+class StaticAssets:
+    """The files under root, read and compressed once at startup and served from memory.
+
+    Each file is served under a name with its content hash in it (css/base.3f2a9c0d81b4.css), so
+    it can be cached for a year: a changed file gets a new name, and url() hands pages the
+    current one. The plain name still works, for anything that links it directly, but isn't
+    cached without revalidating.
+    """
+
+    def __init__(self, root):
+        self._files = {}
+        self._hashed = {}
+        if not os.path.isdir(root):
+            return
+        for directory, _, files in os.walk(root):
+            for name in files:
+                path = os.path.join(directory, name)
+                plain = os.path.relpath(path, root).replace(os.sep, "/")
+                with open(path, "rb") as f:
+                    asset = Asset(f.read(), mimetypes.guess_type(name)[0] or "application/octet-stream")
+                stem, ext = os.path.splitext(plain)
+                hashed = f"{stem}.{asset.digest}{ext}"
+                self._files[plain] = (asset, False)
+                self._files[hashed] = (asset, True)
+                self._hashed[plain] = hashed
+
+    def url_name(self, name):
+        """The content-hashed name to link name by."""
+        return self._hashed.get(name, name)
+
+    def get(self, name):
+        """Returns (Asset, whether name is the content-hashed one), or None."""
+        return self._files.get(name)
@@ -0,0 +1,107 @@
+"""Adherence log: write throughput and report latency over a year of events.
+
+Fills a scratch AdherenceLog with a year of doses for N patients at four rounds a day, through
+record() and the batched background writer the app uses. 90% of the doses are taken, after a
+random delay, and most of the rest reach the end of their escalation chain. Then it times
+reports for random patients over a week, a month, a quarter and the whole year, and checks
+a few reports against the same numbers computed directly from the generated doses.
+
+Usage: python benchmarks/bench_adherence.py [patients] [days]   (default 300 patients, 365 days)
+"""
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from datetime import date, datetime, timedelta
+
+from common import measure, report
+
+from adherence import AdherenceLog
+
+ROUNDS = (8, 12, 18, 22)
+CHECKED = 3
+
+
+def generate(log, patients, first, days, seed=0):
+    """Records the doses; returns the (slot, taken delay in minutes or None) of the first CHECKED patients."""
+    rng = random.Random(seed)
+    expected = {}
+    for p in range(patients):
+        patient = f"p{p}"
+        doses = expected.setdefault(patient, []) if p < CHECKED else None
+        for day in range(days):
+            for hour in ROUNDS:
+                slot = datetime.combine(first + timedelta(days=day), datetime.min.time()).replace(hour=hour)
+                fired = slot.timestamp()
+                log.record("fired", patient, slot, at=fired)
+                log.record("dispensed", patient, slot, at=fired)
+                delay = None
+                if rng.random() < 0.9:
+                    delay = int(rng.expovariate(1 / 15))
+                    log.record("taken", patient, slot, at=fired + delay * 60)
+                elif rng.random() < 0.7:
+                    log.record("missed", patient, slot, at=fired + 30 * 60)
+                if doses is not None:
+                    doses.append((slot, delay))
+    return expected
+
+
+def check(log, patient, doses, first, last):
+    doses = [(slot, delay) for slot, delay in doses if first <= slot.date() <= last]
+    taken = [delay for _, delay in doses if delay is not None]
+    longest = streak = 0
+    for _, delay in doses:
+        streak = 0 if delay is not None else streak + 1
+        longest = max(longest, streak)
+    got = log.report(patient, first, last)
+    assert got["doses"] == len(doses) and got["taken"] == len(taken), (got["doses"], got["taken"])
+    assert got["median_minutes_to_take"] == round(statistics.median(taken), 1)
+    assert got["longest_missed_streak"] == longest and got["current_missed_streak"] == streak
+    assert len(got["days"]) == (last - first).days + 1
+
+
+def main():
+    patients = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+    days = int(sys.argv[2]) if len(sys.argv) > 2 else 365
+    path = os.path.join(tempfile.mkdtemp(), "adherence.db")
+    log = AdherenceLog(path, batch_size=5000)
+    log.start()
+    first = date(2025, 1, 1)
+    last = first + timedelta(days=days - 1)
+
+    start = time.perf_counter()
+    expected = generate(log, patients, first, days)
+    queued = time.perf_counter() - start
+    log.stop()
+    written = time.perf_counter() - start
+    with log._connect() as conn:
+        events = conn.execute("SELECT COUNT(*) FROM adherence_events").fetchone()[0]
+    print(f"{patients} patients x {days} days: {events:,} events, {os.path.getsize(path) / 2 ** 20:.1f} MiB")
+    print(f"record() {queued / events * 1e6:.2f} us per event on the caller; all written after {written:.1f} s "
+          f"({events / written:,.0f} events/s)")
+
+    for patient, doses in expected.items():
+        check(log, patient, doses, first, last)
+        check(log, patient, doses, first + timedelta(days=40), first + timedelta(days=70))
+    print(f"reports for {len(expected)} patients match the generated doses")
+
+    rng = random.Random(1)
+    results = {}
+    for label, span in (("week", 7), ("month", 30), ("quarter", 91), ("year", days)):
+        span = min(span, days)
+
+        def one():
+            begin = first + timedelta(days=rng.randrange(days - span + 1))
+            log.report(f"p{rng.randrange(patients)}", begin, begin + timedelta(days=span - 1))
+
+        samples = measure(one, 200)
+        results[label] = samples
+        report(f"report over a {label} ({span * len(ROUNDS)} doses)", samples)
+    year = sorted(results["year"])
+    assert year[int(len(year) * 0.99)] < 0.1, "a year's report should take well under 100 ms"
+
+
+if __name__ == "__main__":
+    main()
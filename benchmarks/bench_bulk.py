@@ -0,0 +1,111 @@
+"""Bulk import/export of large schedules: time and peak RSS, per backend.
+
+Each scenario runs in its own process so its peak RSS (ru_maxrss) isn't inflated by the one
+before. "import" validates a CSV file and writes it with ScheduleStore.replace_all in one
+transaction/rewrite, "export" streams the schedule back out as CSV, and "http" does both
+through POST /import and GET /export/csv. For comparison, "one-by-one" adds 200 rows with
+store.add, which is what 200 confirm_add -> do_add_med round trips cost.
+
+Export's peak RSS is mostly the ScheduleStore's in-memory copy of the schedule, which the app
+keeps anyway; the streamed response itself only holds one chunk of rows at a time. The xlsx
+numbers include importing openpyxl (about 20 MB).
+
+Usage: python benchmarks/bench_bulk.py [rows ...]   (default: 1000 10000 100000)
+"""
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+from common import ROOT, import_app, login
+
+BACKENDS = ("sqlite", "xlsx")
+
+
+def peak_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def write_csv(path, rows):
+    with open(path, "w", newline="") as f:
+        f.write("Timing,Name,Quantity,Container\n")
+        for i in range(rows):
+            f.write(f"{i % 24:02d}:{(i * 7) % 60:02d},Med{i},{i % 3 + 1},{i % 10 + 1}\n")
+
+
+def open_store(backend, workdir):
+    from schedule_store import ScheduleStore
+    from storage import SqliteBackend, XlsxBackend, write_xlsx
+
+    if backend == "sqlite":
+        return ScheduleStore(SqliteBackend(os.path.join(workdir, "meds.db")))
+    path = os.path.join(workdir, "data.xlsx")
+    if not os.path.exists(path):
+        write_xlsx(path, [])
+    return ScheduleStore(XlsxBackend(path))
+
+
+def child(op, backend, workdir, csv_path):
+    from storage import iter_csv, read_csv, validated
+
+    before = peak_mb()
+    start = time.perf_counter()
+    if op == "import":
+        store = open_store(backend, workdir)
+        with open(csv_path, newline="") as f:
+            rows = store.replace_all(validated(read_csv(f), 10))
+    elif op == "export":
+        store = open_store(backend, workdir)
+        with open(os.devnull, "w") as out:
+            for chunk in iter_csv(store.records()):
+                out.write(chunk)
+        rows = len(store.records())
+    elif op == "one-by-one":
+        store = open_store(backend, workdir)
+        rows = 200
+        for i in range(rows):
+            store.add("08:00", f"Single{i}", "1", str(i % 10 + 1))
+    else:
+        app = import_app(workdir, rows=0)
+        settings = app.config_store.current()
+        client = login(app.app.test_client(), settings.login_username, settings.login_password)
+        with open(csv_path, "rb") as f:
+            client.post("/import", data={"mode": "replace", "schedule_file": (f, "meds.csv")})
+        response = client.get("/export/csv", buffered=False)
+        rows = sum(chunk.count(b"\n") for chunk in response.response) - 1
+    print(json.dumps({"seconds": time.perf_counter() - start, "rows": rows, "rss_mb": peak_mb() - before}))
+
+
+def run(op, backend, workdir, csv_path):
+    result = subprocess.run([sys.executable, os.path.abspath(__file__), "--child", op, backend, workdir, csv_path],
+                            capture_output=True, text=True, check=True, cwd=ROOT)
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def main():
+    sizes = [int(n) for n in sys.argv[1:]] or [1000, 10000, 100000]
+    print(f"{'scenario':<34} {'rows':>8} {'seconds':>9} {'rows/s':>10} {'peak RSS +MB':>13}")
+    for backend in BACKENDS:
+        for rows in sizes:
+            workdir = tempfile.mkdtemp()
+            csv_path = os.path.join(workdir, "meds.csv")
+            write_csv(csv_path, rows)
+            ops = ["import", "export"] + (["http"] if backend == "xlsx" else [])
+            for op in ops:
+                result = run(op, backend, workdir if op != "http" else tempfile.mkdtemp(), csv_path)
+                print(f"{backend + ' ' + op:<34} {result['rows']:>8} {result['seconds']:>9.2f} "
+                      f"{result['rows'] / result['seconds']:>10.0f} {result['rss_mb']:>13.1f}")
+        workdir = tempfile.mkdtemp()
+        result = run("one-by-one", backend, workdir, "")
+        print(f"{backend + ' one-by-one add':<34} {result['rows']:>8} {result['seconds']:>9.2f} "
+              f"{result['rows'] / result['seconds']:>10.0f} {result['rss_mb']:>13.1f}")
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["--child"]:
+        child(*sys.argv[2:6])
+    else:
+        main()
@@ -0,0 +1,180 @@
+"""Outbound call/SMS counts under bursts, with stub providers behind the real Dispatcher and gate.
+
+The scratch setup has one patient with three meds at 08:00 plus 20 more patients at 08:00 who
+each have their own phone but share one caregiver number. Each scenario prints how many calls
+and SMS actually reached the providers next to the naive count of one call and one SMS per
+medication and per button press, and asserts the exact counts the gate should let through.
+The gate keeps its state in SQLite, and a second process with its own Dispatcher and stub
+providers on the same database stands in for another worker: what it sends counts too, and it
+must be deduplicated and rate limited together with this process.
+
+Usage: python benchmarks/bench_coalescing.py
+"""
+import json
+import logging
+import multiprocessing
+import os
+import tempfile
+import time
+from datetime import datetime
+
+from common import PLACEHOLDER_CREDENTIALS, import_app, login
+from stubs import StubCallProvider, StubSmsProvider
+
+SHARED = 20
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def write_patients(workdir):
+    import openpyxl
+
+    os.makedirs(os.path.join(workdir, "schedules"), exist_ok=True)
+    entries = [{"id": "default", "name": "Patient", "recipient_number": "+10000000001",
+                "care_number": "+10000000002", "username": "patient", "password": "patient",
+                "schedule": "default.xlsx"}]
+    rows = {"default.xlsx": [["08:00", "Panadol", "1", "1"], ["08:00", "Aspirin", "1", "2"],
+                             ["08:00", "Vitamin D", "1", "3"]] + [[f"{h:02d}:30", f"Med{h}", "1", "4"] for h in range(24)]}
+    for i in range(SHARED):
+        entries.append({"id": f"ward{i}", "name": f"Ward {i}", "recipient_number": f"+1555000{i:04d}",
+                        "care_number": "+10000000099", "schedule": f"schedules/ward{i}.xlsx"})
+        rows[f"schedules/ward{i}.xlsx"] = [["08:00", "Metformin", "1", "1"]]
+    for path, meds in rows.items():
+        wb = openpyxl.Workbook()
+        wb.active.append(["Timing", "Name", "Quantity", "Container"])
+        for med in meds:
+            wb.active.append(med)
+        wb.save(os.path.join(workdir, path))
+    with open(os.path.join(workdir, "patients.json"), "w") as f:
+        json.dump(entries, f)
+
+
+def settled(calls, sms):
+    """Waits until the stub providers have stopped receiving; returns (calls, sms) sent so far."""
+    deadline = time.time() + 5
+    seen = None
+    while time.time() < deadline:
+        current = (len(calls.calls), len(sms.sent))
+        if current == seen:
+            return current
+        seen = current
+        time.sleep(0.1)
+    return seen
+
+
+def other_worker(gate_path, conn):
+    """Another worker process: submits the batches it is sent through its own Dispatcher and the
+    shared gate, and answers with how many calls and SMS its providers have received."""
+    logging.disable(logging.ERROR)
+    from notifier import Dispatcher, SharedNotificationGate
+
+    clock = FakeClock()
+    calls, sms = StubCallProvider(), StubSmsProvider()
+    dispatcher = Dispatcher(calls, sms, maxsize=1000, gate=SharedNotificationGate(gate_path, 900, 6, 3600, clock=clock))
+    while True:
+        message = conn.recv()
+        if message is None:
+            break
+        clock.now, jobs, slot = message
+        dispatcher.submit_batch(jobs, slot)
+        conn.send(settled(calls, sms))
+    dispatcher.stop()
+
+
+class OtherWorker:
+    def __init__(self, gate_path, clock):
+        self.clock = clock
+        self.sent = (0, 0)
+        self._conn, child = multiprocessing.Pipe()
+        self._process = multiprocessing.get_context("spawn").Process(target=other_worker, args=(gate_path, child))
+        self._process.start()
+
+    def submit_batch(self, jobs, slot):
+        self._conn.send((self.clock.now, jobs, slot))
+        self.sent = self._conn.recv()
+
+    def stop(self):
+        self._conn.send(None)
+        self._process.join(10)
+
+
+def main():
+    logging.disable(logging.ERROR)
+    workdir = tempfile.mkdtemp()
+    with open(os.path.join(workdir, "credentials.py"), "w") as f:
+        f.write(PLACEHOLDER_CREDENTIALS)
+    write_patients(workdir)
+    app = import_app(workdir)
+
+    from notifier import Dispatcher, SharedNotificationGate
+
+    clock = FakeClock()
+    calls, sms = StubCallProvider(), StubSmsProvider()
+    gate_path = os.path.join(workdir, "bench-notifications.db")
+    app.dispatcher = Dispatcher(calls, sms, maxsize=1000,
+                                gate=SharedNotificationGate(gate_path, 900, 6, 3600, clock=clock))
+    # Another worker process: its own dispatcher, queue and providers, the same gate database.
+    other = OtherWorker(gate_path, clock)
+    settings = app.config_store.current()
+    client = login(app.app.test_client(), settings.login_username, settings.login_password)
+    client.post("/select_patient", data={"patient_id": "default"})
+    eight = datetime.now().replace(hour=8, minute=0, second=0, microsecond=0)
+
+    def settle():
+        here = settled(calls, sms)
+        return here[0] + other.sent[0], here[1] + other.sent[1]
+
+    def scenario(label, action, naive, expected):
+        before = settle()
+        action()
+        after = settle()
+        sent = (after[0] - before[0], after[1] - before[1])
+        print(f"{label:<62} calls={sent[0]:<3} sms={sent[1]:<3} (naive: calls={naive[0]}, sms={naive[1]})")
+        assert sent == expected, f"{label}: expected calls={expected[0]}, sms={expected[1]}"
+
+    # One call per patient, one SMS per caregiver number.
+    scenario(f"08:00 tick: 3 meds for one patient + {SHARED} sharing a caregiver",
+             lambda: app.dispense_medication_job(eight),
+             (3 + SHARED, 3 + SHARED), (1 + SHARED, 2))
+    scenario("operator presses /dispense 08:00 five times right after",
+             lambda: [client.post("/dispense", data={"timing": "08:00"}) for _ in range(5)],
+             (15, 15), (0, 0))
+    default_jobs = app.medication_jobs([app.patients.get("default").patient])
+    scenario("another worker's /dispense 08:00 for the same patient",
+             lambda: other.submit_batch(default_jobs, app.slot_key(eight, "08:00")),
+             (1, 1), (0, 0))
+    scenario("scheduler catch-up fires the same 08:00 slot again",
+             lambda: app.dispense_medication_job(eight),
+             (3 + SHARED, 3 + SHARED), (0, 0))
+
+    clock.now += 901
+    scenario("/dispense 08:00 again once the dedupe window has passed",
+             lambda: client.post("/dispense", data={"timing": "08:00"}),
+             (3, 3), (1, 1))
+    # The patient's phone and caregiver have 5 of their 6 tokens left after the last scenario.
+    scenario("burst of /dispense for 20 different slots (rate limit 6/h)",
+             lambda: [client.post("/dispense", data={"timing": f"{h:02d}:30"}) for h in range(20)],
+             (20, 20), (5, 5))
+    scenario("another worker's /dispense 23:30 with those tokens spent",
+             lambda: other.submit_batch(default_jobs, app.slot_key(eight, "23:30")),
+             (1, 1), (0, 0))
+
+    clock.now += 3600
+    client.get("/logout")
+    login(client, "patient", "patient")
+    # A full hour refills the caregiver's bucket to 6.
+    scenario("an hour later, patient taps 'taken' 10 times",
+             lambda: [client.post("/taken_medication") for _ in range(10)],
+             (0, 10), (0, 6))
+    app.dispatcher.stop()
+    other.stop()
+
+
+if __name__ == "__main__":
+    main()
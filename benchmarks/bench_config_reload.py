@@ -0,0 +1,192 @@
+"""Configuration saves under load: no dropped requests and no restart.
+
+First, in-process: a Dispatcher is swapped to a new SMS provider while 20 slow sends are still
+running on the old one. Every job must still be sent, the old provider must finish its own
+jobs and only then be closed, and the new provider must take every job submitted after the swap.
+
+Then a real server runs from a scratch directory that starts with an old-style credentials.py.
+It is the dev server by default, or gunicorn with N workers so that the saves have to reach
+the other processes too. Client threads replay the read routes while the caregiver saves a new
+configuration every 0.2 s through /save_config, and once the bench rewrites config.json
+directly, as an operator would. After each save the new Twilio number must show up on /config
+(answered by any worker). At the end a caregiver password change must lock out the old
+password at once. Any request that fails or returns a non-200 status counts as dropped, and
+the run fails unless there are none.
+
+Usage: python benchmarks/bench_config_reload.py [workers]   (default 0: dev server; N needs gunicorn)
+"""
+import http.client
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+from dataclasses import asdict
+
+from bench_workers import PORT, session_cookie, start_server
+from common import PLACEHOLDER_CREDENTIALS, ROOT, summarize
+from stubs import StubCallProvider, StubSmsProvider
+
+from notifier import Dispatcher
+from settings import ConfigStore, from_dict
+
+CLIENTS = 8
+BASELINE = 3
+RELOADING = 6
+
+FORM = {
+    "username": "caregiver", "password": "caregiver", "patient_username": "patient", "patient_password": "patient",
+    "twilio_sid": "ACbenchmark", "twilio_token": "benchmark", "twilio_number": "+10000000000",
+    "recipient_number": "+10000000001", "care_number": "+10000000002", "arduino_port": "/dev/null",
+    "call_language": "English", "notificationapi1d": "benchmark", "notificationapi2d": "benchmark",
+    "notificationapiid": "benchmark", "storage_backend": "xlsx",
+}
+
+
+class ClosingSmsProvider(StubSmsProvider):
+    def __init__(self, latency):
+        super().__init__(latency)
+        self.closed_after = None
+
+    async def close(self):
+        self.closed_after = len(self.sent)
+
+
+def inflight_swap():
+    old, new = ClosingSmsProvider(0.5), ClosingSmsProvider(0.0)
+    dispatcher = Dispatcher(StubCallProvider(), old, maxsize=100, workers=20)
+    first = [dispatcher.submit("sms", params={"to": {"number": f"+1{i}"}}) for i in range(20)]
+    time.sleep(0.1)
+    dispatcher.replace_provider("sms", new)
+    second = [dispatcher.submit("sms", params={"to": {"number": f"+2{i}"}}) for i in range(20)]
+    deadline = time.time() + 10
+    while time.time() < deadline and any(dispatcher.status(i)["status"] != "sent" for i in first + second):
+        time.sleep(0.05)
+    time.sleep(0.1)
+    statuses = {dispatcher.status(i)["status"] for i in first + second}
+    dispatcher.stop()
+    print(f"provider swap mid-flight: old sent {len(old.sent)} and closed after {old.closed_after}, "
+          f"new sent {len(new.sent)}, job statuses {sorted(statuses)}")
+    assert statuses == {"sent"} and len(old.sent) == 20 and old.closed_after == 20 and len(new.sent) == 20
+
+
+def load(stop, phase, results, lock):
+    conn = http.client.HTTPConnection("127.0.0.1", PORT, timeout=10)
+    patient = session_cookie(conn, "patient", "patient")
+    caregiver = session_cookie(conn, "caregiver", "caregiver")
+    routes = [("/api/patient/due", patient), ("/patient_dashboard", patient), ("/show_all", caregiver)]
+    i = 0
+    while not stop.is_set():
+        path, cookie = routes[i % len(routes)]
+        i += 1
+        start = time.perf_counter()
+        try:
+            conn.request("GET", path, headers={"Cookie": cookie})
+            response = conn.getresponse()
+            response.read()
+            ok = response.status == 200
+        except OSError:
+            ok = False
+            conn.close()
+            conn = http.client.HTTPConnection("127.0.0.1", PORT, timeout=10)
+        with lock:
+            results[phase[0]][0].append(time.perf_counter() - start)
+            if not ok:
+                results[phase[0]][1] += 1
+
+
+def post(conn, path, form, cookie=None):
+    headers = {"Content-Type": "application/x-www-form-urlencoded"}
+    if cookie:
+        headers["Cookie"] = cookie
+    conn.request("POST", path, urllib.parse.urlencode(form), headers)
+    response = conn.getresponse()
+    response.read()
+    return response
+
+
+def shows(conn, cookie, text, timeout=5):
+    """Polls /config until it shows text; returns how long that took, or None."""
+    start = time.perf_counter()
+    while time.perf_counter() - start < timeout:
+        conn.request("GET", "/config", headers={"Cookie": cookie})
+        response = conn.getresponse()
+        if text.encode() in response.read():
+            return time.perf_counter() - start
+        time.sleep(0.01)
+    return None
+
+
+def main():
+    workers = int(sys.argv[1]) if len(sys.argv) > 1 else 0
+    inflight_swap()
+
+    workdir = tempfile.mkdtemp()
+    with open(os.path.join(workdir, "credentials.py"), "w") as f:
+        f.write(PLACEHOLDER_CREDENTIALS)
+    shutil.copy(os.path.join(ROOT, "data.xlsx"), workdir)
+    server = start_server(workdir, workers)
+    results = {"baseline": [[], 0], "reloading": [[], 0]}
+    phase = ["baseline"]
+    stop, lock = threading.Event(), threading.Lock()
+    threads = [threading.Thread(target=load, args=(stop, phase, results, lock)) for _ in range(CLIENTS)]
+    try:
+        for thread in threads:
+            thread.start()
+        time.sleep(BASELINE)
+        phase[0] = "reloading"
+
+        conn = http.client.HTTPConnection("127.0.0.1", PORT, timeout=10)
+        caregiver = session_cookie(conn, "caregiver", "caregiver")
+        propagation, missing, saves = [], 0, 0
+        deadline = time.time() + RELOADING
+        while time.time() < deadline:
+            saves += 1
+            form = dict(FORM, twilio_number=f"+1555{saves:07d}", call_language=("English", "Chinese")[saves % 2],
+                        notificationapi1d=f"client{saves % 3}")
+            assert post(conn, "/save_config", form, caregiver).status == 302
+            took = shows(conn, caregiver, form["twilio_number"])
+            missing += took is None
+            propagation.append(took or 0)
+            time.sleep(0.2)
+
+        # An operator editing config.json by hand (well, atomically) instead of using the page.
+        store = ConfigStore(os.path.join(workdir, "config.json"))
+        store.save(from_dict({**asdict(store.refresh()), "twilio_number": "+19999999999"}))
+        took = shows(conn, caregiver, "+19999999999")
+        print(f"config.json rewritten outside the app: visible after {took * 1000:.1f} ms" if took is not None
+              else "config.json rewritten outside the app: NOT picked up")
+        missing += took is None
+
+        assert post(conn, "/save_config", dict(FORM, password="rotated"), caregiver).status == 302
+        old_login = post(conn, "/login_attempt", {"username": "caregiver", "password": "caregiver"})
+        new_login = post(conn, "/login_attempt", {"username": "caregiver", "password": "rotated"})
+        password_applied = "/index" in (new_login.getheader("Location") or "") and \
+            "/login" in (old_login.getheader("Location") or "")
+        print(f"password change: old password rejected and new one accepted at once: {password_applied}")
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+        server.terminate()
+        server.wait(10)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    label = "dev server" if workers == 0 else f"gunicorn {workers} worker(s)"
+    print(f"{label}, {CLIENTS} clients")
+    for name, seconds in (("baseline", BASELINE), ("during saves", RELOADING)):
+        samples, errors = results["baseline" if name == "baseline" else "reloading"]
+        s = summarize(samples)
+        print(f"  {name:<14} {len(samples) / seconds:8.1f} req/s  p50={s['p50_ms']:7.2f}ms  "
+              f"p99={s['p99_ms']:7.2f}ms  dropped={errors}")
+    s = summarize(propagation)
+    print(f"  {saves} saves through /save_config, new value on /config after p50={s['p50_ms']:.1f}ms "
+          f"max={max(propagation) * 1000:.1f}ms, never shown: {missing}")
+    dropped = results["baseline"][1] + results["reloading"][1]
+    assert dropped == 0 and missing == 0 and password_applied, (dropped, missing, password_applied)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+"""/dispense latency with slow providers: the inline provider round-trip vs. the queued dispatcher.
+
+Fails unless the queued /dispense p99 stays under a tenth of the provider latency, i.e. the
+request never waits on a provider, and unless the queued notification is still delivered.
+
+Usage: python benchmarks/bench_dispense_latency.py [provider_latency_seconds]
+"""
+import contextlib
+import io
+import sys
+import tempfile
+import time
+
+from common import import_app, login, measure, report, summarize
+from stubs import StubCallProvider, StubSmsProvider
+
+
+def main():
+    latency = float(sys.argv[1]) if len(sys.argv) > 1 else 0.5
+    app = import_app(tempfile.mkdtemp())
+    call_provider = StubCallProvider(latency)
+    sms_provider = StubSmsProvider(latency)
+    app.dispatcher.providers = {"call": call_provider, "sms": sms_provider}
+    app.dispatcher.retries = 0
+
+    settings = app.config_store.current()
+    client = login(app.app.test_client(), settings.login_username, settings.login_password)
+    timing = app.patients.first().store.times()[0]
+
+    def inline_round_trip():
+        # What /dispense used to block on: call, SMS, then a fixed two-second sleep.
+        call_provider.call(settings.recipient_number, app.medication_twiml(settings.call_language))
+        time.sleep(latency + 2)
+
+    print(f"provider latency {latency * 1000:.0f}ms")
+    report("inline providers (previous /dispense)", measure(inline_round_trip, 3))
+    with contextlib.redirect_stdout(io.StringIO()):
+        samples = measure(lambda: client.post("/dispense", data={"timing": timing}), 50)
+    report("POST /dispense (queued)", samples)
+    p99 = summarize(samples)["p99_ms"] / 1000
+    assert p99 < latency / 10, f"/dispense p99 {p99 * 1000:.1f}ms is not well below the {latency * 1000:.0f}ms provider latency"
+
+    # The 50 posts are for one slot, so the gate lets one call through after the 3 inline ones.
+    deadline = time.time() + 30
+    while len(call_provider.calls) < 4 and time.time() < deadline:
+        time.sleep(0.05)
+    print(f"delivered: {len(call_provider.calls)} calls, {len(sms_provider.sent)} sms")
+    assert len(call_provider.calls) >= 4, "the queued call was never delivered"
+    app.dispatcher.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+"""Latency and throughput of a 10-container dose over the serial link, one-at-a-time vs. pipelined.
+
+Then checks that a full window queued behind a slow motor doesn't time out: with a 0.5 s reply
+timeout and 0.3 s per container, all ten containers must be acked. Last, a port that can't be
+opened (here a ValueError, as from a bad port setting) must fail the command rather than hang
+it, and the link must work once the port opens.
+
+Usage: python benchmarks/bench_dispenser.py [dispense_time_seconds] [link_latency_seconds]
+"""
+import sys
+
+from common import measure, report
+from fake_arduino import FakeArduino
+
+from dispenser import DispenserError, DispenserLink, open_serial
+
+DOSE = [(container, 1) for container in range(1, 11)]
+
+
+def main():
+    dispense_time = float(sys.argv[1]) if len(sys.argv) > 1 else 0.0
+    link_latency = float(sys.argv[2]) if len(sys.argv) > 2 else 0.004
+    print(f"fake firmware: {dispense_time * 1000:.1f}ms per container, {link_latency * 1000:.1f}ms link latency")
+
+    for window in (1, 10):
+        arduino = FakeArduino(dispense_time, link_latency)
+        link = DispenserLink(arduino.port, window=window)
+        link.dispense([(1, 1)])[0].result(5)
+
+        def dose():
+            for future in link.dispense(DOSE):
+                future.result(10)
+
+        samples = measure(dose, 50)
+        report(f"10-container dose, window={window}", samples)
+        print(f"{'':<40} {len(DOSE) * len(samples) / sum(samples):.0f} commands/s")
+        link.close()
+        arduino.close()
+
+    arduino = FakeArduino(dispense_time=0.3)
+    link = DispenserLink(arduino.port, timeout=0.5, window=8)
+    failed = [future.exception(10) for future in link.dispense(DOSE)]
+    link.close()
+    arduino.close()
+    print(f"slow motor (0.3s per container, 0.5s timeout, window=8): {sum(map(bool, failed))} of {len(DOSE)} failed")
+    assert not any(failed), failed
+
+    arduino = FakeArduino()
+    opened = []
+
+    def flaky_port():
+        opened.append(True)
+        if len(opened) == 1:
+            raise ValueError("bad baud rate")
+        return open_serial(arduino.port, 115200)
+
+    link = DispenserLink(arduino.port, serial_factory=flaky_port)
+    error = link.submit(1, 1).exception(5)
+    assert isinstance(error, DispenserError), error
+    assert link.submit(1, 1).result(5), "the link did not recover after the port failed to open"
+    link.close()
+    arduino.close()
+    print("a port that fails to open fails the command, and the link recovers")
+
+
+if __name__ == "__main__":
+    main()
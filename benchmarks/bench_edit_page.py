@@ -0,0 +1,72 @@
+"""Edit-page lookups and writes: scanning the schedule on every request vs. the indexes kept by ScheduleStore.
+
+"scan" is what the handlers used to do per request: a pass over every record for the names,
+another for the used containers, and one more to find a medication by name; for an edit or a
+delete, a copy of the whole schedule and a search for the record's position. The indexed
+versions are what edit_data, confirm_edit, confirm_delete, do_edit_med and delete_med use now.
+The schedule is held in storage.MemoryBackend, so the writes time the store, not a disk.
+
+Usage: python benchmarks/bench_edit_page.py [rows ...]
+"""
+import itertools
+import sys
+
+from common import measure, report
+
+from bench_tick import make_records
+from schedule_store import ScheduleStore
+from storage import MemoryBackend
+
+CONTAINERS = 10
+WRITES = 200
+
+
+def scan_edit_page(records):
+    names = [record.name for record in records]
+    used = {int(c) for c in (record.container for record in records if record.container) if str(c).isdigit()}
+    return names, sorted(set(range(1, CONTAINERS + 1)) - used)
+
+
+def scan_find(records, name):
+    for record in records:
+        if record.name == name:
+            return record
+    return None
+
+
+def scan_replace(records, old, new):
+    records = list(records)
+    records[next(i for i, record in enumerate(records) if record is old)] = new
+    return tuple(records)
+
+
+def main():
+    sizes = [int(n) for n in sys.argv[1:]] or [100, 10000, 100000]
+    for rows in sizes:
+        records = make_records(rows)
+        store = ScheduleStore(MemoryBackend(records))
+        store.records()
+        # Look up names from the whole schedule, so the scan pays its average cost.
+        names = itertools.cycle([records[i].name for i in range(0, rows, max(1, rows // 97))])
+        print(f"--- {rows} rows ---")
+        report("scan: names + free containers", measure(lambda: scan_edit_page(records), 50))
+        report("index: names + free containers",
+               measure(lambda: (store.names(), store.free_containers(CONTAINERS)), 1000))
+        report("scan: find by name", measure(lambda: scan_find(records, next(names)), 200))
+        report("index: find by name", measure(lambda: store.find(next(names)), 1000))
+
+        snapshot = store.records()
+        report("scan: copy + position for an edit",
+               measure(lambda: scan_replace(snapshot, snapshot[-1], snapshot[-1]), 20))
+        # Each write touches a different med, spread over the schedule like the lookups above.
+        targets = iter([records[i].name for i in range(0, rows, max(1, rows // WRITES))][:WRITES])
+        report("index: do_edit_med (store.update)",
+               measure(lambda: store.update(next(targets), amount="2", container="3"), min(WRITES, rows)))
+        targets = iter([records[i].name for i in range(0, rows, max(1, rows // WRITES))][:WRITES])
+        report("index: delete_med (store.delete)", measure(lambda: store.delete(next(targets)), min(WRITES, rows)))
+        deleted = min(WRITES, rows)
+        assert len(store.names()) == rows - deleted and len(store.records()) == rows - deleted
+
+
+if __name__ == "__main__":
+    main()
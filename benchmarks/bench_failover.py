@@ -0,0 +1,211 @@
+"""Two worker processes sharing one scratch directory: the leader's work, seen from the other one.
+
+Worker A is started first and takes the scheduler lock; worker B starts once A is up and stays a
+standby. Both run app.py on the threaded Werkzeug server, as bench_workers.py's dev server does,
+with a config.json pointing them at a FakeArduino and the fake providers in this process and
+escalation steps of ESCALATION_MINUTES. A caregiver /events stream is held open on B throughout.
+
+  dispense   POST /dispense on B: the leader dispenses it and "dispensed" reaches B's stream
+  dose_due   a med added through B for the next minute: the leader rearms, fires it, and
+             "dose_due" reaches B's stream
+  failover   A is killed (SIGKILL) once that dose's notifications are out: B is elected, resumes
+             the dose's escalation chain (reminder SMS, call, caregiver SMS, "dose_missed") and
+             dispenses the next /dispense itself
+
+Usage: python benchmarks/bench_failover.py
+"""
+import http.client
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+from dataclasses import asdict, replace
+from datetime import datetime, timedelta
+
+from bench_workers import session_cookie
+from common import PLACEHOLDER_CREDENTIALS, ROOT
+from fake_arduino import FakeArduino
+from fake_providers import FakeNotificationApi, FakeTwilio
+from harness import SETTINGS
+
+PORTS = {"A": 5101, "B": 5102}
+# Reminder, call, caregiver: seconds rather than minutes apart, so the chain runs within the bench.
+ESCALATION_MINUTES = (0.25, 0.5, 0.75)
+ELECTION_INTERVAL = 5.0
+
+
+def start_worker(workdir, port):
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([ROOT, workdir]))
+    command = [sys.executable, "-c", f"import app; app.create_app().run(port={port}, threaded=True)"]
+    worker = subprocess.Popen(command, cwd=workdir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=1)
+            conn.request("GET", "/landing_page")
+            conn.getresponse().read()
+            return worker
+        except OSError:
+            time.sleep(0.2)
+    worker.kill()
+    raise RuntimeError(f"worker on port {port} did not start")
+
+
+def post(port, path, cookie, form):
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=10)
+    conn.request("POST", path, urllib.parse.urlencode(form),
+                 {"Content-Type": "application/x-www-form-urlencoded", "Cookie": cookie})
+    response = conn.getresponse()
+    response.read()
+    conn.close()
+    return response.status
+
+
+class Stream:
+    """An /events stream read on a thread; events keeps (arrival time, kind, data) in order."""
+
+    def __init__(self, port, cookie):
+        self.events = []
+        self._cond = threading.Condition()
+        self._sock = socket.create_connection(("127.0.0.1", port), timeout=None)
+        self._sock.sendall(f"GET /events HTTP/1.1\r\nHost: localhost\r\nCookie: {cookie}\r\n\r\n".encode())
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def _run(self):
+        buffer = b""
+        while True:
+            try:
+                chunk = self._sock.recv(65536)
+            except OSError:
+                return
+            if not chunk:
+                return
+            buffer += chunk
+            *blocks, buffer = buffer.split(b"\n\n")
+            for block in blocks:
+                fields = dict(line.split(": ", 1) for line in block.decode().splitlines() if ": " in line)
+                if "event" in fields:
+                    with self._cond:
+                        self.events.append((time.time(), fields["event"], json.loads(fields["data"])))
+                        self._cond.notify_all()
+
+    def wait_for(self, kind, match, timeout):
+        """Returns the arrival time of the first kind event whose data satisfies match, or None."""
+        deadline = time.time() + timeout
+        with self._cond:
+            while True:
+                for arrived, event_kind, data in self.events:
+                    if event_kind == kind and match(data):
+                        return arrived
+                if not self._cond.wait(max(0.0, deadline - time.time())) and time.time() >= deadline:
+                    return None
+
+    def close(self):
+        self._sock.close()
+
+
+def settle(count, expected, timeout):
+    """Waits until count() reaches expected; returns whether it did."""
+    deadline = time.time() + timeout
+    while count() < expected:
+        if time.time() >= deadline:
+            return False
+        time.sleep(0.1)
+    return True
+
+
+def main():
+    arduino = FakeArduino()
+    twilio = FakeTwilio()
+    notificationapi = FakeNotificationApi()
+    workdir = tempfile.mkdtemp()
+    with open(os.path.join(workdir, "credentials.py"), "w") as f:
+        f.write(PLACEHOLDER_CREDENTIALS)
+    shutil.copy(os.path.join(ROOT, "data.xlsx"), workdir)
+    settings = replace(SETTINGS, twilio_api_url=twilio.url, notificationapi_url=notificationapi.url,
+                       arduino_port=arduino.port, escalation_minutes=ESCALATION_MINUTES)
+    with open(os.path.join(workdir, "config.json"), "w") as f:
+        json.dump(asdict(settings), f, indent=2)
+
+    workers = {}
+    stream = None
+    try:
+        workers["A"] = start_worker(workdir, PORTS["A"])
+        workers["B"] = start_worker(workdir, PORTS["B"])
+        conn = http.client.HTTPConnection("127.0.0.1", PORTS["B"], timeout=10)
+        caregiver = session_cookie(conn, "caregiver", "caregiver")
+        conn.close()
+        stream = Stream(PORTS["B"], caregiver)
+        time.sleep(1)
+
+        # /dispense on the standby: only the leader has the port open.
+        sent = time.time()
+        assert post(PORTS["B"], "/dispense", caregiver, {"timing": "08:00"}) == 302
+        arrived = stream.wait_for("dispensed", lambda data: data["time"] == "08:00", 10)
+        assert arrived is not None, "the leader's \"dispensed\" did not reach the other worker's stream"
+        assert sorted(arduino.dispensed) == [(2, 1), (3, 1)], arduino.dispensed
+        print(f"dispense   /dispense 08:00 on B: dispensed {arduino.dispensed} by A, "
+              f"\"dispensed\" on B's stream {(arrived - sent) * 1000:.0f}ms after the POST")
+
+        # A med added through the standby, due at the next minute with some room to spare.
+        slot = (datetime.now() + timedelta(minutes=1)).replace(second=0, microsecond=0)
+        if slot - datetime.now() < timedelta(seconds=10):
+            slot += timedelta(minutes=1)
+        hhmm = slot.strftime("%H:%M")
+        assert post(PORTS["B"], "/do_add_med", caregiver,
+                    {"med_time": hhmm, "med_name": "Failover", "med_amount": "1", "container": "4"}) == 302
+        arrived = stream.wait_for("dose_due", lambda data: data["time"] == hhmm, 90)
+        assert arrived is not None, f"the {hhmm} dose added through B did not fire"
+        dose = next(data["dose"] for _, kind, data in stream.events if kind == "dose_due" and data["time"] == hhmm)
+        assert settle(lambda: len(arduino.dispensed), 3, 10), "A did not dispense the new dose"
+        # The call and SMS for /dispense, then the ones for this dose, all from A.
+        assert settle(lambda: twilio.stats["accepted"], 2, 10) and settle(lambda: notificationapi.stats["accepted"], 2, 10)
+        print(f"dose_due   {hhmm} added on B: fired by A, \"dose_due\" on B's stream "
+              f"{(arrived - slot.timestamp()) * 1000:.0f}ms after {hhmm}:00, dispensed {arduino.dispensed[-1]}")
+
+        # The leader dies before the dose's first escalation step.
+        killed = time.time()
+        workers["A"].kill()
+        workers["A"].wait()
+        steps = [minutes * 60 for minutes in ESCALATION_MINUTES]
+        arrived = stream.wait_for("dose_missed", lambda data: data["dose"] == dose,
+                                  slot.timestamp() + steps[-1] + ELECTION_INTERVAL + 10 - time.time())
+        assert arrived is not None, "B did not resume the escalation chain"
+        assert settle(lambda: twilio.stats["accepted"], 3, 5), "B did not make the escalation call"
+        assert settle(lambda: notificationapi.stats["accepted"], 4, 5), "B did not send the reminder and caregiver SMS"
+        print(f"failover   A killed {killed - slot.timestamp():.1f}s after {hhmm}: B resumed the chain, "
+              f"reminder + caregiver SMS and the call sent, \"dose_missed\" {arrived - slot.timestamp():.1f}s "
+              f"after {hhmm} (last step due at {steps[-1]:.0f}s)")
+
+        assert post(PORTS["B"], "/dispense", caregiver, {"timing": "10:00"}) == 302
+        assert settle(lambda: len(arduino.dispensed), 4, 10), "B did not dispense after taking over"
+        assert arduino.dispensed[-1] == (1, 2), arduino.dispensed
+        print(f"failover   /dispense 10:00 on B after the failover: dispensed {arduino.dispensed[-1]} by B")
+        time.sleep(1)
+        assert twilio.stats["injected_errors"] == notificationapi.stats["injected_errors"] == 0
+        assert twilio.stats["accepted"] == 4 and notificationapi.stats["accepted"] == 5, \
+            (twilio.stats, notificationapi.stats)
+    finally:
+        if stream is not None:
+            stream.close()
+        for worker in workers.values():
+            worker.terminate()
+            try:
+                worker.wait(10)
+            except subprocess.TimeoutExpired:
+                worker.kill()
+                worker.wait()
+        arduino.close()
+        twilio.close()
+        notificationapi.close()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+"""Bytes on the wire and latency per page: before vs. compression, conditional GETs and cached assets.
+
+Runs in-process against a scratch copy of the app with a synthetic schedule (100 rows per page).
+For each page:
+
+  before       no Accept-Encoding, no If-None-Match, plus the base.html CSS/JS that every page used
+               to inline (now fetched once per deploy from /static under a content-hashed name)
+  gzip / br    a first visit from a browser that accepts the encoding (br needs the brotli package)
+  revisit 304  the browser revalidating with the ETag it got: no render, no body
+
+Bytes are response body bytes; headers are about the same in every case.
+
+Usage: python benchmarks/bench_http_cache.py [rows] [repeat]   (default 1000 rows, 200 requests each)
+"""
+import gzip
+import re
+import sys
+import tempfile
+
+from common import import_app, login, measure, summarize
+
+import assets
+
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    app = import_app(tempfile.mkdtemp(), rows=rows)
+    settings = app.config_store.current()
+    encodings = ["gzip"] + (["br"] if assets.brotli is not None else [])
+
+    caregiver = login(app.app.test_client(), settings.login_username, settings.login_password)
+    patient = login(app.app.test_client(), settings.patient_username, settings.patient_password)
+    pages = [("/show_all", caregiver), ("/edit", caregiver), ("/patient_dashboard", patient)]
+    for path, client in pages:
+        client.get(path)  # shows (and so clears) the login flash, which turns page ETags off
+
+    page = caregiver.get("/show_all", headers={"Accept-Encoding": "gzip"})
+    html = gzip.decompress(page.data)
+    static = re.findall(rb'(?:href|src)="(/static/[^"]+)"', html)
+    inline = sum(len(caregiver.get(url.decode()).data) for url in static)
+
+    print(f"{rows} rows; the shared CSS/JS is {inline} bytes, previously inlined into every page")
+    print(f"{'route':<34} {'scenario':<14} {'bytes':>8} {'p50 ms':>9} {'p99 ms':>9}")
+
+    def row(path, scenario, client, headers, extra=0, expect=200):
+        response = client.get(path, headers=headers)
+        assert response.status_code == expect, (path, scenario, response.status_code)
+        s = summarize(measure(lambda: client.get(path, headers=headers), repeat))
+        print(f"{path:<34} {scenario:<14} {len(response.data) + extra:>8} {s['p50_ms']:>9.3f} {s['p99_ms']:>9.3f}")
+        return response
+
+    for path, client in pages:
+        identity = row(path, "before", client, {}, extra=inline)
+        etag = identity.headers.get("ETag")
+        assert etag, f"{path} has no ETag"
+        for encoding in encodings:
+            row(path, encoding, client, {"Accept-Encoding": encoding})
+        row(path, "revisit 304", client, {"If-None-Match": etag, "Accept-Encoding": encodings[-1]}, expect=304)
+
+    for url in static:
+        url = url.decode()
+        for encoding in encodings:
+            response = row(url, encoding, caregiver, {"Accept-Encoding": encoding})
+        print(f"{'':<34} cached for a year ({response.headers['Cache-Control']}); later pages don't fetch it")
+
+    # A schedule change has to show up on the next revalidation rather than a stale 304.
+    etag = caregiver.get("/show_all").headers["ETag"]
+    app.patients.first().store.add("09:00", "BenchNewMed", "1", "1")
+    changed = caregiver.get("/show_all", headers={"If-None-Match": etag})
+    assert changed.status_code == 200 and changed.headers["ETag"] != etag
+    print("after a schedule change the old ETag gets a fresh 200, as it should")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+"""Container stock: atomic decrements and the refill forecast at 10k containers.
+
+Builds in-memory schedules for N patients with 12 meds each over 10 containers (N x 10 tracked
+containers in a scratch inventory.db), then times Forecaster.forecast() over all of them:
+
+  cold        the first forecast, which also boils every schedule down to pills a day
+  vectorized  later forecasts, one NumPy join over every container (needs numpy)
+  dict        the same with the pure-Python fallback used when NumPy is missing
+
+Both paths must give identical rows. Then 8 threads take pills from one container at once;
+no decrement may be lost, and each low container is claimed for an alert once a day.
+
+Usage: python benchmarks/bench_inventory.py [patients]   (default 1000, i.e. 10,000 containers)
+"""
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from datetime import date, timedelta
+
+from common import measure, report
+
+from inventory import Forecaster, Inventory, numpy
+from schedule_store import MedRecord, ScheduleStore
+from storage import MemoryBackend
+
+CONTAINERS = 10
+MEDS = 12
+TIMINGS = ["08:00", "12:00", "18:00", "22:00", "08:00 every 8h", "09:00 mon,wed,fri", "20:00 every 12h"]
+
+
+def build(inventory, patients, seed=0):
+    rng = random.Random(seed)
+    stores = {}
+    for i in range(patients):
+        patient_id = f"p{i}"
+        records = [MedRecord(rng.choice(TIMINGS), f"Med{j}", str(rng.randint(1, 2)), str(j % CONTAINERS + 1))
+                   for j in range(MEDS)]
+        stores[patient_id] = ScheduleStore(MemoryBackend(records))
+        for container in range(1, CONTAINERS + 1):
+            inventory.refill(patient_id, container, rng.randint(0, 120))
+    return stores
+
+
+def contend(inventory, threads=8, takes=500):
+    inventory.refill("shared", 1, threads * takes + 10)
+
+    def worker():
+        for _ in range(takes):
+            inventory.take("shared", 1, 1)
+
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    start = time.perf_counter()
+    for worker_thread in workers:
+        worker_thread.start()
+    for worker_thread in workers:
+        worker_thread.join()
+    elapsed = time.perf_counter() - start
+    left = inventory.take("shared", 1, 0)
+    print(f"{threads} threads x {takes} take(): {left} left of {threads * takes + 10} "
+          f"({threads * takes / elapsed:,.0f} takes/s)")
+    assert left == 10, "a concurrent decrement was lost"
+
+
+def alerts(inventory, forecast, today):
+    low = sorted((forecast.row(i)["patient"], forecast.row(i)["container"]) for i in forecast.low(7))
+    start = time.perf_counter()
+    claimed = inventory.claim_alerts(today, low)
+    print(f"claim_alerts() for {len(low):,} low containers: {(time.perf_counter() - start) * 1000:.1f}ms")
+    assert claimed == low
+    assert inventory.claim_alerts(today, low) == [], "a container was alerted twice in one day"
+    assert inventory.claim_alerts(today + timedelta(days=1), low[:1]) == low[:1]
+
+
+def main():
+    patients = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    inventory = Inventory(os.path.join(tempfile.mkdtemp(), "inventory.db"))
+    stores = build(inventory, patients)
+    levels = inventory.levels()
+    today = date.today()
+    print(f"{patients} patients, {len(levels):,} tracked containers, {patients * MEDS:,} meds")
+
+    vectorized, fallback = Forecaster(), Forecaster(vectorized=False)
+    start = time.perf_counter()
+    forecast = vectorized.forecast(levels, stores, today)
+    print(f"{'cold (schedules read)':<40} {(time.perf_counter() - start) * 1000:10.3f}ms")
+    fallback.forecast(levels, stores, today)
+    if numpy() is not None:
+        report("vectorized", measure(lambda: vectorized.forecast(levels, stores, today), 50))
+    else:
+        print("numpy is not installed; only the fallback runs")
+    report("dict", measure(lambda: fallback.forecast(levels, stores, today), 50))
+
+    expected = fallback.forecast(levels, stores, today)
+    assert [forecast.row(i) for i in range(len(forecast))] == [expected.row(i) for i in range(len(expected))]
+    low = forecast.low(7)
+    report(f"low(7 days): {len(low):,} containers", measure(lambda: forecast.low(7), 50))
+    print("both paths give the same rows")
+
+    alerts(inventory, forecast, today)
+    contend(inventory)
+
+
+if __name__ == "__main__":
+    main()
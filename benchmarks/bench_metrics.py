@@ -0,0 +1,70 @@
+"""Cost of the built-in instrumentation: raw Histogram.observe(), a request with and without
+the timing hooks, and rendering /metrics.
+
+Fails if the hooks add more than a tenth to a cheap request's p50 or /metrics takes more than
+MAX_METRICS_MS at p99 to render.
+
+Usage: python benchmarks/bench_metrics.py
+"""
+import tempfile
+import threading
+import time
+
+from common import import_app, login, measure, report, summarize
+
+from metrics import Histogram, Registry
+
+MAX_METRICS_MS = 25
+
+
+def observe_cost(threads, per_thread=200000):
+    histogram = Histogram("bench_seconds", "bench", ("endpoint",), registry=Registry())
+
+    def work():
+        for i in range(per_thread):
+            histogram.observe(i * 1e-6, "index")
+
+    workers = [threading.Thread(target=work) for _ in range(threads)]
+    start = time.perf_counter()
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    return (time.perf_counter() - start) / (threads * per_thread)
+
+
+def main():
+    for threads in (1, 4):
+        print(f"Histogram.observe, {threads} thread(s): {observe_cost(threads) * 1e9:8.0f} ns/call")
+
+    app = import_app(tempfile.mkdtemp())
+    settings = app.config_store.current()
+    client = login(app.app.test_client(), settings.patient_username, settings.patient_password)
+    request = lambda: client.get("/api/patient/due")
+    measure(request, 200)
+
+    before = app.app.before_request_funcs[None]
+    after = app.app.after_request_funcs[None]
+    rounds = {"instrumented": [], "hooks removed": []}
+    # Alternate the two setups so drift in the machine's speed hits both equally.
+    for _ in range(10):
+        rounds["instrumented"].extend(measure(request, 300))
+        before.remove(app.start_request_timer)
+        after.remove(app.record_request_duration)
+        rounds["hooks removed"].extend(measure(request, 300))
+        before.append(app.start_request_timer)
+        after.append(app.record_request_duration)
+    for label, samples in rounds.items():
+        report(f"GET /api/patient/due ({label})", samples)
+    baseline = summarize(rounds["hooks removed"])["p50_ms"]
+    overhead = summarize(rounds["instrumented"])["p50_ms"] - baseline
+    print(f"per-request overhead at p50: {overhead * 1000:.1f} us")
+    assert overhead < baseline / 10, f"the timing hooks add {overhead * 1000:.1f} us to a {baseline * 1000:.1f} us request"
+
+    samples = measure(lambda: client.get("/metrics"), 200)
+    report("GET /metrics", samples)
+    assert summarize(samples)["p99_ms"] < MAX_METRICS_MS, f"/metrics must render within {MAX_METRICS_MS}ms at p99"
+
+
+if __name__ == "__main__":
+    main()
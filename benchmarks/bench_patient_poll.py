@@ -0,0 +1,56 @@
+"""Cost of one patient dashboard poll: full page re-render vs. /api/patient/due (200 and 304).
+
+Fails unless both kinds of /api/patient/due poll are smaller and cheaper than re-rendering the page
+and the 304 has no body.
+
+Usage: python benchmarks/bench_patient_poll.py [rows]
+"""
+import sys
+import tempfile
+import time
+
+from common import import_app, login, measure, report, summarize
+
+
+def cpu(fn, repeat):
+    start = time.process_time()
+    for _ in range(repeat):
+        fn()
+    return (time.process_time() - start) / repeat * 1000
+
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    app = import_app(tempfile.mkdtemp(), rows)
+    settings = app.config_store.current()
+    client = login(app.app.test_client(), settings.patient_username, settings.patient_password)
+
+    page = client.get("/patient_dashboard")
+    due = client.get("/api/patient/due")
+    etag = due.headers["ETag"]
+    not_modified = client.get("/api/patient/due", headers={"If-None-Match": etag})
+    assert not_modified.status_code == 304
+
+    print(f"--- {rows} rows ---")
+    print(f"bytes: page={len(page.data)}  due={len(due.data)}  304={len(not_modified.data)}")
+    assert len(not_modified.data) == 0 < len(due.data) < len(page.data), "a poll must send less than the page"
+    polls = {
+        "GET /patient_dashboard": lambda: client.get("/patient_dashboard"),
+        "GET /api/patient/due": lambda: client.get("/api/patient/due"),
+        "GET /api/patient/due (304)": lambda: client.get("/api/patient/due", headers={"If-None-Match": etag}),
+    }
+    p50, cpu_ms = {}, {}
+    for label, fn in polls.items():
+        samples = measure(fn, 200)
+        report(label, samples)
+        p50[label] = summarize(samples)["p50_ms"]
+        cpu_ms[label] = cpu(fn, 200)
+        print(f"{'':<40} cpu/poll={cpu_ms[label]:.3f}ms")
+    page_label, *poll_labels = polls
+    for costs in (p50, cpu_ms):
+        for label in poll_labels:
+            assert costs[label] < costs[page_label], f"{label} must cost less than re-rendering the page"
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+"""Scheduler tick and notification fan-out across many patients.
+
+Each patient gets their own synthetic schedule and every tick goes through PatientRegistry.due_at
+and the real dispense_medication_job, with stub providers and a stub dispenser, so the numbers
+are the server's own cost. Memory is the tracemalloc peak while building the registry.
+
+Usage: python benchmarks/bench_patients.py [patients ...]
+"""
+import contextlib
+import io
+import itertools
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import Future
+from datetime import datetime
+
+from common import import_app, measure, report
+from stubs import StubCallProvider, StubSmsProvider
+
+ROWS_PER_PATIENT = 12
+ROUNDS = ["08:00", "12:00", "18:00", "22:00"]
+
+
+class StubDispenser:
+    def __init__(self):
+        self.commands = 0
+
+    def submit(self, container, quantity):
+        self.commands += 1
+        future = Future()
+        future.set_result(True)
+        return future
+
+    def close(self):
+        pass
+
+
+def write_schedule(path, seed):
+    """Most doses land on the home's medication rounds; the rest are spread over the day."""
+    import openpyxl
+
+    rng = random.Random(seed)
+    wb = openpyxl.Workbook()
+    sheet = wb.active
+    sheet.append(["Timing", "Name", "Quantity", "Container"])
+    for i in range(ROWS_PER_PATIENT):
+        timing = rng.choice(ROUNDS) if i % 3 else f"{rng.randrange(24):02d}:{rng.randrange(60):02d}"
+        sheet.append([timing, f"Med{i}", str(rng.randint(1, 3)), str(i % 10 + 1)])
+    wb.save(path)
+
+
+def write_patients(count):
+    os.makedirs("schedules", exist_ok=True)
+    entries = []
+    for i in range(count):
+        patient_id = f"p{i:04d}"
+        write_schedule(f"schedules/{patient_id}.xlsx", seed=i)
+        entries.append({
+            "id": patient_id,
+            "name": f"Patient {i}",
+            "recipient_number": f"+1555{i:07d}",
+            "care_number": f"+1666{i:07d}",
+            "arduino_port": f"/dev/bench{i}",
+            "username": patient_id,
+            "password": "patient",
+        })
+    with open("patients.json", "w") as f:
+        json.dump(entries, f)
+
+
+def main():
+    sizes = [int(n) for n in sys.argv[1:]] or [10, 100, 1000]
+    app = import_app(tempfile.mkdtemp())
+    from notifier import Dispatcher
+    from patients import PatientRegistry, load_patients
+
+    call_provider = StubCallProvider()
+    sms_provider = StubSmsProvider()
+    app.dispatcher = Dispatcher(call_provider, sms_provider, maxsize=1_000_000)
+    dispenser = StubDispenser()
+
+    for count in sizes:
+        os.chdir(tempfile.mkdtemp())
+        write_patients(count)
+        print(f"--- {count} patients x {ROWS_PER_PATIENT} meds ---")
+
+        def load():
+            return PatientRegistry(load_patients("patients.json", None), "xlsx", "meds.db", lambda port: dispenser)
+
+        start = time.perf_counter()
+        registry = load()
+        elapsed = time.perf_counter() - start
+        tracemalloc.start()
+        retained = load()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        del retained
+        print(f"registry load: {elapsed * 1000:.1f}ms, "
+              f"memory retained {current / 1024 / 1024:.1f} MiB (peak {peak / 1024 / 1024:.1f} MiB)")
+
+        app.patients = registry
+        slots = list(registry.times())
+        busiest = max(slots, key=lambda hhmm: len(registry.due_at(hhmm)))
+        print(f"{len(slots)} distinct slots, busiest {busiest} with {len(registry.due_at(busiest))} patients")
+
+        idle = [f"{m // 60:02d}:{m % 60:02d}" for m in range(1440)]
+        idle = [hhmm for hhmm in idle if hhmm not in set(slots)] or ["--:--"]
+        it = itertools.cycle(idle)
+        report("due_at (nothing due)", measure(lambda: registry.due_at(next(it)), 1000))
+
+        it = itertools.cycle(slots)
+        report("due_at (scheduled slot)", measure(lambda: registry.due_at(next(it)), 1000))
+
+        hour, minute = busiest.split(":")
+        slot = datetime(2026, 1, 1, int(hour), int(minute))
+        with contextlib.redirect_stdout(io.StringIO()):
+            samples = measure(lambda: app.dispense_medication_job(slot), 20)
+        report("tick at busiest slot (dispense + fan-out)", samples)
+
+        time.sleep(0.5)
+        print(f"dispenser commands: {dispenser.commands}, calls delivered: {len(call_provider.calls)}")
+    app.dispatcher.stop()
+
+
+if __name__ == "__main__":
+    main()
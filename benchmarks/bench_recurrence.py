@@ -0,0 +1,100 @@
+"""Recurring schedules: one-minute due queries over thousands of rules, plus a correctness check.
+
+First a few hundred random rules (intervals, weekday sets, courses, start dates) are checked
+against brute force: every minute of a three-week span is tested with Rule.occurs_at, and
+the result must match Rule.occurrences, TimeIndex.between and TimeIndex.at. Then a
+TimeIndex over N recurring medications answers "what is due this minute" and "what is due in
+the next 24 hours", compared with asking every rule in turn.
+
+Usage: python benchmarks/bench_recurrence.py [meds]   (default 10000)
+"""
+import random
+import sys
+from datetime import date, datetime, timedelta
+from itertools import takewhile
+
+from common import measure, report
+
+from recurrence import WEEKDAYS, parse_rule
+from schedule_store import MedRecord, TimeIndex
+
+
+def random_rule(rng):
+    parts = [f"{rng.randrange(24):02d}:{rng.randrange(60):02d}"]
+    start = date(2026, 1, 1) + timedelta(days=rng.randrange(10))
+    every = rng.choice([None, None, 4, 6, 8, 12, 5, 7, 36])
+    if every:
+        parts.append(f"every {every}h")
+    if rng.random() < 0.4:
+        parts.append(",".join(sorted(rng.sample(WEEKDAYS, rng.randint(1, 6)), key=WEEKDAYS.index)))
+    if rng.random() < 0.5 or (every and 1440 % (every * 60)):
+        parts.append(f"from {start.isoformat()}")
+        if rng.random() < 0.5:
+            parts.append(f"for {rng.randint(1, 14)}d")
+    elif rng.random() < 0.3:
+        parts.append(f"until {(start + timedelta(days=rng.randrange(14))).isoformat()}")
+    return " ".join(parts)
+
+
+def check(rng, rules=300):
+    begin, end = datetime(2026, 1, 1), datetime(2026, 1, 22)
+    records = [MedRecord(random_rule(rng), f"Med{i}", "1", "1") for i in range(rules)]
+    index = TimeIndex(records)
+    minutes = [begin + timedelta(minutes=m) for m in range(int((end - begin).total_seconds() // 60) + 1)]
+    expected = []
+    for record in records:
+        rule = parse_rule(record.time)
+        assert rule is not None and parse_rule(rule.text).text == rule.text, record.time
+        brute = [when for when in minutes if rule.occurs_at(when)]
+        lazy = list(takewhile(lambda when: when <= end, rule.occurrences(begin)))
+        assert brute == lazy, (record.time, brute[:5], lazy[:5])
+        if rule.start:
+            assert rule.per_day(rule.start - timedelta(days=1)) == 0 < rule.per_day(rule.start), record.time
+        expected.extend((when, record.name) for when in brute)
+    merged = [(when, record.name) for when, record in index.between(begin, end)]
+    assert [when for when, _ in merged] == sorted(when for when, _ in merged)
+    assert sorted(expected) == sorted(merged)
+
+    by_minute = {}
+    for when, name in expected:
+        by_minute.setdefault(when, set()).add(name)
+    for when in rng.sample(minutes, 2000):
+        names = {record.name for record in index.at(when.strftime("%H:%M"), when.date())}
+        assert names == by_minute.get(when, set()), when
+        window = {record.name for _, record in index.between(when, when + timedelta(minutes=5))}
+        assert window == {name for w, name in expected if when <= w <= when + timedelta(minutes=5)}, when
+    print(f"checked {rules} random rules minute by minute over 3 weeks: {len(expected)} doses, all match")
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    rng = random.Random(0)
+    check(rng)
+
+    records = [MedRecord(random_rule(rng), f"Med{i}", "1", str(i % 10 + 1)) for i in range(count)]
+    index = report_build(records)
+    rules = [(parse_rule(record.time), record) for record in records]
+    now = datetime(2026, 1, 7, 8, 0)
+    ticks = iter([now + timedelta(minutes=m) for m in range(100000)])
+
+    print(f"--- {count} recurring medications ---")
+    report("index: due this minute (at)", measure(lambda: index.at(*split(next(ticks))), 500))
+    report("index: due in the next minute (between)",
+           measure(lambda: list(index.between(now, now + timedelta(minutes=1))), 500))
+    report("index: due in the next 24 hours", measure(lambda: list(index.between(now, now + timedelta(days=1))), 5))
+    report("every rule: due this minute (occurs_at)",
+           measure(lambda: [record for rule, record in rules if rule.occurs_at(now)], 20))
+
+
+def split(when):
+    return when.strftime("%H:%M"), when.date()
+
+
+def report_build(records):
+    holder = []
+    report(f"build TimeIndex ({len(records)} rules)", measure(lambda: holder.append(TimeIndex(records)), 1))
+    return holder[0]
+
+
+if __name__ == "__main__":
+    main()
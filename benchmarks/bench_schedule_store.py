@@ -0,0 +1,39 @@
+"""Per-request schedule read: reload-every-time workbook parse vs. the cached ScheduleStore.
+
+Usage: python benchmarks/bench_schedule_store.py [rows ...]
+"""
+import os
+import sys
+import tempfile
+
+from common import make_workbook, measure, report
+
+import openpyxl
+
+from schedule_store import ScheduleStore
+from storage import XlsxBackend
+
+
+def reload_every_time(path):
+    wb = openpyxl.load_workbook(path)
+    sheet = wb.active
+    return [row[:4] for row in sheet.iter_rows(min_row=2, values_only=True) if row[1]]
+
+
+def main():
+    sizes = [int(n) for n in sys.argv[1:]] or [10, 1000, 100000]
+    with tempfile.TemporaryDirectory() as tmp:
+        for rows in sizes:
+            path = make_workbook(os.path.join(tmp, f"data_{rows}.xlsx"), rows)
+            repeat = 3 if rows >= 100000 else 20
+            print(f"--- {rows} rows ---")
+            report("load_workbook per request", measure(lambda: reload_every_time(path), repeat))
+
+            store = ScheduleStore(XlsxBackend(path))
+            report("ScheduleStore cold load", measure(lambda: ScheduleStore(XlsxBackend(path)).records(), repeat))
+            store.records()
+            report("ScheduleStore warm read", measure(lambda: [r.as_row() for r in store.records()], 200))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+"""DoseScheduler on a fake clock: when run_pending() fires, misses and skips, then what it costs.
+
+The checks drive run_pending() and next_fire() through the cases the scheduler exists for:
+a wake that comes late but within catch_up fires what it overslept, one beyond catch_up hands
+the slot to on_missed instead, two wakes in the same minute fire a slot once, and the slots
+either side of midnight fire on the right days. A real scheduler then has to rearm within a
+second when another process adds a slot and bumps DispenseQueue's schedule version. Then a day
+of wakes over a schedule with a slot in every minute is timed.
+
+Usage: python benchmarks/bench_scheduler.py
+"""
+import multiprocessing
+import os
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from common import measure, report
+
+from dispenser import DispenseQueue
+from dose_scheduler import DoseScheduler
+from schedule_store import ScheduleStore
+from storage import SqliteBackend
+
+TIMES = ["00:00", "08:00", "08:30", "23:59"]
+DAY = datetime(2026, 3, 1)
+
+
+class FakeClock:
+    def __init__(self, now):
+        self.current = now
+
+    def now(self):
+        return self.current
+
+
+def at(hhmm, days=0):
+    hour, minute = map(int, hhmm.split(":"))
+    return DAY + timedelta(days=days, hours=hour, minutes=minute)
+
+
+def scheduler(times=TIMES, start=None):
+    """A scheduler whose fired and missed slots are collected, already run once at `start`."""
+    fired, missed = [], []
+    clock = FakeClock(start or at("07:59"))
+    dose = DoseScheduler(lambda: times, fired.append, clock=clock, on_missed=missed.append, record_metrics=False)
+    assert dose.run_pending() == [] and dose.last_run == clock.current, "the first run only sets the position"
+    return dose, clock, fired, missed
+
+
+def check():
+    # Woken 20 minutes late: within catch_up (30 minutes), so the 08:00 dose still fires.
+    dose, clock, fired, missed = scheduler()
+    clock.current = at("08:20")
+    assert dose.run_pending() == [at("08:00")] and fired == [at("08:00")] and missed == []
+
+    # Woken 40 minutes after 08:30: too late, so it goes to on_missed and doesn't fire.
+    clock.current = at("09:10")
+    assert dose.run_pending() == [] and missed == [at("08:30")] and fired == [at("08:00")]
+
+    # Two wakes in the same minute, and a wake at exactly the same instant, fire the slot once.
+    dose, clock, fired, missed = scheduler()
+    for now in (at("08:00"), at("08:00") + timedelta(seconds=40), at("08:00") + timedelta(seconds=40)):
+        clock.current = now
+        dose.run_pending()
+    assert fired == [at("08:00")] and missed == []
+
+    # Across midnight: 23:59 fires on its own day and 00:00 on the next, in order.
+    dose, clock, fired, missed = scheduler(start=at("23:58"))
+    clock.current = at("00:00", days=1) + timedelta(seconds=30)
+    assert dose.run_pending() == [at("23:59"), at("00:00", days=1)] and missed == []
+    clock.current = at("00:01", days=1)
+    assert dose.run_pending() == [], "a slot fired again after midnight"
+
+    # next_fire is strictly after the given time and wraps to the next day's first slot.
+    assert dose.next_fire(at("07:59")) == at("08:00")
+    assert dose.next_fire(at("08:00")) == at("08:30")
+    assert dose.next_fire(at("08:00") + timedelta(seconds=30)) == at("08:30")
+    assert dose.next_fire(at("23:59")) == at("00:00", days=1)
+    assert dose.next_fire(at("23:59") + timedelta(seconds=59)) == at("00:00", days=1)
+    assert DoseScheduler(lambda: [], None).next_fire(at("08:00")) is None
+    print("late wake, missed slot, same-minute wakes, midnight rollover and next_fire all check out")
+
+
+def edit_elsewhere(workdir, hhmm):
+    """Another worker's edit: add a slot to the shared schedule and tell the leader."""
+    ScheduleStore(SqliteBackend(os.path.join(workdir, "meds.db"), "p")).add(hhmm, "Elsewhere", 1, 1)
+    DispenseQueue(os.path.join(workdir, "dispense.db")).schedule_changed()
+
+
+def check_rearm_across_processes():
+    workdir = tempfile.mkdtemp()
+    store = ScheduleStore(SqliteBackend(os.path.join(workdir, "meds.db"), "p"))
+    store.add((datetime.now() - timedelta(hours=1)).strftime("%H:%M"), "Here", 1, 1)
+    queue = DispenseQueue(os.path.join(workdir, "dispense.db"))
+    wakes = []
+    dose = DoseScheduler(store.times, lambda slot: None, on_run=lambda last_run: wakes.append(time.perf_counter()),
+                         record_metrics=False)
+    queue.start(lambda patient_id, slot: None, on_schedule_changed=dose.rearm)
+    dose.start()
+    try:
+        time.sleep(1)
+        idle = len(wakes)
+        hhmm = (datetime.now() + timedelta(minutes=2)).strftime("%H:%M")
+        started = time.perf_counter()
+        editor = multiprocessing.Process(target=edit_elsewhere, args=(workdir, hhmm))
+        editor.start()
+        editor.join()
+        deadline = time.time() + 5
+        while len(wakes) == idle and time.time() < deadline:
+            time.sleep(0.01)
+        assert len(wakes) > idle, "the scheduler did not rearm after another process edited the schedule"
+        assert idle == 1, f"an idle scheduler woke {idle} times in a second"
+        assert dose.next_fire(datetime.now()).strftime("%H:%M") == hhmm
+        print(f"rearmed {(wakes[idle] - started) * 1000:.0f}ms after another process added a slot "
+              f"(including starting that process)")
+    finally:
+        dose.stop()
+        queue.stop()
+
+
+def main():
+    check()
+    check_rearm_across_processes()
+
+    times = [f"{m // 60:02d}:{m % 60:02d}" for m in range(1440)]
+    dose, clock, fired, _ = scheduler(times, start=DAY)
+    wakes = iter([DAY + timedelta(minutes=m, seconds=5) for m in range(1, 1441)])
+
+    def wake():
+        clock.current = next(wakes)
+        dose.run_pending(clock.current)
+        dose.next_fire(clock.current)
+
+    report("run_pending + next_fire, 1440 slots", measure(wake, 1440))
+    assert fired == [DAY + timedelta(minutes=m) for m in range(1, 1441)], "every minute must fire exactly once"
+
+
+if __name__ == "__main__":
+    main()
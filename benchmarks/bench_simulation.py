@@ -0,0 +1,76 @@
+"""Capacity test: replay a month of a large multi-drug schedule in virtual time.
+
+Builds in-memory schedules for N patients with M meds each (no files, no serial ports) and runs
+them through simulation.simulate() with the app's real per-slot pipeline. None of the patients
+has a dispenser port configured; every fired dose must still reach the fake dispenser. First it
+checks that a dose due exactly at the start of a run is counted, fired or missed, and that one
+due exactly at its end is left to the next run.
+
+Usage: python benchmarks/bench_simulation.py [patients meds ...]   e.g. 100 12 500 20
+"""
+import random
+import sys
+import tempfile
+from datetime import datetime, timedelta
+
+from common import import_app
+
+from patients import Patient, PatientRegistry
+from schedule_store import MedRecord, ScheduleStore
+from simulation import PERIODS, simulate
+from storage import MemoryBackend
+
+ROUNDS = ["08:00", "12:00", "18:00", "22:00"]
+
+
+def make_registry(count, meds, seed=0):
+    rng = random.Random(seed)
+    patients, stores = [], {}
+    for i in range(count):
+        patient = Patient(f"p{i}", f"Patient {i}", f"+1555{i:07d}", f"+1666{i // 20:07d}")
+        records = [
+            MedRecord(rng.choice(ROUNDS) if j % 3 else f"{rng.randrange(24):02d}:{rng.randrange(60):02d}",
+                      f"Med{j}", str(rng.randint(1, 2)), str(j % 10 + 1))
+            for j in range(meds)
+        ]
+        patients.append(patient)
+        stores[patient.id] = ScheduleStore(MemoryBackend(records))
+    return PatientRegistry(patients, None, None, None, stores=stores)
+
+
+def check_edges(pipeline, start):
+    patient = Patient("edge", "Edge", "+15550000000", "+16660000000")
+    records = [MedRecord("00:00", "Midnight", "1", "1"), MedRecord("12:00", "Noon", "1", "2")]
+    registry = PatientRegistry([patient], None, None, None, stores={"edge": ScheduleStore(MemoryBackend(records))})
+    day = simulate(registry, pipeline, start, start + PERIODS["day"])
+    assert (day.doses_fired, day.doses_missed) == (2, 0), (day.doses_fired, day.doses_missed)
+    late = simulate(registry, pipeline, start, start + PERIODS["day"], lag=timedelta(minutes=40))
+    assert (late.doses_fired, late.doses_missed) == (0, 2), (late.doses_fired, late.doses_missed)
+    week = simulate(registry, pipeline, start, start + PERIODS["week"])
+    assert week.doses_fired == 14, week.doses_fired
+    print("doses at a run's start are counted once, fired or missed, and those at its end are left out")
+
+
+def main():
+    args = [int(n) for n in sys.argv[1:]] or [10, 12, 100, 12, 500, 20]
+    app = import_app(tempfile.mkdtemp())
+    settings = app.config_store.current()
+    pipeline = lambda slot, registry, notifier, events: app.run_dose_slot(slot, registry, notifier, events,
+                                                                          app.SIMULATION_LOG)
+    start = datetime(2026, 1, 1)
+    check_edges(pipeline, start)
+    for count, meds in zip(args[::2], args[1::2]):
+        registry = make_registry(count, meds)
+        report = simulate(registry, pipeline, start, start + PERIODS["month"], fail_rate=0.01,
+                          gate_settings=(settings.notify_dedupe_window, settings.notify_rate_limit,
+                                         settings.notify_rate_period))
+        print(f"--- {count} patients x {meds} meds, one month ---")
+        print(f"slots fired {report.ticks}, doses {report.doses_fired}, failed dispenses {report.dispense_failures}, "
+              f"calls {report.calls}, sms {report.sms}, suppressed {report.suppressed}")
+        print(f"tick p50={report.tick_p50_ms:.3f}ms p99={report.tick_p99_ms:.3f}ms max={report.tick_max_ms:.3f}ms, "
+              f"wall {report.wall_seconds:.2f}s ({report.speedup:,.0f}x real time)")
+        assert report.dispensed + report.dispense_failures == report.doses_fired
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,167 @@
+"""Hundreds of idle /events streams: the app's threaded workers vs. the gevent events server.
+
+Runs wsgi.py under gunicorn (one worker, THREADS threads) and events_wsgi.py with
+gunicorn_events.conf.py from a scratch directory, as bench_workers.py does. First it shows why
+the events server exists: THREADS streams opened on the app itself leave no thread for any other
+route. Then it opens STREAMS idle streams on the events server and checks that the app's routes
+stay fast while they are open, and that an event appended to events.db reaches every stream
+within RELAY_BUDGET seconds.
+
+Usage: python benchmarks/bench_sse.py [streams]   (needs gunicorn and gevent installed)
+"""
+import http.client
+import os
+import resource
+import selectors
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+from common import PLACEHOLDER_CREDENTIALS, ROOT, summarize
+
+from bench_workers import session_cookie
+from events import EVERYONE, EventLog
+
+APP_PORT = 5099
+EVENTS_PORT = 5098
+THREADS = 4
+STREAMS = 500
+EVENTS = 5
+REQUESTS = 100
+RELAY_BUDGET = 2.0
+
+
+def serve(workdir, port, *args):
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([ROOT, workdir]))
+    server = subprocess.Popen([sys.executable, "-m", "gunicorn", *args, "--bind", f"127.0.0.1:{port}"],
+                              cwd=workdir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=5)
+            conn.request("GET", "/landing_page")
+            conn.getresponse().read()
+            return server
+        except OSError:
+            time.sleep(0.2)
+    server.kill()
+    raise RuntimeError(f"server on port {port} did not start")
+
+
+def open_stream(port, cookie):
+    """Opens an /events stream and waits for its first line, so it is being served, not queued."""
+    sock = socket.create_connection(("127.0.0.1", port), timeout=10)
+    sock.sendall(f"GET /events HTTP/1.1\r\nHost: localhost\r\nCookie: {cookie}\r\n\r\n".encode())
+    received = b""
+    while b"retry:" not in received:
+        chunk = sock.recv(4096)
+        if not chunk:
+            raise RuntimeError("stream closed before it started")
+        received += chunk
+    return sock
+
+
+def get(path, cookie, timeout=10):
+    """Returns the seconds a GET took, or None if it failed or timed out."""
+    conn = http.client.HTTPConnection("127.0.0.1", APP_PORT, timeout=timeout)
+    start = time.perf_counter()
+    try:
+        conn.request("GET", path, headers={"Cookie": cookie})
+        response = conn.getresponse()
+        response.read()
+        return time.perf_counter() - start if response.status == 200 else None
+    except OSError:
+        return None
+    finally:
+        conn.close()
+
+
+def deliver(log, streams, marker):
+    """Appends one event to the log; returns how long until every stream had it, or None."""
+    selector = selectors.DefaultSelector()
+    received = {}
+    for sock in streams:
+        sock.setblocking(False)
+        selector.register(sock, selectors.EVENT_READ)
+        received[sock] = b""
+    started = time.perf_counter()
+    log.append("dose_due", {"time": "08:00", "meds": [marker]}, EVERYONE)
+    pending = set(streams)
+    while pending and time.perf_counter() - started < 10:
+        for key, _ in selector.select(0.5):
+            sock = key.fileobj
+            received[sock] += sock.recv(65536)
+            if marker.encode() in received[sock]:
+                pending.discard(sock)
+                selector.unregister(sock)
+    selector.close()
+    return None if pending else time.perf_counter() - started
+
+
+def main():
+    streams_wanted = int(sys.argv[1]) if len(sys.argv) > 1 else STREAMS
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    wanted = 2 * streams_wanted + 256
+    if soft < wanted:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (min(hard, wanted), hard))
+
+    workdir = tempfile.mkdtemp()
+    with open(os.path.join(workdir, "credentials.py"), "w") as f:
+        f.write(PLACEHOLDER_CREDENTIALS)
+    shutil.copy(os.path.join(ROOT, "data.xlsx"), workdir)
+    app = serve(workdir, APP_PORT, "--workers", "1", "--threads", str(THREADS), "wsgi:app")
+    events = serve(workdir, EVENTS_PORT, "--config", os.path.join(ROOT, "gunicorn_events.conf.py"), "events_wsgi:app")
+    streams = []
+    try:
+        conn = http.client.HTTPConnection("127.0.0.1", APP_PORT, timeout=30)
+        patient = session_cookie(conn, "patient", "patient")
+        caregiver = session_cookie(conn, "caregiver", "caregiver")
+        conn.close()
+
+        # The problem: every app thread is parked on a stream, so a plain route can't be served.
+        blocking = [open_stream(APP_PORT, caregiver) for _ in range(THREADS)]
+        assert get("/api/patient/due", patient, timeout=3) is None, f"{THREADS} streams on the app should take every thread"
+        print(f"app, {THREADS} streams open on its own threads: /api/patient/due times out")
+        for sock in blocking:
+            sock.close()
+        # The threads notice the closed streams at their next heartbeat.
+        deadline = time.time() + 30
+        while get("/api/patient/due", patient, timeout=3) is None:
+            assert time.time() < deadline, "the app did not get its threads back"
+
+        started = time.perf_counter()
+        streams = [open_stream(EVENTS_PORT, caregiver) for _ in range(streams_wanted)]
+        print(f"events server: {len(streams)} streams open in {time.perf_counter() - started:.2f}s")
+
+        samples = [get("/api/patient/due", patient) for _ in range(REQUESTS)]
+        failed = samples.count(None)
+        s = summarize([sample for sample in samples if sample is not None])
+        print(f"app, /api/patient/due with the streams open  p50={s['p50_ms']:7.2f}ms  p99={s['p99_ms']:7.2f}ms  "
+              f"failed={failed}")
+        assert failed == 0 and s["p99_ms"] < 500, "the app's routes must not wait on the events server's streams"
+
+        log = EventLog(os.path.join(workdir, "events.db"))
+        delivered = [deliver(log, streams, f"bench-{i}") for i in range(EVENTS)]
+        assert None not in delivered, "an event did not reach every stream"
+        print(f"events server: {EVENTS} events reached all {len(streams)} streams, "
+              f"slowest in {max(delivered) * 1000:.0f}ms")
+        assert max(delivered) < RELAY_BUDGET, f"delivery must stay within {RELAY_BUDGET}s (relay interval 0.5s)"
+        assert events.poll() is None, "the events server died under the streams"
+    finally:
+        for sock in streams:
+            sock.close()
+        for server in (events, app):
+            server.terminate()
+            try:
+                server.wait(10)
+            except subprocess.TimeoutExpired:
+                server.kill()
+                server.wait()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
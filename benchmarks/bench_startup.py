@@ -0,0 +1,116 @@
+"""Cold-start cost: time to import app.py and serve a first request, in fresh interpreters.
+
+Each run is a new process in a scratch directory with placeholder credentials. It reports the
+median import and first-request times, the slowest top-level imports (from python -X importtime),
+and whether any of the lazily loaded SDKs were imported at startup anyway. It fails if importing
+the app creates any SQLite database: the stores that own one open it on first use.
+
+With --baseline FILE the medians are compared against the ones saved there and the script
+exits non-zero if either got more than --tolerance slower; the file is written if it doesn't
+exist yet (or with --save).
+
+Usage: python benchmarks/bench_startup.py [--runs 10] [--baseline startup.json] [--tolerance 0.2] [--save]
+"""
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+
+from common import PLACEHOLDER_CREDENTIALS, ROOT
+
+LAZY = ["twilio", "openpyxl", "serial", "httpx", "notificationapi_python_server_sdk"]
+
+CHILD = f"""
+import glob, json, os, sys, time
+for name in glob.glob("*.db*"):
+    os.remove(name)
+started = time.perf_counter()
+import app
+imported = time.perf_counter()
+databases = sorted(glob.glob("*.db"))
+app.app.test_client().get("/login")
+served = time.perf_counter()
+print(json.dumps({{
+    "import_ms": (imported - started) * 1000,
+    "first_request_ms": (served - imported) * 1000,
+    "loaded": [name for name in {LAZY!r} if name in sys.modules],
+    "databases": databases,
+}}))
+"""
+
+
+def run_once(workdir):
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([workdir, ROOT]), PYTHONDONTWRITEBYTECODE="")
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", CHILD], cwd=workdir, env=env,
+                            capture_output=True, text=True, check=True)
+    timings = json.loads(result.stdout.strip().splitlines()[-1])
+    imports = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|")
+        # Direct imports of app.py are indented one level below it.
+        if name.startswith("   ") and not name.startswith("     ") and cumulative.strip().isdigit():
+            imports[name.strip()] = int(cumulative) / 1000
+    return timings, imports
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    parser.add_argument("--save", action="store_true")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    with open(os.path.join(workdir, "credentials.py"), "w") as f:
+        f.write(PLACEHOLDER_CREDENTIALS)
+    shutil.copy(os.path.join(ROOT, "data.xlsx"), workdir)
+
+    run_once(workdir)  # warm the bytecode cache so every measured run starts from the same state
+    runs = [run_once(workdir) for _ in range(args.runs)]
+    result = {
+        "import_ms": statistics.median(timings["import_ms"] for timings, _ in runs),
+        "first_request_ms": statistics.median(timings["first_request_ms"] for timings, _ in runs),
+    }
+    print(f"import app          p50 {result['import_ms']:8.1f} ms")
+    print(f"first request       p50 {result['first_request_ms']:8.1f} ms")
+
+    imports = {name: statistics.median(run[1].get(name, 0) for run in runs) for name in runs[0][1]}
+    print("slowest top-level imports (cumulative, p50):")
+    for name, ms in sorted(imports.items(), key=lambda item: -item[1])[:10]:
+        print(f"  {name:<32} {ms:8.1f} ms")
+    loaded = sorted({name for timings, _ in runs for name in timings["loaded"]})
+    print(f"lazy SDKs loaded at startup: {', '.join(loaded) or 'none'}")
+    databases = sorted({name for timings, _ in runs for name in timings["databases"]})
+    print(f"databases created by importing the app: {', '.join(databases) or 'none'}")
+    assert not databases, "importing the app must not open its databases"
+
+    if not args.baseline:
+        return
+    if args.save or not os.path.exists(args.baseline):
+        with open(args.baseline, "w") as f:
+            json.dump(result, f, indent=2)
+        print(f"saved baseline to {args.baseline}")
+        return
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    regressed = False
+    for key, value in result.items():
+        limit = baseline[key] * (1 + args.tolerance)
+        if value > limit:
+            regressed = True
+            print(f"WARNING: {key} regressed: {value:.1f} ms vs baseline {baseline[key]:.1f} ms "
+                  f"(limit {limit:.1f} ms)")
+    if regressed:
+        sys.exit(1)
+    print(f"within {args.tolerance:.0%} of the baseline in {args.baseline}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+"""Write throughput and concurrent read/write behaviour of the xlsx and SQLite backends.
+
+Usage: python benchmarks/bench_storage.py [rows] [writes]
+"""
+import os
+import sys
+import tempfile
+import threading
+import time
+
+from common import make_workbook, measure, report
+
+from schedule_store import ScheduleStore
+from storage import SqliteBackend, XlsxBackend, import_xlsx
+
+
+def write_throughput(store, writes):
+    start = time.perf_counter()
+    for i in range(writes):
+        store.add("08:00", f"Bench{i}", "1", "1")
+        store.update(f"Bench{i}", amount="2")
+        store.delete(f"Bench{i}")
+    elapsed = time.perf_counter() - start
+    return writes * 3 / elapsed
+
+
+def concurrent(store, writes, readers=4):
+    stop = threading.Event()
+    samples = []
+    lock = threading.Lock()
+
+    def reader():
+        local = []
+        while not stop.is_set():
+            start = time.perf_counter()
+            store.due_at("08:00")
+            local.append(time.perf_counter() - start)
+        with lock:
+            samples.extend(local)
+
+    threads = [threading.Thread(target=reader) for _ in range(readers)]
+    for thread in threads:
+        thread.start()
+    rate = write_throughput(store, writes)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    return rate, samples
+
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    writes = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    with tempfile.TemporaryDirectory() as tmp:
+        xlsx_path = make_workbook(os.path.join(tmp, "data.xlsx"), rows)
+        sqlite = SqliteBackend(os.path.join(tmp, "meds.db"))
+        import_xlsx(sqlite, xlsx_path)
+        backends = {"xlsx": XlsxBackend(xlsx_path), "sqlite": sqlite}
+
+        print(f"--- {rows} rows, {writes} add/update/delete cycles ---")
+        for name, backend in backends.items():
+            store = ScheduleStore(backend)
+            store.records()
+            print(f"{name:<8} writes/s alone:      {write_throughput(store, writes):10.1f}")
+            rate, samples = concurrent(store, writes)
+            print(f"{name:<8} writes/s with readers: {rate:8.1f}")
+            report(f"{name} reader latency under writes", samples)
+
+            other = ScheduleStore(backend)
+            other.records()
+            store.add("08:00", "Probe", "1", "1")
+            report(f"{name} second store read after write", measure(other.records, 1))
+            store.delete("Probe")
+
+
+if __name__ == "__main__":
+    main()
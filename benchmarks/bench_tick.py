@@ -0,0 +1,41 @@
+"""Scheduler tick over large schedules: linear scan of every row vs. the minute-of-day TimeIndex.
+
+Usage: python benchmarks/bench_tick.py [rows ...]
+"""
+import random
+import sys
+
+from common import measure, report
+
+from schedule_store import MedRecord, TimeIndex
+
+
+def make_records(rows, seed=0):
+    rng = random.Random(seed)
+    return [
+        MedRecord(f"{rng.randrange(24)}:{rng.randrange(60):02d}", f"Med{i}", "1", str(i % 10 + 1))
+        for i in range(rows)
+    ]
+
+
+def main():
+    sizes = [int(n) for n in sys.argv[1:]] or [1000, 100000, 1000000]
+    ticks = [f"{m // 60:02d}:{m % 60:02d}" for m in range(0, 1440, 7)]
+    for rows in sizes:
+        records = make_records(rows)
+        print(f"--- {rows} rows ---")
+        it = iter(ticks * 1000)
+
+        def linear_tick():
+            now = next(it)
+            return [r.name for r in records if str(r.time) == now]
+
+        report("linear scan tick", measure(linear_tick, 50))
+        report("TimeIndex build", measure(lambda: TimeIndex(records), 3))
+        index = TimeIndex(records)
+        it = iter(ticks * 1000)
+        report("TimeIndex tick", measure(lambda: [r.name for r in index.at(next(it))], 1000))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+"""Read-route throughput: the Werkzeug dev server vs. gunicorn with N worker processes.
+
+Each server runs wsgi.py/app.py from a scratch directory with placeholder credentials and the
+real data.xlsx. Client processes log in once and then replay GET /api/patient/due,
+/patient_dashboard and /show_all over keep-alive connections for a fixed time.
+
+Usage: python benchmarks/bench_workers.py [workers ...]   (needs gunicorn installed)
+"""
+import http.client
+import multiprocessing
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.parse
+
+from common import PLACEHOLDER_CREDENTIALS, ROOT, summarize
+
+DURATION = 10
+CLIENTS = 8
+PORT = 5099
+
+
+def start_server(workdir, workers):
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([ROOT, workdir]))
+    if workers == 0:
+        command = [sys.executable, "-c",
+                   f"import app; app.create_app().run(port={PORT}, threaded=True)"]
+    else:
+        command = [sys.executable, "-m", "gunicorn", "--workers", str(workers), "--threads", "4",
+                   "--bind", f"127.0.0.1:{PORT}", "wsgi:app"]
+    server = subprocess.Popen(command, cwd=workdir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            conn = http.client.HTTPConnection("127.0.0.1", PORT, timeout=1)
+            conn.request("GET", "/landing_page")
+            conn.getresponse().read()
+            return server
+        except OSError:
+            time.sleep(0.2)
+    server.kill()
+    raise RuntimeError("server did not start")
+
+
+def session_cookie(conn, username, password):
+    body = urllib.parse.urlencode({"username": username, "password": password})
+    conn.request("POST", "/login_attempt", body, {"Content-Type": "application/x-www-form-urlencoded"})
+    response = conn.getresponse()
+    response.read()
+    return response.getheader("Set-Cookie").split(";")[0]
+
+
+def client(results):
+    conn = http.client.HTTPConnection("127.0.0.1", PORT, timeout=10)
+    patient = session_cookie(conn, "patient", "patient")
+    caregiver = session_cookie(conn, "caregiver", "caregiver")
+    routes = [("/api/patient/due", patient), ("/patient_dashboard", patient), ("/show_all", caregiver)]
+    samples, errors, i = [], 0, 0
+    deadline = time.time() + DURATION
+    while time.time() < deadline:
+        path, cookie = routes[i % len(routes)]
+        i += 1
+        start = time.perf_counter()
+        try:
+            conn.request("GET", path, headers={"Cookie": cookie})
+            response = conn.getresponse()
+            response.read()
+            if response.status != 200:
+                errors += 1
+        except OSError:
+            errors += 1
+            conn.close()
+            conn = http.client.HTTPConnection("127.0.0.1", PORT, timeout=10)
+            continue
+        samples.append(time.perf_counter() - start)
+    results.put((samples, errors))
+
+
+def run(workers):
+    workdir = tempfile.mkdtemp()
+    with open(os.path.join(workdir, "credentials.py"), "w") as f:
+        f.write(PLACEHOLDER_CREDENTIALS)
+    shutil.copy(os.path.join(ROOT, "data.xlsx"), workdir)
+    server = start_server(workdir, workers)
+    try:
+        results = multiprocessing.Queue()
+        clients = [multiprocessing.Process(target=client, args=(results,)) for _ in range(CLIENTS)]
+        for p in clients:
+            p.start()
+        samples, errors = [], 0
+        for _ in clients:
+            s, e = results.get()
+            samples.extend(s)
+            errors += e
+        for p in clients:
+            p.join()
+    finally:
+        server.terminate()
+        server.wait(10)
+        shutil.rmtree(workdir, ignore_errors=True)
+    s = summarize(samples)
+    label = "dev server (threaded)" if workers == 0 else f"gunicorn {workers} worker(s)"
+    print(f"{label:<28} {len(samples) / DURATION:8.1f} req/s  p50={s['p50_ms']:7.2f}ms  "
+          f"p99={s['p99_ms']:7.2f}ms  errors={errors}")
+
+
+def main():
+    workers = [int(n) for n in sys.argv[1:]] or [1, 2, 4]
+    print(f"{CLIENTS} clients, {DURATION}s per run, {os.cpu_count()} CPU(s)")
+    for n in [0] + workers:
+        run(n)
+
+
+if __name__ == "__main__":
+    main()
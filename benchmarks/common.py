@@ -0,0 +1,99 @@
+import os
+import random
+import statistics
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+
+def make_workbook(path, rows, seed=0):
+    """Writes a synthetic data.xlsx with the same layout as the real one.
+
+    The workbook is streamed out row by row, so any size fits in memory.
+    """
+    import openpyxl
+
+    rng = random.Random(seed)
+    wb = openpyxl.Workbook(write_only=True)
+    sheet = wb.create_sheet()
+    sheet.append(["Timing", "Name", "Quantity", "Container"])
+    for i in range(rows):
+        sheet.append([
+            f"{rng.randrange(24):02d}:{rng.randrange(60):02d}",
+            f"Med{i}",
+            str(rng.randint(1, 3)),
+            str(i % 10 + 1),
+        ])
+    wb.save(path)
+    return path
+
+
+def measure(fn, repeat):
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def summarize(samples):
+    samples = sorted(samples)
+    p99 = samples[min(len(samples) - 1, int(len(samples) * 0.99))]
+    return {
+        "n": len(samples),
+        "p50_ms": statistics.median(samples) * 1000,
+        "p99_ms": p99 * 1000,
+        "mean_ms": statistics.fmean(samples) * 1000,
+    }
+
+
+def report(label, samples):
+    s = summarize(samples)
+    print(f"{label:<40} n={s['n']:<5} p50={s['p50_ms']:10.3f}ms  p99={s['p99_ms']:10.3f}ms")
+
+
+PLACEHOLDER_CREDENTIALS = """\
+LOGIN_USERNAME = "caregiver"
+LOGIN_PASSWORD = "caregiver"
+PATIENT_USERNAME = "patient"
+PATIENT_PASSWORD = "patient"
+SECRET_KEY = ""
+SECRET_KEY_FILE = 'secret_key.txt'
+TWILIO_ACCOUNT_SID = "ACbenchmark"
+TWILIO_AUTH_TOKEN = "benchmark"
+TWILIO_NUMBER = "+10000000000"
+RECIPIENT_NUMBER = "+10000000001"
+CARE_NUMBER = "+10000000002"
+ARDUINO_PORT = "/dev/null"
+CALL_LANGUAGE = "English"
+NOTIFICATIONAPI1D = "benchmark"
+NOTIFICATIONAPI2D = "benchmark"
+NOTIFICATIONAPIID = "benchmark"
+"""
+
+
+def import_app(workdir, rows=None):
+    """Imports app.py with workdir as its working directory (so data.xlsx and
+    credentials.py there are used instead of the real ones) and returns the module."""
+    import shutil
+
+    os.chdir(workdir)
+    if not os.path.exists("credentials.py"):
+        with open("credentials.py", "w") as f:
+            f.write(PLACEHOLDER_CREDENTIALS)
+    if rows is None:
+        shutil.copy(os.path.join(ROOT, "data.xlsx"), "data.xlsx")
+    else:
+        make_workbook("data.xlsx", rows)
+    sys.path.insert(0, workdir)
+    import app
+    return app
+
+
+def login(client, username, password):
+    client.post("/login_attempt", data={"username": username, "password": password})
+    return client
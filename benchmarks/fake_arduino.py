@@ -0,0 +1,67 @@
+"""A stand-in for the dispenser firmware on a pseudo-terminal, speaking the dispenser.py protocol."""
+import os
+import threading
+import time
+import tty
+
+from dispenser import decode_frame, encode_frame
+
+
+class FakeArduino:
+    """Opens a pty pair; point a DispenserLink (or pyserial) at .port.
+
+    Each command takes dispense_time seconds and is handled in order, like the real firmware.
+    Each reply reaches the host link_latency seconds later, as over a USB-serial adapter.
+    Containers listed in empty are answered with a NAK; a repeated sequence id is re-acked
+    without dispensing again.
+    """
+
+    def __init__(self, dispense_time=0.0, link_latency=0.0, empty=()):
+        self.dispense_time = dispense_time
+        self.link_latency = link_latency
+        self.empty = set(empty)
+        self.dispensed = []
+        self._replies = {}
+        self._master, slave = os.openpty()
+        tty.setraw(slave)
+        self.port = os.ttyname(slave)
+        self._slave = slave
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        buffer = b""
+        while not self._stopped.is_set():
+            try:
+                chunk = os.read(self._master, 4096)
+            except OSError:
+                return
+            buffer += chunk
+            *lines, buffer = buffer.split(b"\n")
+            for line in lines:
+                fields = decode_frame(line)
+                if not fields or fields[0] != "D":
+                    continue
+                seq, container, quantity = fields[1], int(fields[2]), int(fields[3])
+                reply = self._replies.get(seq)
+                if reply is None:
+                    if container in self.empty:
+                        reply = encode_frame("N", seq, "EMPTY")
+                    else:
+                        time.sleep(self.dispense_time)
+                        self.dispensed.append((container, quantity))
+                        reply = encode_frame("A", seq)
+                    self._replies[seq] = reply
+                self._reply(reply)
+
+    def _reply(self, reply):
+        if self.link_latency:
+            threading.Timer(self.link_latency, os.write, (self._master, reply)).start()
+        else:
+            os.write(self._master, reply)
+
+    def close(self):
+        self._stopped.set()
+        os.close(self._master)
+        os.close(self._slave)
@@ -0,0 +1,101 @@
+"""Local HTTP stand-ins for the Twilio and NotificationAPI services.
+
+Unlike stubs.py, which replaces the provider objects, these answer the real SDK and httpx
+requests, so the app's own TwilioCallProvider and NotificationApiProvider are exercised. Point
+them here with the twilio_api_url and notificationapi_url settings.
+"""
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FakeService:
+    """An HTTP server on a free local port that answers after latency seconds.
+
+    A fraction error_rate of the requests gets a 500 instead (chosen by a seeded RNG, so runs are
+    repeatable). stats counts what was accepted, what was failed on purpose and what wasn't
+    recognised; requests keeps the accepted (path, body) pairs.
+    """
+
+    def __init__(self, latency=0.0, error_rate=0.0, seed=0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.stats = {"accepted": 0, "injected_errors": 0, "unknown": 0}
+        self.requests = []
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        service = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+                status, payload = service.handle(self.path, body)
+                data = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self._server.server_port}"
+
+    def handle(self, path, body):
+        time.sleep(self.latency)
+        with self._lock:
+            result = self.respond(path, body)
+            if result is None:
+                self.stats["unknown"] += 1
+                return 404, {"message": f"no such resource: {path}"}
+            if self._rng.random() < self.error_rate:
+                self.stats["injected_errors"] += 1
+                return 500, {"message": "injected error"}
+            self.stats["accepted"] += 1
+            self.requests.append((path, body))
+            return result
+
+    def respond(self, path, body):
+        """Returns (status, JSON payload) for a request this service knows, or None."""
+        raise NotImplementedError
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+class FakeTwilio(FakeService):
+    """Creates calls: POST /2010-04-01/Accounts/<sid>/Calls.json, as twilio.rest.Client sends it."""
+
+    CALLS = re.compile(r"^/2010-04-01/Accounts/(?P<sid>[^/]+)/Calls\.json$")
+
+    def respond(self, path, body):
+        match = self.CALLS.match(path)
+        if match is None:
+            return None
+        n = self.stats["accepted"] + 1
+        return 201, {"sid": f"CA{n:032d}", "account_sid": match["sid"], "status": "queued"}
+
+
+class FakeNotificationApi(FakeService):
+    """Accepts sends: POST /<client id>/sender, as notifier.NotificationApiProvider sends it."""
+
+    SENDER = re.compile(r"^/[^/]+/sender$")
+
+    def respond(self, path, body):
+        if self.SENDER.match(path) is None:
+            return None
+        return 202, {}
@@ -0,0 +1,291 @@
+"""End-to-end load test: the whole app, offline, with the scheduler running alongside.
+
+The app runs in this process on a threaded Werkzeug server, from a scratch directory holding a
+synthetic data.xlsx of --rows rows and a config.json that points it at local stand-ins:
+FakeTwilio and FakeNotificationApi (fake_providers.py, with --*-latency and --*-errors
+injected) and a FakeArduino on a pseudo-terminal. Nothing leaves the machine.
+
+--clients client processes each log in as the caregiver and the patient and, until --duration
+runs out, send a random mix (--mix) of:
+
+  show_all           GET /show_all as the caregiver, expecting 200
+  patient_dashboard  GET /patient_dashboard as the patient, expecting 200
+  do_add_med         POST /do_add_med with a new med at a random time, expecting a redirect to /edit
+  dispense           POST /dispense for one of the scheduled times, expecting a redirect to /run
+
+Meanwhile the scheduler's job, dispense_medication_job, fires every --tick seconds for the next
+minute of a virtual day, so every scheduled slot dispenses and notifies while the routes are
+under load. The notification gate's rate limit is lifted so the providers see every dose;
+duplicates are still dropped.
+
+The results (per-route throughput, error rate and latency percentiles, scheduler tick times,
+provider traffic and notification job outcomes) are written as JSON with sorted keys to
+--output, so two runs diff line by line. --compare prints the change from an earlier file.
+
+Usage: python benchmarks/harness.py [--rows 2000] [--duration 20] [--clients 4] [--output harness.json]
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+import urllib.parse
+from dataclasses import asdict, replace
+from datetime import datetime, timedelta
+
+from bench_workers import session_cookie
+from common import import_app
+from fake_arduino import FakeArduino
+from fake_providers import FakeNotificationApi, FakeTwilio
+
+from settings import Settings
+
+SCENARIOS = ("show_all", "patient_dashboard", "do_add_med", "dispense")
+DEFAULT_MIX = "show_all=4,patient_dashboard=4,do_add_med=1,dispense=1"
+SETTINGS = Settings(
+    login_username="caregiver", login_password="caregiver", patient_username="patient", patient_password="patient",
+    twilio_account_sid="ACbenchmark", twilio_auth_token="benchmark", twilio_number="+10000000000",
+    recipient_number="+10000000001", care_number="+10000000002", notificationapi1d="benchmark",
+    notificationapi2d="benchmark", notificationapiid="benchmark", notify_rate_limit=1_000_000,
+)
+
+
+def parse_mix(text):
+    weights = {}
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        if name not in SCENARIOS:
+            raise argparse.ArgumentTypeError(f"unknown scenario {name!r}; choose from {', '.join(SCENARIOS)}")
+        weights[name] = float(weight or 1)
+    return weights
+
+
+def percentile(samples, q):
+    return samples[min(len(samples) - 1, int(len(samples) * q))] if samples else 0.0
+
+
+def latency(samples):
+    """Latency percentiles in ms, rounded to 0.01 ms so the output diffs cleanly."""
+    samples = sorted(samples)
+    return {
+        "p50_ms": round(percentile(samples, 0.50) * 1000, 2),
+        "p90_ms": round(percentile(samples, 0.90) * 1000, 2),
+        "p99_ms": round(percentile(samples, 0.99) * 1000, 2),
+        "max_ms": round(samples[-1] * 1000, 2) if samples else 0.0,
+    }
+
+
+def request(conn, method, path, cookie, form=None):
+    headers = {"Cookie": cookie, "Accept-Encoding": "gzip"}
+    body = None
+    if form is not None:
+        body = urllib.parse.urlencode(form)
+        headers["Content-Type"] = "application/x-www-form-urlencoded"
+    conn.request(method, path, body, headers)
+    response = conn.getresponse()
+    return response, response.read()
+
+
+def client(index, port, mix, times, duration, seed, results):
+    """One client process: replays the scenario mix over a keep-alive connection until duration is up."""
+    import http.client
+
+    rng = random.Random(seed * 1000 + index)
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+    caregiver = session_cookie(conn, SETTINGS.login_username, SETTINGS.login_password)
+    patient = session_cookie(conn, SETTINGS.patient_username, SETTINGS.patient_password)
+    names, weights = list(mix), list(mix.values())
+    stats = {name: {"requests": 0, "samples": [], "errors": 0, "bytes": 0} for name in names}
+    added = 0
+    deadline = time.time() + duration
+    while time.time() < deadline:
+        name = rng.choices(names, weights)[0]
+        if name == "show_all":
+            call, expect = ("GET", "/show_all", caregiver), (200, None)
+        elif name == "patient_dashboard":
+            call, expect = ("GET", "/patient_dashboard", patient), (200, None)
+        elif name == "do_add_med":
+            added += 1
+            form = {"med_time": f"{rng.randrange(24):02d}:{rng.randrange(60):02d}", "med_name": f"Load{index}-{added}",
+                    "med_amount": "1", "container": str(rng.randint(1, 10))}
+            call, expect = ("POST", "/do_add_med", caregiver, form), (302, "/edit")
+        else:
+            call, expect = ("POST", "/dispense", caregiver, {"timing": rng.choice(times)}), (302, "/run")
+        stats[name]["requests"] += 1
+        start = time.perf_counter()
+        try:
+            response, body = request(conn, *call)
+        except OSError:
+            stats[name]["errors"] += 1
+            conn.close()
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+            continue
+        stats[name]["samples"].append(time.perf_counter() - start)
+        stats[name]["bytes"] += len(body)
+        status, location = expect
+        if response.status != status or (location and not (response.getheader("Location") or "").endswith(location)):
+            stats[name]["errors"] += 1
+    results.put(stats)
+
+
+class SchedulerDriver(threading.Thread):
+    """Fires the scheduler's job for consecutive minutes of a virtual day, one every tick seconds."""
+
+    def __init__(self, app, tick, start):
+        super().__init__(name="scheduler-driver", daemon=True)
+        self.app = app
+        self.tick = tick
+        self.slot = start
+        self.samples = []
+        self.errors = 0
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.tick):
+            started = time.perf_counter()
+            try:
+                self.app.dispense_medication_job(self.slot)
+            except Exception:
+                self.errors += 1
+            self.samples.append(time.perf_counter() - started)
+            self.slot += timedelta(minutes=1)
+
+
+def wait_for_notifications(dispatcher, timeout):
+    """Waits for queued and retrying jobs to finish, so the outcome counts are final."""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        counts = dispatcher.counts()
+        if not {"queued", "running", "retrying"} & set(counts):
+            return counts
+        time.sleep(0.1)
+    return dispatcher.counts()
+
+
+def run(args):
+    from werkzeug.serving import make_server
+
+    workdir = tempfile.mkdtemp()
+    twilio = FakeTwilio(args.twilio_latency, args.twilio_errors, seed=args.seed)
+    notificationapi = FakeNotificationApi(args.sms_latency, args.sms_errors, seed=args.seed + 1)
+    arduino = FakeArduino(dispense_time=args.dispense_time)
+    settings = replace(SETTINGS, twilio_api_url=twilio.url, notificationapi_url=notificationapi.url,
+                       arduino_port=arduino.port)
+    with open(os.path.join(workdir, "config.json"), "w") as f:
+        json.dump(asdict(settings), f, indent=2)
+    app = import_app(workdir, rows=args.rows)
+
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+    server = make_server("127.0.0.1", 0, app.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    times = app.patients.first().store.times()
+    # This process stands in for the scheduler leader, which carries out every worker's /dispense.
+    app.dispense_requests.start(app.dispense_request)
+    driver = SchedulerDriver(app, args.tick, datetime.combine(datetime.now().date(), datetime.min.time()))
+
+    spawn = multiprocessing.get_context("spawn")
+    results = spawn.Queue()
+    clients = [spawn.Process(target=client, args=(i, server.server_port, args.mix, times, args.duration,
+                                                  args.seed, results))
+               for i in range(args.clients)]
+    try:
+        for process in clients:
+            process.start()
+        driver.start()
+        stats = [results.get(timeout=args.duration + 120) for _ in clients]
+        driver.stopped.set()
+        driver.join()
+        for process in clients:
+            process.join()
+        jobs = wait_for_notifications(app.dispatcher, timeout=30)
+    finally:
+        for process in clients:
+            if process.is_alive():
+                process.kill()
+        server.shutdown()
+        app.dispense_requests.stop()
+        app.shutdown()
+        twilio.close()
+        notificationapi.close()
+        arduino.close()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    routes = {}
+    for name in args.mix:
+        samples = [s for client_stats in stats for s in client_stats[name]["samples"]]
+        requests = sum(client_stats[name]["requests"] for client_stats in stats)
+        errors = sum(client_stats[name]["errors"] for client_stats in stats)
+        routes[name] = {
+            "requests": requests,
+            "errors": errors,
+            "error_rate": round(errors / requests, 4) if requests else 0.0,
+            "throughput_rps": round(requests / args.duration, 1),
+            "bytes_per_response": round(sum(c[name]["bytes"] for c in stats) / len(samples)) if samples else 0,
+            **latency(samples),
+        }
+    all_requests = sum(route["requests"] for route in routes.values())
+    all_errors = sum(route["errors"] for route in routes.values())
+    return {
+        "parameters": {key: value for key, value in vars(args).items() if key not in ("output", "compare")},
+        "routes": routes,
+        "total": {
+            "requests": all_requests,
+            "errors": all_errors,
+            "error_rate": round(all_errors / all_requests, 4) if all_requests else 0.0,
+            "throughput_rps": round(all_requests / args.duration, 1),
+        },
+        "scheduler": {"ticks": len(driver.samples), "errors": driver.errors, **latency(driver.samples)},
+        "dispenser": {"commands": len(arduino.dispensed)},
+        "providers": {"twilio": dict(twilio.stats), "notificationapi": dict(notificationapi.stats)},
+        "notification_jobs": jobs,
+    }
+
+
+def compare(old, new):
+    print(f"{'route':<20} {'rps':>16} {'p50 ms':>18} {'p99 ms':>18} {'error rate':>18}")
+    for name in sorted(set(old["routes"]) | set(new["routes"])):
+        a, b = old["routes"].get(name), new["routes"].get(name)
+        if a is None or b is None:
+            print(f"{name:<20} only in the {'new' if a is None else 'old'} run")
+            continue
+        cells = [f"{a[key]:>7} -> {b[key]:<7}" for key in ("throughput_rps", "p50_ms", "p99_ms", "error_rate")]
+        print(f"{name:<20} " + " ".join(f"{cell:>18}" for cell in cells))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--rows", type=int, default=2000, help="rows in the synthetic data.xlsx")
+    parser.add_argument("--duration", type=float, default=20, help="seconds of load")
+    parser.add_argument("--clients", type=int, default=4, help="client processes")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix(DEFAULT_MIX),
+                        help=f"scenario weights (default {DEFAULT_MIX})")
+    parser.add_argument("--tick", type=float, default=0.1, help="seconds between scheduler jobs")
+    parser.add_argument("--twilio-latency", type=float, default=0.05)
+    parser.add_argument("--twilio-errors", type=float, default=0.0, help="fraction of calls answered with a 500")
+    parser.add_argument("--sms-latency", type=float, default=0.05)
+    parser.add_argument("--sms-errors", type=float, default=0.0, help="fraction of SMS answered with a 500")
+    parser.add_argument("--dispense-time", type=float, default=0.0, help="seconds the fake dispenser takes per command")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="harness.json")
+    parser.add_argument("--compare", help="an earlier output file to compare against")
+    args = parser.parse_args()
+
+    result = run(args)
+    with open(args.output, "w") as f:
+        json.dump(result, f, indent=2, sort_keys=True)
+        f.write("\n")
+    total, scheduler = result["total"], result["scheduler"]
+    print(f"{total['requests']} requests, {total['throughput_rps']} req/s, error rate {total['error_rate']}; "
+          f"{scheduler['ticks']} scheduler ticks, p99 {scheduler['p99_ms']} ms; written to {args.output}")
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), result)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,39 @@
+"""Local stand-ins for the Twilio and NotificationAPI providers used by notifier.Dispatcher."""
+import asyncio
+import itertools
+import threading
+import time
+
+
+class StubCallProvider:
+    def __init__(self, latency=0.0, fail_every=0):
+        self.latency = latency
+        self.fail_every = fail_every
+        self.calls = []
+        self._count = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def call(self, to, twiml):
+        n = next(self._count)
+        time.sleep(self.latency)
+        if self.fail_every and n % self.fail_every == 0:
+            raise RuntimeError("stub call failure")
+        with self._lock:
+            self.calls.append((to, twiml))
+        return f"CA{n:032d}"
+
+
+class StubSmsProvider:
+    def __init__(self, latency=0.0, fail_every=0):
+        self.latency = latency
+        self.fail_every = fail_every
+        self.sent = []
+        self._count = itertools.count(1)
+
+    async def send(self, params):
+        n = next(self._count)
+        await asyncio.sleep(self.latency)
+        if self.fail_every and n % self.fail_every == 0:
+            raise RuntimeError("stub sms failure")
+        self.sent.append(params)
+        return 200
@@ -0,0 +1,313 @@
+import itertools
+import logging
+import queue
+import random
+import threading
+import time
+from concurrent.futures import Future
+from datetime import datetime
+
+from storage import sqlite_connection
+
+log = logging.getLogger(__name__)
+
+
+class DispenserError(Exception):
+    pass
+
+
+def checksum(body):
+    value = 0
+    for byte in body.encode():
+        value ^= byte
+    return f"{value:02X}"
+
+
+def open_serial(port, baudrate):
+    # pyserial is imported here so that importing the app doesn't pay for it until a dispenser is used.
+    import serial
+
+    return serial.Serial(port, baudrate, timeout=0.01)
+
+
+def encode_frame(*fields):
+    """Builds a "$<fields>*<xor checksum>\\n" frame, e.g. $D,7,3,2*4A."""
+    body = ",".join(str(field) for field in fields)
+    return f"${body}*{checksum(body)}\n".encode()
+
+
+def decode_frame(line):
+    """Returns the comma-separated fields of a frame, or None if it is malformed or fails its checksum."""
+    line = line.strip()
+    if isinstance(line, bytes):
+        line = line.decode(errors="replace")
+    if not line.startswith("$") or "*" not in line:
+        return None
+    body, _, received = line[1:].rpartition("*")
+    if checksum(body) != received.upper():
+        return None
+    return body.split(",")
+
+
+class DispenserLink:
+    """Keeps one serial connection to the Arduino open and pipelines dispense commands over it.
+
+    Commands are "$D,<seq>,<container>,<quantity>*<cs>". The Arduino answers each one with
+    "$A,<seq>*<cs>" once it has dispensed, or "$N,<seq>,<reason>*<cs>" if it can't. A dedicated
+    I/O thread owns the port: it keeps up to `window` commands in flight, matches replies by
+    sequence id and resolves the Future returned by submit(). The firmware works through its
+    commands one at a time, so each command is given `timeout` seconds past the deadline of the
+    one queued ahead of it rather than past the moment it was written. Commands that see no reply
+    by their deadline are resent once and then failed, so the firmware must answer a repeated
+    sequence id with the earlier reply rather than dispensing again.
+    """
+
+    def __init__(self, port, baudrate=115200, timeout=5.0, window=8, retries=1, serial_factory=None):
+        self.port = port
+        self.baudrate = baudrate
+        self.timeout = timeout
+        self.window = window
+        self.retries = retries
+        self.serial_factory = serial_factory or (lambda: open_serial(port, baudrate))
+        self._commands = queue.Queue()
+        self._seq = itertools.count(random.randrange(65535))
+        self._in_flight = {}
+        self._serial = None
+        self._buffer = b""
+        self._thread = None
+        self._stopped = threading.Event()
+        self._start_lock = threading.Lock()
+
+    def start(self):
+        with self._start_lock:
+            if self._thread is not None:
+                return
+            self._stopped.clear()
+            self._thread = threading.Thread(target=self._run, name="dispenser-io", daemon=True)
+            self._thread.start()
+
+    def submit(self, container, quantity):
+        self.start()
+        future = Future()
+        seq = next(self._seq) % 65535 + 1
+        self._commands.put((seq, int(container), int(quantity), future))
+        return future
+
+    def dispense(self, items):
+        """Queues (container, quantity) pairs back to back; returns their futures in order."""
+        return [self.submit(container, quantity) for container, quantity in items]
+
+    def _open(self):
+        if self._serial is None:
+            self._serial = self.serial_factory()
+            self._buffer = b""
+        return self._serial
+
+    def _fail_all(self, error):
+        for entry in self._in_flight.values():
+            entry[3].set_exception(error)
+        self._in_flight.clear()
+
+    def _send(self, seq, entry):
+        self._open().write(encode_frame("D", seq, entry[0], entry[1]))
+        # It waits behind every other command in flight, whose deadlines already allow for theirs.
+        ahead = max((other[2] for other in self._in_flight.values() if other is not entry), default=0.0)
+        entry[2] = max(time.monotonic(), ahead) + self.timeout
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                self._fill()
+                if self._in_flight:
+                    self._read()
+                    self._expire()
+            except Exception as e:
+                # Usually a serial.SerialException (an OSError), but a missing pyserial, a bad port
+                # setting or a bug must not kill the thread either: every later future would hang.
+                log.error("dispenser link error", extra={"port": self.port, "error": str(e)},
+                          exc_info=not isinstance(e, OSError))
+                self._fail_all(DispenserError(str(e)))
+                self._close_port()
+                self._drain(DispenserError(str(e)))
+                self._stopped.wait(1)
+        self._close_port()
+        self._fail_all(DispenserError("Dispenser link closed"))
+        self._drain(DispenserError("Dispenser link closed"))
+
+    def _fill(self):
+        while len(self._in_flight) < self.window:
+            try:
+                if self._in_flight:
+                    seq, container, quantity, future = self._commands.get_nowait()
+                else:
+                    seq, container, quantity, future = self._commands.get(timeout=0.5)
+            except queue.Empty:
+                return
+            if not future.set_running_or_notify_cancel():
+                continue
+            entry = [container, quantity, 0.0, future, 0]
+            self._in_flight[seq] = entry
+            self._send(seq, entry)
+
+    def _read(self):
+        port = self._serial
+        chunk = port.read(port.in_waiting or 1)
+        if not chunk:
+            return
+        self._buffer += chunk
+        *lines, self._buffer = self._buffer.split(b"\n")
+        for line in lines:
+            fields = decode_frame(line)
+            if not fields or len(fields) < 2 or not fields[1].isdigit():
+                continue
+            entry = self._in_flight.pop(int(fields[1]), None)
+            if entry is None:
+                continue
+            if fields[0] == "A":
+                entry[3].set_result(True)
+            else:
+                reason = fields[2] if len(fields) > 2 else "rejected"
+                entry[3].set_exception(DispenserError(f"Container {entry[0]}: {reason}"))
+
+    def _expire(self):
+        now = time.monotonic()
+        for seq, entry in list(self._in_flight.items()):
+            if entry[2] > now:
+                continue
+            if entry[4] < self.retries:
+                entry[4] += 1
+                self._send(seq, entry)
+            else:
+                del self._in_flight[seq]
+                entry[3].set_exception(DispenserError(f"Container {entry[0]}: no reply from dispenser"))
+
+    def _drain(self, error):
+        while True:
+            try:
+                future = self._commands.get_nowait()[3]
+            except queue.Empty:
+                return
+            if future.set_running_or_notify_cancel():
+                future.set_exception(error)
+
+    def _close_port(self):
+        if self._serial is not None:
+            try:
+                self._serial.close()
+            except Exception:
+                pass
+            self._serial = None
+
+    def close(self, timeout=5):
+        with self._start_lock:
+            if self._thread is None:
+                return
+            self._stopped.set()
+            self._thread.join(timeout)
+            self._thread = None
+
+
+class DispenseQueue:
+    """Dispense requests handed from any worker process to the one that owns the serial ports, in SQLite.
+
+    Only the scheduler leader opens a dispenser's port: two processes on one port would read
+    each other's replies. /dispense on any worker put()s a (patient, slot) request here, and the
+    leader, once it has called start(handle), takes every waiting request each `interval`
+    seconds (at once for requests put in its own process) and calls handle(patient_id, slot).
+    A request older than max_age when the leader gets to it, e.g. one put while no worker was
+    leader, is dropped rather than dispensed late.
+
+    The same file carries a schedule version, so the leader's scheduler hears about edits made on
+    the other workers: schedule_changed() bumps it, and the leader calls on_schedule_changed()
+    when it sees it move, on the same pass that takes the requests.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS dispense_requests (
+            id INTEGER PRIMARY KEY,
+            patient_id TEXT NOT NULL,
+            slot TEXT NOT NULL,
+            queued_at REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS schedule_version (
+            id INTEGER PRIMARY KEY CHECK (id = 0),
+            version INTEGER NOT NULL
+        );
+        INSERT OR IGNORE INTO schedule_version (id, version) VALUES (0, 0);
+    """
+
+    def __init__(self, path, interval=0.5, max_age=300):
+        self.path = path
+        self.interval = interval
+        self.max_age = max_age
+        self._handle = None
+        self._on_schedule_changed = None
+        self._schedule_version = None
+        self._wake = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def _connect(self):
+        return sqlite_connection(self.path, self.SCHEMA)
+
+    def put(self, patient_id, slot):
+        self._connect().execute("INSERT INTO dispense_requests (patient_id, slot, queued_at) VALUES (?, ?, ?)",
+                                (patient_id, slot.isoformat(timespec="minutes"), time.time()))
+        self._wake.set()
+
+    def take(self):
+        """Removes every waiting request; returns the (patient id, slot) of those still fresh enough, oldest first."""
+        rows = self._connect().execute(
+            "DELETE FROM dispense_requests RETURNING id, patient_id, slot, queued_at").fetchall()
+        now = time.time()
+        requests = []
+        for _, patient_id, slot, queued_at in sorted(rows):
+            if now - queued_at > self.max_age:
+                log.warning("dropping stale dispense request", extra={"patient": patient_id, "slot": slot})
+                continue
+            requests.append((patient_id, datetime.fromisoformat(slot)))
+        return requests
+
+    def schedule_changed(self):
+        """Tells the leader, whichever process it is in, that a schedule was edited."""
+        self._connect().execute("UPDATE schedule_version SET version = version + 1 WHERE id = 0")
+        self._wake.set()
+
+    def schedule_version(self):
+        return self._connect().execute("SELECT version FROM schedule_version WHERE id = 0").fetchone()[0]
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            try:
+                version = self.schedule_version()
+                if version != self._schedule_version:
+                    self._schedule_version = version
+                    self._on_schedule_changed()
+                requests = self.take()
+            except Exception:
+                log.exception("error reading dispense requests")
+                continue
+            for patient_id, slot in requests:
+                try:
+                    self._handle(patient_id, slot)
+                except Exception:
+                    log.exception("error handling dispense request", extra={"patient": patient_id})
+
+    def start(self, handle, on_schedule_changed=lambda: None):
+        if self._thread is not None:
+            return
+        self._handle = handle
+        self._on_schedule_changed = on_schedule_changed
+        self._schedule_version = self.schedule_version()
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name="dispense-requests", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=5):
+        self._stopped.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
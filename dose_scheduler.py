@@ -0,0 +1,143 @@
+import logging
+import threading
+import time
+from bisect import bisect_right
+from datetime import datetime, timedelta
+
+from metrics import SCHEDULER_LAG, SCHEDULER_TICK
+
+log = logging.getLogger(__name__)
+
+
+class SystemClock:
+    def now(self):
+        return datetime.now()
+
+
+def _at(day, hhmm):
+    hour, minute = hhmm.split(":")
+    return datetime.combine(day, datetime.min.time()).replace(hour=int(hour), minute=int(minute))
+
+
+class DoseScheduler:
+    """Sleeps until the next scheduled dose instead of polling every minute.
+
+    times() returns the sorted "HH:MM" slots (ScheduleStore.times) and fire(slot) is called once
+    per slot with the slot's datetime. Call rearm() whenever the schedule changes.
+
+    Every wake fires each slot in (last run, now], so a wake that comes late still fires the doses
+    it overslept, as long as they are within catch_up; older ones are reported to on_missed instead.
+    rearm() has to be called for edits made in other processes too; the app does it through
+    DispenseQueue's schedule version. The sleep is still capped at max_sleep (288 wakes a day at
+    the default) so clock jumps and hand edits of data.xlsx are picked up. on_run(last_run) is
+    called after every wake so the position can be saved and handed to another process's
+    scheduler (by setting its last_run) if this one dies.
+    """
+
+    def __init__(self, times, fire, clock=None, catch_up=timedelta(minutes=30),
+                 max_sleep=timedelta(minutes=5), on_missed=None, on_run=None, record_metrics=True):
+        self.times = times
+        self.fire = fire
+        self.clock = clock or SystemClock()
+        self.catch_up = catch_up
+        self.max_sleep = max_sleep
+        self.on_missed = on_missed
+        self.on_run = on_run
+        self.record_metrics = record_metrics
+        self.last_run = None
+        self._cond = threading.Condition()
+        self._rearmed = False
+        self._stopped = False
+        self._thread = None
+
+    def next_fire(self, after):
+        """Returns the first slot strictly after the given datetime, or None if nothing is scheduled."""
+        times = self.times() or ()
+        if not times:
+            return None
+        i = bisect_right(times, after.strftime("%H:%M"))
+        if i < len(times):
+            return _at(after.date(), times[i])
+        return _at(after.date() + timedelta(days=1), times[0])
+
+    def slots_between(self, start, end):
+        """Returns every slot datetime in (start, end]."""
+        times = self.times() or ()
+        slots = []
+        day = start.date()
+        while day <= end.date():
+            # Slots have whole minutes, so comparing "HH:MM" strings is enough to find the window.
+            lo = bisect_right(times, start.strftime("%H:%M")) if day == start.date() else 0
+            hi = bisect_right(times, end.strftime("%H:%M")) if day == end.date() else len(times)
+            slots.extend(_at(day, hhmm) for hhmm in times[lo:hi])
+            day += timedelta(days=1)
+        return slots
+
+    def run_pending(self, now=None):
+        """Fires every slot that came due since the last run; returns the fired slots."""
+        now = now or self.clock.now()
+        if self.last_run is None:
+            self.last_run = now
+            return []
+        start = max(self.last_run, now - timedelta(days=1))
+        fired = []
+        for slot in self.slots_between(start, now):
+            if now - slot > self.catch_up:
+                if self.on_missed:
+                    self.on_missed(slot)
+                continue
+            started = time.perf_counter()
+            try:
+                self.fire(slot)
+            except Exception:
+                log.exception("error firing scheduled dose", extra={"slot": slot.isoformat()})
+            if self.record_metrics:
+                SCHEDULER_LAG.observe(max(0.0, (now - slot).total_seconds()))
+                SCHEDULER_TICK.observe(time.perf_counter() - started)
+            fired.append(slot)
+        self.last_run = now
+        return fired
+
+    def seconds_until_next(self, now=None):
+        now = now or self.clock.now()
+        limit = self.max_sleep.total_seconds()
+        next_slot = self.next_fire(self.last_run or now)
+        if next_slot is None:
+            return limit
+        return min(max(0.0, (next_slot - now).total_seconds()), limit)
+
+    def rearm(self):
+        with self._cond:
+            self._rearmed = True
+            self._cond.notify_all()
+
+    def _run(self):
+        while True:
+            self.run_pending()
+            if self.on_run:
+                try:
+                    self.on_run(self.last_run)
+                except Exception:
+                    log.exception("error saving scheduler state")
+            delay = self.seconds_until_next()
+            with self._cond:
+                if not self._rearmed and not self._stopped:
+                    self._cond.wait(delay)
+                self._rearmed = False
+                if self._stopped:
+                    return
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, name="dose-scheduler", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=5):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
@@ -0,0 +1,373 @@
+import json
+import logging
+import math
+import threading
+import time
+from datetime import datetime
+
+from storage import sqlite_connection
+
+log = logging.getLogger(__name__)
+
+
+class Timer:
+    __slots__ = ("deadline", "tick", "callback", "args", "_bucket")
+
+    def __init__(self, deadline, tick, callback, args):
+        self.deadline = deadline
+        self.tick = tick
+        self.callback = callback
+        self.args = args
+        self._bucket = None
+
+    @property
+    def active(self):
+        return self._bucket is not None
+
+
+class TimingWheel:
+    """A hashed timing wheel: each timer is filed under the tick it expires on, modulo `size`.
+
+    schedule() and cancel() are a dict insert and delete, and advance() only looks at the buckets
+    for the ticks that have passed, so the cost of a tick doesn't grow with the number of pending
+    timers. Timers fire on the first advance() at or after their deadline, at most one resolution
+    late. A bucket only holds timers from later turns of the wheel if they are more than
+    size * resolution seconds out (68 minutes by default); those are skipped until their turn.
+    """
+
+    def __init__(self, resolution=1.0, size=4096, clock=time.monotonic):
+        self.resolution = resolution
+        self.size = size
+        self.clock = clock
+        self._buckets = [{} for _ in range(size)]
+        self._origin = clock()
+        self._tick = 0
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self._count
+
+    def schedule(self, delay, callback, *args):
+        """Calls callback(*args) once `delay` seconds have passed; returns a Timer for cancel()."""
+        with self._lock:
+            deadline = self.clock() + delay
+            tick = max(self._tick, math.ceil((deadline - self._origin) / self.resolution))
+            timer = Timer(deadline, tick, callback, args)
+            timer._bucket = self._buckets[tick % self.size]
+            timer._bucket[timer] = None
+            self._count += 1
+        return timer
+
+    def cancel(self, timer):
+        """Stops a pending timer; returns False if it already fired or was cancelled."""
+        with self._lock:
+            if timer._bucket is None:
+                return False
+            del timer._bucket[timer]
+            timer._bucket = None
+            self._count -= 1
+        return True
+
+    def advance(self, now=None):
+        """Fires every timer that is due by now (default: the clock); returns how many fired."""
+        now = self.clock() if now is None else now
+        expired = []
+        with self._lock:
+            while self._origin + self._tick * self.resolution <= now:
+                if not self._count:
+                    # Nothing pending: jump straight to the current tick.
+                    self._tick = max(self._tick, math.floor((now - self._origin) / self.resolution) + 1)
+                    break
+                bucket = self._buckets[self._tick % self.size]
+                if bucket:
+                    for timer in [timer for timer in bucket if timer.tick <= self._tick]:
+                        del bucket[timer]
+                        timer._bucket = None
+                        self._count -= 1
+                        expired.append(timer)
+                self._tick += 1
+        for timer in expired:
+            try:
+                timer.callback(*timer.args)
+            except Exception:
+                log.exception("error in timer callback")
+        return len(expired)
+
+
+def dose_id(patient_id, slot):
+    """Names one patient's dose at one slot; the same slot always gets the same id."""
+    return f"{patient_id}@{slot:%Y-%m-%dT%H:%M}"
+
+
+def dose_slot(dose):
+    """The slot a dose id names, or None if it isn't one."""
+    try:
+        return datetime.strptime(dose.rpartition("@")[2], "%Y-%m-%dT%H:%M")
+    except ValueError:
+        return None
+
+
+class DoseLedger:
+    """Which fired doses are still waiting on the patient, in SQLite shared by every worker process.
+
+    Only the leader runs escalation chains, but /taken_medication can land on any worker: it
+    closes the dose here, and the leader checks the ledger before each step it sends. A dose is
+    open from the moment it fires until it is acknowledged or its chain runs out; closed rows are
+    kept for `keep` seconds, so a catch-up re-fire of the same slot doesn't start it over. Each
+    open dose also keeps its meds and how many steps were sent, so a new leader can pick up
+    the chains the last one was running (see EscalationEngine.resume).
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS doses (
+            dose TEXT PRIMARY KEY,
+            patient_id TEXT NOT NULL,
+            fired_at INTEGER NOT NULL,
+            closed_at INTEGER,
+            step INTEGER NOT NULL DEFAULT 0,
+            meds TEXT NOT NULL DEFAULT '[]'
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS doses_open ON doses (patient_id) WHERE closed_at IS NULL;
+    """
+
+    def __init__(self, path, keep=7 * 86400):
+        self.path = path
+        self.keep = keep
+        self._pruned = 0
+
+    @classmethod
+    def _set_up(cls, conn):
+        conn.executescript(cls.SCHEMA)
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(doses)")}
+        if "step" not in columns:
+            conn.execute("ALTER TABLE doses ADD COLUMN step INTEGER NOT NULL DEFAULT 0")
+        if "meds" not in columns:
+            conn.execute("ALTER TABLE doses ADD COLUMN meds TEXT NOT NULL DEFAULT '[]'")
+
+    def _connect(self):
+        return sqlite_connection(self.path, self._set_up)
+
+    def open(self, dose, patient_id, meds=()):
+        """Records a dose that just fired; returns False if it was already closed."""
+        now = int(time.time())
+        conn = self._connect()
+        if now - self._pruned >= 3600:
+            self._pruned = now
+            conn.execute("DELETE FROM doses WHERE fired_at < ?", (now - self.keep,))
+        conn.execute("INSERT OR IGNORE INTO doses (dose, patient_id, fired_at, meds) VALUES (?, ?, ?, ?)",
+                     (dose, patient_id, now, json.dumps(list(meds))))
+        return self.is_open(dose)
+
+    def is_open(self, dose):
+        return self._connect().execute(
+            "SELECT 1 FROM doses WHERE dose = ? AND closed_at IS NULL", (dose,)).fetchone() is not None
+
+    def advance(self, dose, step):
+        """Notes that a dose's chain has sent `step` steps; returns False if the dose is no longer open."""
+        return self._connect().execute(
+            "UPDATE doses SET step = ? WHERE dose = ? AND closed_at IS NULL RETURNING dose",
+            (step, dose)).fetchone() is not None
+
+    def close(self, dose):
+        """Closes one dose; returns False if it wasn't open."""
+        return self._connect().execute(
+            "UPDATE doses SET closed_at = ? WHERE dose = ? AND closed_at IS NULL RETURNING dose",
+            (int(time.time()), dose)).fetchone() is not None
+
+    def close_patient(self, patient_id):
+        """Closes every open dose of one patient; returns their ids."""
+        return [row[0] for row in self._connect().execute(
+            "UPDATE doses SET closed_at = ? WHERE patient_id = ? AND closed_at IS NULL RETURNING dose",
+            (int(time.time()), patient_id)).fetchall()]
+
+    def open_doses(self, patient_id):
+        return [row[0] for row in self._connect().execute(
+            "SELECT dose FROM doses WHERE patient_id = ? AND closed_at IS NULL ORDER BY dose", (patient_id,))]
+
+    def all_open(self):
+        """(dose, patient id, fired at, steps sent, [meds]) for every open dose of every patient."""
+        return [(dose, patient_id, fired_at, step, json.loads(meds)) for dose, patient_id, fired_at, step, meds in
+                self._connect().execute(
+                    "SELECT dose, patient_id, fired_at, step, meds FROM doses WHERE closed_at IS NULL ORDER BY dose")]
+
+
+class PendingDose:
+    __slots__ = ("id", "patient_id", "slot", "meds", "step", "timer")
+
+    def __init__(self, dose, patient_id, slot, meds):
+        self.id = dose
+        self.patient_id = patient_id
+        self.slot = slot
+        self.meds = meds
+        self.step = 0
+        self.timer = None
+
+
+class EscalationEngine:
+    """Tracks fired doses until they are acknowledged and escalates the ones that are not.
+
+    steps is a sequence of (minutes after the dose fired, name); on_step(dose, name) is called for
+    each step the dose reaches without being acknowledged, and does the actual notifying. Only
+    the dose's next step is ever on the wheel, so acknowledge() is a dict pop and one cancel.
+
+    With a DoseLedger the chains still run in this process, but which doses are pending is
+    decided by the ledger: acknowledge() from any process closes the dose there, and a chain
+    whose dose was closed elsewhere stops at its next step.
+    """
+
+    def __init__(self, steps, on_step, wheel=None, ledger=None):
+        self.steps = [(minutes * 60, name) for minutes, name in sorted(steps)]
+        self.on_step = on_step
+        self.wheel = wheel if wheel is not None else TimingWheel()
+        self.ledger = ledger
+        self._pending = {}
+        self._by_patient = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def __len__(self):
+        return len(self._pending)
+
+    def set_steps(self, steps):
+        """Changes the escalation steps; doses already escalating take the new timings from their next step on."""
+        with self._lock:
+            self.steps = [(minutes * 60, name) for minutes, name in sorted(steps)]
+
+    def track(self, patient_id, slot, meds):
+        """Starts the escalation chain for a dose that just fired; returns its dose id.
+
+        Firing the same slot again (a catch-up after a restart) keeps the chain already running,
+        or, with a ledger, doesn't restart one whose dose was already closed.
+        """
+        dose = dose_id(patient_id, slot)
+        with self._lock:
+            if dose in self._pending or not self.steps:
+                return dose
+        if self.ledger is not None and not self.ledger.open(dose, patient_id, meds):
+            return dose
+        with self._lock:
+            if dose in self._pending:
+                return dose
+            pending = self._pending[dose] = PendingDose(dose, patient_id, slot, list(meds))
+            self._by_patient.setdefault(patient_id, {})[dose] = None
+            pending.timer = self.wheel.schedule(self.steps[0][0], self._escalate, pending)
+        return dose
+
+    def acknowledge(self, dose):
+        """Stops the chain for a dose; returns False if it was not pending."""
+        with self._lock:
+            pending = self._pending.pop(dose, None)
+            if pending is not None:
+                self._forget(pending)
+        if pending is not None:
+            self.wheel.cancel(pending.timer)
+        if self.ledger is not None:
+            return self.ledger.close(dose)
+        return pending is not None
+
+    def acknowledge_patient(self, patient_id):
+        """Acknowledges every pending dose of one patient; returns their ids."""
+        if self.ledger is None:
+            return [dose for dose in self.pending(patient_id) if self.acknowledge(dose)]
+        doses = self.ledger.close_patient(patient_id)
+        for dose in doses:
+            with self._lock:
+                pending = self._pending.pop(dose, None)
+                if pending is not None:
+                    self._forget(pending)
+            if pending is not None:
+                self.wheel.cancel(pending.timer)
+        return doses
+
+    def resume(self):
+        """Re-arms the chain of every dose the ledger has open that this engine isn't running, e.g.
+        after becoming the leader when the last one died; returns how many were re-armed.
+
+        Each chain picks up where it should be by now: of the steps that came due while nobody was
+        running it, only the latest is sent, at once, and the rest follow on their schedule.
+        """
+        if self.ledger is None:
+            return 0
+        now = time.time()
+        resumed = 0
+        for dose, patient_id, fired_at, sent, meds in self.ledger.all_open():
+            slot = dose_slot(dose)
+            if slot is None:
+                continue
+            elapsed = now - fired_at
+            with self._lock:
+                if dose in self._pending or not self.steps:
+                    continue
+                overdue = sum(1 for offset, _ in self.steps if offset <= elapsed)
+                step = max(sent, overdue - 1)
+                if step < len(self.steps):
+                    pending = self._pending[dose] = PendingDose(dose, patient_id, slot, meds)
+                    pending.step = step
+                    self._by_patient.setdefault(patient_id, {})[dose] = None
+                    delay = max(0.0, self.steps[step][0] - elapsed)
+                    pending.timer = self.wheel.schedule(delay, self._escalate, pending)
+                    resumed += 1
+                    continue
+            # Every step was already sent (the steps were shortened since): the chain is over.
+            self.ledger.close(dose)
+        if resumed:
+            log.info("resumed escalation chains", extra={"doses": resumed})
+        return resumed
+
+    def pending(self, patient_id):
+        if self.ledger is not None:
+            return self.ledger.open_doses(patient_id)
+        with self._lock:
+            return list(self._by_patient.get(patient_id, ()))
+
+    def _forget(self, pending):
+        doses = self._by_patient.get(pending.patient_id)
+        if doses is not None:
+            doses.pop(pending.id, None)
+            if not doses:
+                del self._by_patient[pending.patient_id]
+
+    def _escalate(self, pending):
+        with self._lock:
+            if self._pending.get(pending.id) is not pending:
+                return
+            if pending.step >= len(self.steps):
+                # The steps were shortened while this dose was waiting.
+                del self._pending[pending.id]
+                self._forget(pending)
+                return
+            offset, name = self.steps[pending.step]
+            pending.step += 1
+            if pending.step < len(self.steps):
+                pending.timer = self.wheel.schedule(self.steps[pending.step][0] - offset, self._escalate, pending)
+            else:
+                del self._pending[pending.id]
+                self._forget(pending)
+        if self.ledger is not None:
+            # Acknowledged in another process since the last step; the last step closes the dose itself.
+            last = pending.step >= len(self.steps)
+            if not (self.ledger.close(pending.id) if last else self.ledger.advance(pending.id, pending.step)):
+                if not last:
+                    self.acknowledge(pending.id)
+                return
+        log.info("escalating unacknowledged dose", extra={"dose": pending.id, "step": name})
+        self.on_step(pending, name)
+
+    def _run(self):
+        while not self._stopped.wait(self.wheel.resolution):
+            self.wheel.advance()
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name="escalation", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=5):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
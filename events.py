@@ -0,0 +1,216 @@
+import itertools
+import json
+import logging
+import threading
+import time
+from collections import deque
+
+from storage import sqlite_connection
+
+log = logging.getLogger(__name__)
+
+PATIENT = "patient"
+CAREGIVER = "caregiver"
+EVERYONE = (PATIENT, CAREGIVER)
+
+
+class Event:
+    __slots__ = ("id", "kind", "data", "audience", "patient", "created")
+
+    def __init__(self, event_id, kind, data, audience, patient=None):
+        self.id = event_id
+        self.kind = kind
+        self.data = data
+        self.audience = audience
+        self.patient = patient
+        self.created = time.time()
+
+    def visible_to(self, role, patient):
+        if role not in self.audience:
+            return False
+        return role != PATIENT or self.patient is None or self.patient == patient
+
+    def to_sse(self):
+        return f"id: {self.id}\nevent: {self.kind}\ndata: {json.dumps(self.data)}\n\n"
+
+
+class EventLog:
+    """Recent events in SQLite, shared by every worker process.
+
+    Events are numbered by the table's AUTOINCREMENT id, so ids are the same in every process
+    and a client can reconnect to any worker with its Last-Event-ID. Rows older than `keep`
+    seconds are pruned as new ones are added.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS events (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            data TEXT NOT NULL,
+            audience TEXT NOT NULL,
+            patient TEXT,
+            created REAL NOT NULL
+        );
+    """
+
+    def __init__(self, path, keep=3600):
+        self.path = path
+        self.keep = keep
+        self._pruned = 0
+
+    def _connect(self):
+        return sqlite_connection(self.path, self.SCHEMA)
+
+    def append(self, kind, data, audience, patient=None):
+        """Adds an event; returns its id."""
+        now = time.time()
+        conn = self._connect()
+        if now - self._pruned >= 60:
+            self._pruned = now
+            conn.execute("DELETE FROM events WHERE created < ?", (now - self.keep,))
+        return conn.execute(
+            "INSERT INTO events (kind, data, audience, patient, created) VALUES (?, ?, ?, ?, ?) RETURNING id",
+            (kind, json.dumps(data), ",".join(audience), patient, now)).fetchone()[0]
+
+    def last_id(self):
+        return self._connect().execute("SELECT COALESCE(MAX(id), 0) FROM events").fetchone()[0]
+
+    def after(self, last_id, limit=500):
+        """The events with ids above last_id, oldest first."""
+        rows = self._connect().execute(
+            "SELECT id, kind, data, audience, patient FROM events WHERE id > ? ORDER BY id LIMIT ?",
+            (last_id, limit)).fetchall()
+        return [Event(event_id, kind, json.loads(data), tuple(audience.split(",")), patient)
+                for event_id, kind, data, audience, patient in rows]
+
+
+class EventBus:
+    """Publish/subscribe over a ring buffer of recent events.
+
+    Subscribers don't get their own queue or thread: they all wait on one condition and read
+    whatever is newer than the last id they saw, so an idle subscriber is just a parked wait.
+    A reconnecting client can pass its Last-Event-ID and replay anything still in the buffer.
+
+    On its own the bus only reaches subscribers in this process. With an EventLog, publish()
+    writes the event there instead, and start() runs a relay thread that copies new events from
+    the log into the buffer every `interval` seconds (at once for this process's own events),
+    so subscribers on every worker see what any worker published.
+    """
+
+    def __init__(self, capacity=256, log=None, interval=0.5):
+        self._cond = threading.Condition()
+        self._events = deque(maxlen=capacity)
+        self._ids = itertools.count(1)
+        self._last_id = 0
+        self.log = log
+        self.interval = interval
+        self._wake = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    @property
+    def last_id(self):
+        with self._cond:
+            return self._last_id
+
+    def publish(self, kind, data, audience=EVERYONE, patient=None):
+        """Publishes an event; with a patient id, patient-role subscribers only see their own patient's events."""
+        if self.log is not None:
+            event_id = self.log.append(kind, data, audience, patient)
+            self._wake.set()
+            return event_id
+        with self._cond:
+            event = Event(next(self._ids), kind, data, audience, patient)
+            self._add(event)
+        return event.id
+
+    def _add(self, event):
+        self._events.append(event)
+        self._last_id = event.id
+        self._cond.notify_all()
+
+    def relay(self):
+        """Copies the events published since the last relay from the log; returns how many."""
+        events = self.log.after(self.last_id)
+        if events:
+            with self._cond:
+                for event in events:
+                    self._add(event)
+        return len(events)
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            try:
+                self.relay()
+            except Exception:
+                log.exception("error relaying events")
+
+    def start(self):
+        if self.log is None or self._thread is not None:
+            return
+        with self._cond:
+            self._last_id = max(self._last_id, self.log.last_id() - self._events.maxlen)
+        # Load the latest events first, so a client that reconnects to a worker that has just
+        # started can still replay what it missed.
+        while self.relay():
+            pass
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name="event-relay", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=5):
+        self._stopped.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def _after(self, last_id):
+        newer = []
+        for event in reversed(self._events):
+            if event.id <= last_id:
+                break
+            newer.append(event)
+        newer.reverse()
+        return newer
+
+    def listen(self, role, last_id=None, heartbeat=15, patient=None):
+        """Yields events for role (and patient) as they are published, and None every heartbeat seconds of silence."""
+        with self._cond:
+            if last_id is None or last_id > self._last_id:
+                last_id = self._last_id
+        while True:
+            with self._cond:
+                events = self._after(last_id)
+                if not events:
+                    self._cond.wait(heartbeat)
+                    events = self._after(last_id)
+            if not events:
+                yield None
+                continue
+            for event in events:
+                last_id = event.id
+                if event.visible_to(role, patient):
+                    yield event
+
+
+def sse_stream(bus, role, last_id=None, heartbeat=15, patient=None):
+    yield "retry: 5000\n\n"
+    for event in bus.listen(role, last_id, heartbeat, patient):
+        yield ": keepalive\n\n" if event is None else event.to_sse()
+
+
+def sse_response(bus, session, last_id=None):
+    """The /events response for a logged-in session: its role's (and patient's) events after last_id."""
+    # Flask is imported here so the simulator, which uses EventBus, can be imported without it.
+    from flask import Response
+
+    if last_id is None:
+        last_id = bus.last_id
+    return Response(
+        sse_stream(bus, session.get('user_role'), last_id, patient=session.get('patient_id')),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
@@ -0,0 +1,35 @@
+"""The /events server, run beside wsgi.py:
+
+    gunicorn --config gunicorn_events.conf.py events_wsgi:app
+
+Every logged-in page keeps an /events stream open for as long as it is open. On the app's
+threaded workers each stream would hold a thread, so a few dozen tabs would leave none for the
+other routes. Here each stream is a gevent greenlet parked on the EventBus, so one worker holds
+thousands of them. The app's workers publish to events.db (EventLog) and this server relays from
+it; it reads the app's config and secret key, so the app's session cookie logs the page in here too.
+"""
+import atexit
+
+from flask import Flask, jsonify, request, session
+
+from events import EventBus, EventLog, sse_response
+from settings import CONFIG_FILE, ConfigStore, legacy_settings, secret_key
+
+settings = ConfigStore(CONFIG_FILE, legacy_settings).current()
+
+app = Flask(__name__, static_folder=None)
+app.secret_key = secret_key(settings.secret_key_file)
+
+bus = EventBus(log=EventLog(settings.events_path))
+
+
+@app.route('/events')
+def events():
+    if not session.get('logged_in'):
+        return jsonify(error="forbidden"), 403
+    return sse_response(bus, session, request.headers.get('Last-Event-ID', type=int))
+
+
+# gunicorn imports this module in each worker after forking it, so the relay thread is the worker's own.
+bus.start()
+atexit.register(bus.stop)
@@ -0,0 +1,9 @@
+# gunicorn settings for the /events server (events_wsgi.py); the proxy sends /events here (see wsgi.py).
+bind = "127.0.0.1:5001"
+worker_class = "gevent"
+workers = 1
+# Open streams (one per logged-in tab) each worker will hold.
+worker_connections = 2000
+# Streams never finish by themselves, so a restart would always wait out the whole graceful
+# timeout; pages reconnect on their own (the stream sends "retry: 5000").
+graceful_timeout = 5
@@ -0,0 +1,233 @@
+import logging
+import math
+import time
+from datetime import timedelta
+from itertools import chain
+from operator import itemgetter
+
+from recurrence import parse_rule
+from storage import sqlite_connection
+
+log = logging.getLogger(__name__)
+
+_numpy = None
+
+
+def numpy():
+    """numpy, imported on first use like the other heavy dependencies, or None if it isn't installed."""
+    global _numpy
+    if _numpy is None:
+        try:
+            import numpy as np
+        except ImportError:
+            log.warning("numpy is not installed; refill forecasts fall back to a per-container Python loop")
+            np = False
+        _numpy = np
+    return _numpy or None
+
+
+class Inventory:
+    """Pills left in each (patient, container), in SQLite.
+
+    A container is tracked from its first refill(); take() from one that never was is a no-op.
+    Each take() is a single UPDATE, so concurrent dispenses from the same container, in any
+    thread or worker process, never lose a decrement. The containers already reported as
+    running low are kept per day, so each one is alerted at most once a day.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS stock (
+            patient_id TEXT NOT NULL,
+            container INTEGER NOT NULL,
+            count INTEGER NOT NULL,
+            refilled_at INTEGER NOT NULL,
+            PRIMARY KEY (patient_id, container)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS low_stock_alerts (
+            day TEXT NOT NULL,
+            patient_id TEXT NOT NULL,
+            container INTEGER NOT NULL,
+            PRIMARY KEY (day, patient_id, container)
+        ) WITHOUT ROWID;
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def _connect(self):
+        return sqlite_connection(self.path, self.SCHEMA)
+
+    def take(self, patient_id, container, quantity):
+        """Takes quantity pills out of a container; returns how many are left, or None if it isn't tracked."""
+        row = self._connect().execute(
+            "UPDATE stock SET count = MAX(count - ?, 0) WHERE patient_id = ? AND container = ? RETURNING count",
+            (quantity, patient_id, container),
+        ).fetchone()
+        return None if row is None else row[0]
+
+    def refill(self, patient_id, container, count):
+        """Sets a container's count, starting to track it if it wasn't."""
+        self._connect().execute(
+            "INSERT INTO stock (patient_id, container, count, refilled_at) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT (patient_id, container) DO UPDATE SET count = excluded.count, refilled_at = excluded.refilled_at",
+            (patient_id, container, count, int(time.time())),
+        )
+
+    def claim_alerts(self, day, containers):
+        """Marks (patient id, container) pairs as alerted on a day; returns the ones that weren't yet.
+
+        Days before `day` are forgotten.
+        """
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("DELETE FROM low_stock_alerts WHERE day < ?", (day.isoformat(),))
+            claimed = [key for key in containers if conn.execute(
+                "INSERT OR IGNORE INTO low_stock_alerts (day, patient_id, container) VALUES (?, ?, ?) RETURNING 1",
+                (day.isoformat(), *key)).fetchone()]
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return claimed
+
+    def release_alerts(self, day, containers):
+        """Undoes claim_alerts() for an alert that could not be sent after all."""
+        self._connect().executemany(
+            "DELETE FROM low_stock_alerts WHERE day = ? AND patient_id = ? AND container = ?",
+            [(day.isoformat(), *key) for key in containers])
+
+    def levels(self, patient_id=None):
+        """(patient id, container, count) for every tracked container, or one patient's, in that order."""
+        if patient_id is None:
+            return self._connect().execute("SELECT patient_id, container, count FROM stock ORDER BY 1, 2").fetchall()
+        return self._connect().execute(
+            "SELECT patient_id, container, count FROM stock WHERE patient_id = ? ORDER BY 2", (patient_id,)
+        ).fetchall()
+
+
+class Forecast:
+    """The projection for each tracked container: parallel sequences (NumPy arrays when available)."""
+
+    def __init__(self, day, patients, containers, counts, per_day, days_left):
+        self.day = day
+        self.patients = patients
+        self.containers = containers
+        self.counts = counts
+        self.per_day = per_day
+        self.days_left = days_left
+
+    def __len__(self):
+        return len(self.patients)
+
+    def low(self, days):
+        """Indexes of the containers that run out in fewer than `days` days."""
+        if hasattr(self.days_left, "nonzero"):
+            return (self.days_left < days).nonzero()[0].tolist()
+        return [i for i, left in enumerate(self.days_left) if left < days]
+
+    def row(self, i):
+        left = float(self.days_left[i])
+        return {
+            "patient": str(self.patients[i]),
+            "container": int(self.containers[i]),
+            "count": int(self.counts[i]),
+            "per_day": round(float(self.per_day[i]), 2),
+            "days_left": None if math.isinf(left) else round(left, 1),
+            "runs_out": None if math.isinf(left) else (self.day + timedelta(days=math.floor(left))).isoformat(),
+        }
+
+
+class Forecaster:
+    """Projects when every tracked container runs out, at the schedule's average daily use.
+
+    Each schedule is boiled down to (container, pills a day) per med once per version of the
+    store and day; forecast() then joins those with the stock levels of every patient and
+    divides, as a handful of array operations over all the containers at once. Without NumPy
+    the same join is done with a dict.
+    """
+
+    def __init__(self, vectorized=True):
+        self.vectorized = vectorized
+        self._usage = {}
+        self._arrays = None
+
+    def usage(self, patient_id, store, day):
+        """([container], [pills a day]) for a patient's schedule, one entry per med."""
+        key = (store.version(), day)
+        cached = self._usage.get(patient_id)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+        containers, rates = [], []
+        for record in store.records() or ():
+            rule = parse_rule(record.time)
+            try:
+                container, amount = int(record.container), int(record.amount)
+            except (TypeError, ValueError):
+                continue
+            if rule is not None and container > 0:
+                containers.append(container)
+                rates.append(amount * rule.per_day(day))
+        self._usage[patient_id] = (key, (containers, rates))
+        return containers, rates
+
+    def forecast(self, levels, stores, day):
+        """levels are Inventory.levels() rows, in its order (by patient); stores maps patient id to
+        ScheduleStore. Returns a Forecast."""
+        usage = {patient_id: self.usage(patient_id, store, day) for patient_id, store in stores.items()}
+        if not levels:
+            return Forecast(day, [], [], [], [], [])
+        np = numpy() if self.vectorized else None
+        if np is None:
+            return self._forecast_dict(levels, usage, day)
+
+        patients = np.asarray(list(map(itemgetter(0), levels)))
+        containers = np.fromiter(map(itemgetter(1), levels), np.int64, len(levels))
+        counts = np.fromiter(map(itemgetter(2), levels), np.int64, len(levels))
+        # levels come sorted by patient, so each patient's rows are one run: number the runs.
+        starts = np.flatnonzero(np.concatenate(([True], patients[1:] != patients[:-1])))
+        level_patients = np.repeat(np.arange(len(starts)), np.diff(np.append(starts, len(levels))))
+        index = {name: i for i, name in enumerate(patients[starts].tolist())}
+        owners, use_containers, use_rates = self._usage_arrays(np, usage)
+        # Which of the levels' patients each med belongs to, or -1 if none of theirs is tracked.
+        use_patients = np.asarray([index.get(patient_id, -1) for patient_id in usage], dtype=np.int64)[owners]
+
+        # Number each (patient, container) pair as patient index * width + container, on both sides.
+        width = max(containers.max(), use_containers.max(initial=0)) + 1
+        level_keys = level_patients * width + containers
+        use_keys = use_patients * width + use_containers
+        # Then add up each tracked container's meds; untracked ones are dropped.
+        order = np.argsort(level_keys)
+        slot = np.searchsorted(level_keys, use_keys, sorter=order).clip(max=len(order) - 1)
+        tracked = (use_patients >= 0) & (level_keys[order[slot]] == use_keys)
+        per_day = np.bincount(order[slot[tracked]], weights=use_rates[tracked], minlength=len(counts))
+
+        days_left = np.full(len(counts), np.inf)
+        np.divide(counts, per_day, out=days_left, where=per_day > 0)
+        return Forecast(day, patients, containers, counts, per_day, days_left)
+
+    def _usage_arrays(self, np, usage):
+        """Every patient's usage lists concatenated, as (owner: index into usage, container, pills a day)
+        arrays; rebuilt only when one of the lists changed."""
+        entries = list(usage.values())
+        if self._arrays is not None and len(self._arrays[0]) == len(entries) and \
+                all(a is b for a, b in zip(self._arrays[0], entries)):
+            return self._arrays[1]
+        lengths = [len(rates) for _, rates in entries]
+        arrays = (
+            np.repeat(np.arange(len(entries)), lengths),
+            np.fromiter(chain.from_iterable(containers for containers, _ in entries), np.int64, sum(lengths)),
+            np.fromiter(chain.from_iterable(rates for _, rates in entries), np.float64, sum(lengths)),
+        )
+        self._arrays = (entries, arrays)
+        return arrays
+
+    def _forecast_dict(self, levels, usage, day):
+        totals = {}
+        for patient_id, (containers, rates) in usage.items():
+            for container, rate in zip(containers, rates):
+                totals[patient_id, container] = totals.get((patient_id, container), 0.0) + rate
+        patients, containers, counts = (list(map(itemgetter(i), levels)) for i in range(3))
+        per_day = [totals.get(key, 0.0) for key in zip(patients, containers)]
+        days_left = [count / rate if rate > 0 else math.inf for count, rate in zip(counts, per_day)]
+        return Forecast(day, patients, containers, counts, per_day, days_left)
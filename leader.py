@@ -0,0 +1,116 @@
+import logging
+import os
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
+log = logging.getLogger(__name__)
+
+
+class LeaderLock:
+    """An exclusive, non-blocking lock on a file, shared by every worker process on the machine.
+
+    The operating system drops the lock when the holder exits or crashes, which is what lets a
+    standby worker take over. The holder can also leave a short piece of state in the file for
+    whoever holds it next.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._fd = None
+
+    @property
+    def held(self):
+        return self._fd is not None
+
+    def acquire(self):
+        if self._fd is not None:
+            return True
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if fcntl:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            else:
+                msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+        except OSError:
+            os.close(fd)
+            return False
+        self._fd = fd
+        return True
+
+    def read(self):
+        """Returns the state the last holder wrote, or "" if there is none."""
+        os.lseek(self._fd, 0, os.SEEK_SET)
+        return os.read(self._fd, 4096).decode(errors="replace").strip()
+
+    def write(self, state):
+        os.lseek(self._fd, 0, os.SEEK_SET)
+        os.ftruncate(self._fd, 0)
+        os.write(self._fd, state.encode())
+
+    def release(self):
+        if self._fd is None:
+            return
+        try:
+            if fcntl:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+            else:
+                os.lseek(self._fd, 0, os.SEEK_SET)
+                msvcrt.locking(self._fd, msvcrt.LK_UNLCK, 1)
+        finally:
+            os.close(self._fd)
+            self._fd = None
+
+
+class LeaderElection:
+    """Calls on_elected() in whichever process holds the lock.
+
+    The others retry every interval seconds, so when the leader goes away one of them is
+    elected within that time. stop() calls on_resigned() before letting the lock go.
+    """
+
+    def __init__(self, lock, on_elected, on_resigned=None, interval=5.0):
+        self.lock = lock
+        self.on_elected = on_elected
+        self.on_resigned = on_resigned
+        self.interval = interval
+        self._stopped = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    @property
+    def is_leader(self):
+        return self.lock.held
+
+    def _run(self):
+        while True:
+            with self._lock:
+                if self._stopped.is_set():
+                    return
+                if not self.lock.held and self.lock.acquire():
+                    log.info("elected scheduler leader", extra={"pid": os.getpid(), "lock": self.lock.path})
+                    self.on_elected()
+            if self.lock.held or self._stopped.wait(self.interval):
+                return
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name="leader-election", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=5):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+        with self._lock:
+            if self.lock.held:
+                if self.on_resigned:
+                    self.on_resigned()
+                self.lock.release()
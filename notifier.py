@@ -0,0 +1,509 @@
+import asyncio
+import base64
+import itertools
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import NOTIFICATIONS_SUPPRESSED, PROVIDER_ERRORS, PROVIDER_LATENCY
+from settings import NOTIFICATIONAPI_URL
+from storage import sqlite_connection
+
+log = logging.getLogger(__name__)
+
+
+class QueueFull(Exception):
+    pass
+
+
+class ProviderError(Exception):
+    """A provider refused a message. Only a retryable one (a server error or throttling) is tried again."""
+
+    def __init__(self, message, retryable=True):
+        super().__init__(message)
+        self.retryable = retryable
+
+
+def retryable_status(status):
+    # A 4xx other than 429 (bad credentials, bad number, bad payload) fails the same way every time.
+    return status is None or status >= 500 or status == 429
+
+
+class TwilioCallProvider:
+    """Places voice calls through a single, long-lived Twilio client.
+
+    client() returns that client; it is only called when the first call is placed, so the Twilio
+    SDK isn't loaded by processes that never make one.
+    """
+
+    name = "twilio"
+
+    def __init__(self, client, from_number):
+        self.client = client
+        self.from_number = from_number
+
+    def call(self, to, twiml):
+        from twilio.base.exceptions import TwilioRestException
+
+        try:
+            return self.client().calls.create(twiml=twiml, to=to, from_=self.from_number).sid
+        except TwilioRestException as e:
+            raise ProviderError(f"Twilio returned {e.status}: {e.msg}", retryable=retryable_status(e.status)) from e
+
+
+class NotificationApiProvider:
+    """Sends NotificationAPI messages over one pooled HTTP session instead of a new client per send."""
+
+    name = "notificationapi"
+
+    def __init__(self, client_id, client_secret, base_url=NOTIFICATIONAPI_URL):
+        self.client_id = client_id
+        self.base_url = base_url or NOTIFICATIONAPI_URL
+        token = base64.b64encode(f"{client_id}:{client_secret}".encode()).decode()
+        self.headers = {"Authorization": f"Basic {token}"}
+        self._session = None
+
+    @property
+    def url(self):
+        return f"{self.base_url}/{self.client_id}/sender"
+
+    async def send(self, params):
+        if self._session is None:
+            # httpx is imported on the first send rather than with the module.
+            import httpx
+
+            self._session = httpx.AsyncClient(timeout=10)
+        response = await self._session.post(self.url, json=params, headers=self.headers)
+        if not 200 <= response.status_code < 300:
+            raise ProviderError(f"NotificationAPI returned {response.status_code}: {response.text}",
+                                retryable=retryable_status(response.status_code))
+        return response.status_code
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.aclose()
+            self._session = None
+
+
+def recipient_of(kind, payload):
+    if kind == "call":
+        return payload.get("to")
+    return payload.get("params", {}).get("to", {}).get("number")
+
+
+def refilled(tokens, updated, now, rate, per):
+    """A token bucket's level at now, `rate` tokens per `per` seconds having dripped in since updated."""
+    return min(rate, tokens + (now - updated) * rate / per)
+
+
+class NotificationGate:
+    """Stops repeat calls and SMS before they cost anything.
+
+    A job submitted for a slot is dropped if the same kind of message already went to the same
+    recipient for that slot within `window` seconds, whether it came from the scheduler or from
+    a manual dispense; the earlier job's id is returned in its place. On top of that, each
+    recipient gets at most `rate` messages per `per` seconds (a token bucket). Jobs admitted with
+    limited=False, such as missed-dose escalations, are still deduplicated but never rate limited
+    and don't use up tokens.
+    """
+
+    def __init__(self, window=900, rate=6, per=3600, clock=time.monotonic):
+        self.window = window
+        self.rate = rate
+        self.per = per
+        self.clock = clock
+        self._recent = OrderedDict()
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def configure(self, window, rate, per):
+        """Applies new limits in place; the dedupe history and each recipient's tokens carry over."""
+        with self._lock:
+            self.window = window
+            self.rate = rate
+            self.per = per
+
+    def _expire(self, now):
+        # Every entry lives for the same window, so insertion order is expiry order.
+        while self._recent:
+            key, (expires, _) = next(iter(self._recent.items()))
+            if expires > now:
+                return
+            del self._recent[key]
+
+    def _take(self, recipient, now):
+        tokens, updated = self._buckets.get(recipient, (self.rate, now))
+        tokens = refilled(tokens, updated, now, self.rate, self.per)
+        allowed = tokens >= 1
+        self._buckets[recipient] = (tokens - 1 if allowed else tokens, now)
+        return allowed
+
+    def admit(self, jobs, slot=None, limited=True):
+        """Returns, for each job, None if it may be sent or (reason, earlier job id) if it is suppressed."""
+        now = self.clock()
+        decisions = []
+        with self._lock:
+            self._expire(now)
+            for job in jobs:
+                recipient = recipient_of(job.kind, job.payload)
+                key = (job.kind, recipient, slot)
+                if slot is not None and key in self._recent:
+                    decisions.append(("duplicate", self._recent[key][1]))
+                elif limited and not self._take(recipient, now):
+                    decisions.append(("rate_limited", None))
+                else:
+                    if slot is not None:
+                        self._recent[key] = (now + self.window, job.id)
+                    decisions.append(None)
+        return decisions
+
+    def revoke(self, jobs, slot=None, limited=True):
+        """Undoes admit() for jobs that could not be queued after all."""
+        with self._lock:
+            for job in jobs:
+                recipient = recipient_of(job.kind, job.payload)
+                key = (job.kind, recipient, slot)
+                if key in self._recent and self._recent[key][1] == job.id:
+                    del self._recent[key]
+                if not limited:
+                    continue
+                tokens, updated = self._buckets[recipient]
+                self._buckets[recipient] = (min(self.rate, tokens + 1), updated)
+
+
+class SharedNotificationGate(NotificationGate):
+    """A NotificationGate whose dedupe claims and token buckets are in SQLite, shared by every worker process.
+
+    The leader's scheduler tick and a /dispense served by any other worker claim the same
+    (kind, recipient, slot) rows, so whichever comes second is the duplicate, and each
+    recipient has one token bucket however many workers send to them. Each admit() is one
+    transaction, so two workers can't both take a recipient's last token. The clock defaults
+    to wall time, which unlike monotonic time every process agrees on. A duplicate of a job
+    queued by another process reports no earlier job id: job ids are only known to the
+    dispatcher that queued them.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS notify_claims (
+            kind TEXT NOT NULL,
+            recipient TEXT NOT NULL,
+            slot TEXT NOT NULL,
+            job INTEGER NOT NULL,
+            pid INTEGER NOT NULL,
+            expires REAL NOT NULL,
+            PRIMARY KEY (kind, recipient, slot)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS notify_claims_expires ON notify_claims (expires);
+        CREATE TABLE IF NOT EXISTS notify_buckets (
+            recipient TEXT PRIMARY KEY,
+            tokens REAL NOT NULL,
+            updated REAL NOT NULL
+        ) WITHOUT ROWID;
+    """
+
+    def __init__(self, path, window=900, rate=6, per=3600, clock=time.time):
+        super().__init__(window, rate, per, clock)
+        self.path = path
+        self._pruned = 0
+
+    def _connect(self):
+        return sqlite_connection(self.path, self.SCHEMA)
+
+    def _transaction(self, work):
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            result = work(conn)
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return result
+
+    def _take_shared(self, conn, recipient, now, rate, per):
+        row = conn.execute("SELECT tokens, updated FROM notify_buckets WHERE recipient = ?", (recipient,)).fetchone()
+        tokens = refilled(*row, now, rate, per) if row else rate
+        allowed = tokens >= 1
+        conn.execute("INSERT OR REPLACE INTO notify_buckets (recipient, tokens, updated) VALUES (?, ?, ?)",
+                     (recipient, tokens - 1 if allowed else tokens, now))
+        return allowed
+
+    def admit(self, jobs, slot=None, limited=True):
+        now = self.clock()
+        pid = os.getpid()
+        with self._lock:
+            window, rate, per = self.window, self.rate, self.per
+
+        def work(conn):
+            if now - self._pruned >= 60:
+                self._pruned = now
+                conn.execute("DELETE FROM notify_claims WHERE expires <= ?", (now,))
+                # After `per` seconds a bucket is full again, the same as having none.
+                conn.execute("DELETE FROM notify_buckets WHERE updated < ?", (now - per,))
+            decisions = []
+            for job in jobs:
+                recipient = recipient_of(job.kind, job.payload) or ""
+                key = (job.kind, recipient, str(slot))
+                earlier = slot is not None and conn.execute(
+                    "SELECT job, pid FROM notify_claims WHERE kind = ? AND recipient = ? AND slot = ? AND expires > ?",
+                    (*key, now)).fetchone()
+                if earlier:
+                    decisions.append(("duplicate", earlier[0] if earlier[1] == pid else None))
+                elif limited and not self._take_shared(conn, recipient, now, rate, per):
+                    decisions.append(("rate_limited", None))
+                else:
+                    if slot is not None:
+                        conn.execute("INSERT OR REPLACE INTO notify_claims (kind, recipient, slot, job, pid, expires) "
+                                     "VALUES (?, ?, ?, ?, ?, ?)", (*key, job.id, pid, now + window))
+                    decisions.append(None)
+            return decisions
+
+        return self._transaction(work)
+
+    def revoke(self, jobs, slot=None, limited=True):
+        pid = os.getpid()
+        with self._lock:
+            rate = self.rate
+
+        def work(conn):
+            for job in jobs:
+                recipient = recipient_of(job.kind, job.payload) or ""
+                conn.execute("DELETE FROM notify_claims "
+                             "WHERE kind = ? AND recipient = ? AND slot = ? AND job = ? AND pid = ?",
+                             (job.kind, recipient, str(slot), job.id, pid))
+                if limited:
+                    conn.execute("UPDATE notify_buckets SET tokens = MIN(?, tokens + 1) WHERE recipient = ?",
+                                 (rate, recipient))
+
+        self._transaction(work)
+
+
+class Job:
+    __slots__ = ("id", "kind", "payload", "status", "attempts", "error", "result", "created", "finished")
+
+    def __init__(self, job_id, kind, payload):
+        self.id = job_id
+        self.kind = kind
+        self.payload = payload
+        self.status = "queued"
+        self.attempts = 0
+        self.error = None
+        self.result = None
+        self.created = time.time()
+        self.finished = None
+
+    def as_dict(self):
+        return {
+            "id": self.id,
+            "kind": self.kind,
+            "status": self.status,
+            "attempts": self.attempts,
+            "error": self.error,
+            "result": self.result,
+            "created": self.created,
+            "finished": self.finished,
+        }
+
+
+class Dispatcher:
+    """Runs outbound calls and SMS on a background event loop so callers only pay for an enqueue.
+
+    Jobs go through a bounded queue; submit() raises QueueFull rather than blocking when it is full.
+    Failed jobs are retried with exponential backoff and every job keeps a status record. With a
+    NotificationGate, duplicate and over-limit jobs are filtered out before they are queued.
+    """
+
+    def __init__(self, call_provider, sms_provider, maxsize=100, workers=4, retries=3, backoff=1.0, history=1000,
+                 gate=None):
+        self.providers = {"call": call_provider, "sms": sms_provider}
+        self.gate = gate
+        self.workers = workers
+        self.retries = retries
+        self.backoff = backoff
+        self.history = history
+        self._slots = threading.BoundedSemaphore(maxsize)
+        self._in_use = {}
+        self._retired = set()
+        self._ids = itertools.count(1)
+        self._jobs = OrderedDict()
+        self._jobs_lock = threading.Lock()
+        self._start_lock = threading.Lock()
+        self._loop = None
+        self._queue = None
+        self._thread = None
+        self._executor = None
+
+    def start(self):
+        with self._start_lock:
+            if self._thread is not None:
+                return
+            ready = threading.Event()
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="notify")
+            self._thread = threading.Thread(target=self._run, args=(ready,), name="dispatcher", daemon=True)
+            self._thread.start()
+            ready.wait()
+
+    def _run(self, ready):
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        self._queue = asyncio.Queue()
+        tasks = [self._loop.create_task(self._worker()) for _ in range(self.workers)]
+        ready.set()
+        try:
+            self._loop.run_forever()
+        finally:
+            for task in tasks:
+                task.cancel()
+            self._loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+            for provider in [*self.providers.values(), *self._retired]:
+                if hasattr(provider, "close"):
+                    self._loop.run_until_complete(provider.close())
+            self._loop.close()
+
+    def replace_provider(self, kind, provider):
+        """Swaps in a rebuilt provider for new jobs. Jobs already running (retries included) finish on
+        the old one, which is closed once the last of them is done."""
+        old = self.providers[kind]
+        self.providers = {**self.providers, kind: provider}
+        if old is not provider and hasattr(old, "close") and self._loop is not None:
+            self._loop.call_soon_threadsafe(self._retire, old)
+
+    def _retire(self, provider):
+        if self._in_use.get(provider):
+            self._retired.add(provider)
+        else:
+            self._loop.create_task(provider.close())
+
+    def submit(self, kind, slot=None, urgent=False, **payload):
+        """Queues a "call" (to, twiml) or "sms" (params) job and returns its id without waiting for it.
+
+        slot identifies the dose the message is about, for deduplication; see submit_batch().
+        """
+        return self.submit_batch([(kind, payload)], slot, urgent)[0]
+
+    def submit_batch(self, jobs, slot=None, urgent=False):
+        """Queues a list of (kind, payload) jobs with a single wake-up of the loop; returns their ids.
+
+        A job the gate suppresses as a duplicate gets the id of the earlier job for the same
+        recipient and slot; one suppressed by the rate limit gets None. Urgent jobs are exempt
+        from the rate limit. Either every other job is queued or, if there isn't room for all of
+        them, none are and QueueFull is raised.
+        """
+        for kind, _ in jobs:
+            if kind not in self.providers:
+                raise ValueError(f"Unknown notification kind: {kind}")
+        self.start()
+        candidates = [Job(next(self._ids), kind, payload) for kind, payload in jobs]
+        decisions = self.gate.admit(candidates, slot, limited=not urgent) if self.gate else [None] * len(candidates)
+        batch = [job for job, decision in zip(candidates, decisions) if decision is None]
+        acquired = 0
+        for _ in batch:
+            if not self._slots.acquire(blocking=False):
+                for _ in range(acquired):
+                    self._slots.release()
+                if self.gate:
+                    self.gate.revoke(batch, slot, limited=not urgent)
+                raise QueueFull("Notification queue is full")
+            acquired += 1
+        ids = []
+        for job, decision in zip(candidates, decisions):
+            if decision is None:
+                ids.append(job.id)
+                continue
+            reason, earlier = decision
+            NOTIFICATIONS_SUPPRESSED.inc(job.kind, reason)
+            # A duplicate was already sent; a rate-limited message is lost.
+            level = logging.WARNING if reason == "rate_limited" else logging.INFO
+            log.log(level, "notification suppressed", extra={"kind": job.kind, "recipient": recipient_of(job.kind, job.payload),
+                                                       "slot": slot, "reason": reason, "earlier_job": earlier})
+            ids.append(earlier)
+        if not batch:
+            return ids
+        with self._jobs_lock:
+            for job in batch:
+                self._jobs[job.id] = job
+            while len(self._jobs) > self.history:
+                self._jobs.popitem(last=False)
+        self._loop.call_soon_threadsafe(self._enqueue_all, batch)
+        return ids
+
+    def _enqueue_all(self, batch):
+        for job in batch:
+            self._queue.put_nowait(job)
+
+    def status(self, job_id):
+        with self._jobs_lock:
+            job = self._jobs.get(job_id)
+            return job.as_dict() if job else None
+
+    def counts(self):
+        """How many of the jobs still in the history are in each status, e.g. {"sent": 40, "retrying": 2}."""
+        with self._jobs_lock:
+            statuses = [job.status for job in self._jobs.values()]
+        counts = {}
+        for status in statuses:
+            counts[status] = counts.get(status, 0) + 1
+        return counts
+
+    async def _worker(self):
+        while True:
+            job = await self._queue.get()
+            try:
+                await self._process(job)
+            finally:
+                self._slots.release()
+
+    async def _process(self, job):
+        provider = self.providers[job.kind]
+        self._in_use[provider] = self._in_use.get(provider, 0) + 1
+        try:
+            await self._attempt(job, provider)
+        finally:
+            self._in_use[provider] -= 1
+            if not self._in_use[provider]:
+                del self._in_use[provider]
+                if provider in self._retired:
+                    self._retired.discard(provider)
+                    await provider.close()
+
+    async def _attempt(self, job, provider):
+        name = getattr(provider, "name", job.kind)
+        while True:
+            job.attempts += 1
+            job.status = "running"
+            started = time.perf_counter()
+            try:
+                if job.kind == "call":
+                    job.result = await self._loop.run_in_executor(
+                        self._executor, provider.call, job.payload["to"], job.payload["twiml"])
+                else:
+                    job.result = await provider.send(job.payload["params"])
+                PROVIDER_LATENCY.observe(time.perf_counter() - started, name)
+                job.status = "sent"
+                job.error = None
+                log.info("notification sent", extra={"job": job.id, "provider": name, "attempts": job.attempts})
+                break
+            except Exception as e:
+                PROVIDER_LATENCY.observe(time.perf_counter() - started, name)
+                PROVIDER_ERRORS.inc(name)
+                job.error = str(e)
+                if job.attempts > self.retries or not getattr(e, "retryable", True):
+                    job.status = "failed"
+                    log.error("notification failed",
+                              extra={"job": job.id, "provider": name, "attempts": job.attempts, "error": job.error})
+                    break
+                job.status = "retrying"
+                await asyncio.sleep(self.backoff * 2 ** (job.attempts - 1))
+        job.finished = time.time()
+
+    def stop(self, timeout=5):
+        with self._start_lock:
+            if self._thread is None:
+                return
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join(timeout)
+            self._executor.shutdown(wait=False)
+            self._thread = None
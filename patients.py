@@ -0,0 +1,169 @@
+import json
+import os
+import threading
+from dataclasses import dataclass, fields
+
+from schedule_store import ScheduleStore
+from storage import open_backend
+
+DEFAULT_PATIENT = "default"
+
+
+@dataclass(slots=True)
+class Patient:
+    id: str
+    name: str
+    recipient_number: str
+    care_number: str
+    arduino_port: str = ""
+    containers: int = 10
+    username: str = ""
+    password: str = ""
+    schedule: str = ""
+
+
+def load_patients(path, default):
+    """Reads patients.json (a list of Patient fields) if it exists; otherwise there is just the default patient."""
+    if not os.path.exists(path):
+        return [default]
+    names = {f.name for f in fields(Patient)}
+    with open(path) as f:
+        return [Patient(**{k: v for k, v in entry.items() if k in names}) for entry in json.load(f)]
+
+
+class PatientContext:
+    """Everything that belongs to one patient: their schedule store and, lazily, their dispenser link."""
+
+    def __init__(self, patient, store, dispenser_factory):
+        self.patient = patient
+        self.store = store
+        self._dispenser_factory = dispenser_factory
+        self._dispenser = None
+        self._lock = threading.Lock()
+
+    @property
+    def id(self):
+        return self.patient.id
+
+    @property
+    def dispenser(self):
+        if self._dispenser is None and self.patient.arduino_port:
+            with self._lock:
+                if self._dispenser is None:
+                    self._dispenser = self._dispenser_factory(self.patient.arduino_port)
+        return self._dispenser
+
+    def reset_dispenser(self):
+        """Drops the dispenser link so the next use opens one on the patient's current port."""
+        with self._lock:
+            dispenser, self._dispenser = self._dispenser, None
+        if dispenser is not None:
+            dispenser.close()
+
+    def close(self):
+        if self._dispenser is not None:
+            self._dispenser.close()
+
+
+class PatientRegistry:
+    """All patients on this server, plus a slot -> patients index so a scheduler tick only
+    touches the patients who actually have a dose due in that minute.
+
+    The index is built the first time it is needed, so creating the registry (and importing the
+    app) doesn't read any schedule.
+    """
+
+    def __init__(self, patients, storage_kind, db_path, dispenser_factory, stores=None):
+        self._contexts = {}
+        self._by_username = {}
+        self._slots = {}
+        self._patient_slots = {}
+        self._times = ()
+        self._indexed = False
+        self._lock = threading.Lock()
+        for patient in patients:
+            if stores is not None:
+                store = stores[patient.id]
+            else:
+                schedule = patient.schedule or ("data.xlsx" if patient.id == DEFAULT_PATIENT else f"schedules/{patient.id}.xlsx")
+                store = ScheduleStore(open_backend(storage_kind, schedule, db_path, patient.id))
+            context = PatientContext(patient, store, dispenser_factory)
+            self._contexts[patient.id] = context
+            if patient.username:
+                self._by_username[patient.username] = context
+            store.add_listener(lambda context=context: self._reindex(context))
+
+    def _index_all(self):
+        if self._indexed:
+            return
+        for context in self._contexts.values():
+            self._reindex(context)
+        self._indexed = True
+
+    def _reindex(self, context):
+        times = set(context.store.times() or ())
+        with self._lock:
+            for slot in self._patient_slots.get(context.id, set()) - times:
+                patients = self._slots[slot]
+                patients.discard(context.id)
+                if not patients:
+                    del self._slots[slot]
+            for slot in times:
+                self._slots.setdefault(slot, set()).add(context.id)
+            self._patient_slots[context.id] = times
+            self._times = tuple(sorted(self._slots))
+
+    def __len__(self):
+        return len(self._contexts)
+
+    def __iter__(self):
+        return iter(self._contexts.values())
+
+    def get(self, patient_id):
+        return self._contexts.get(patient_id)
+
+    def first(self):
+        return next(iter(self._contexts.values()))
+
+    def update_patient(self, patient):
+        """Swaps in new details for an existing patient, reopening their dispenser only if the port changed."""
+        context = self._contexts[patient.id]
+        with self._lock:
+            old = context.patient
+            if self._by_username.get(old.username) is context:
+                del self._by_username[old.username]
+            context.patient = patient
+            if patient.username:
+                self._by_username[patient.username] = context
+        if old.arduino_port != patient.arduino_port:
+            context.reset_dispenser()
+
+    def authenticate(self, username, password):
+        context = self._by_username.get(username)
+        if context and context.patient.password == password:
+            return context
+        return None
+
+    def times(self):
+        """Returns the sorted distinct slots across every patient."""
+        self._index_all()
+        for context in self._contexts.values():
+            context.store.version()
+        return self._times
+
+    def due_at(self, hhmm, day=None):
+        """Returns (context, records) for every patient with something due at hhmm (on `day`, if given)."""
+        self._index_all()
+        with self._lock:
+            patient_ids = sorted(self._slots.get(hhmm, ()))
+        due = []
+        for patient_id in patient_ids:
+            context = self._contexts[patient_id]
+            records = context.store.due_at(hhmm, day)
+            if records:
+                due.append((context, records))
+        return due
+
+    def close(self):
+        for context in self._contexts.values():
+            context.close()
@@ -0,0 +1,213 @@
+import heapq
+from datetime import date, datetime, time, timedelta
+from functools import lru_cache
+from itertools import takewhile
+from math import gcd
+
+WEEKDAYS = ("mon", "tue", "wed", "thu", "fri", "sat", "sun")
+DAY = 1440
+WEEK = 7 * DAY
+EXAMPLE = "08:00 every 8h mon-fri from 2026-01-05 for 14d"
+
+
+def normalize_time(value):
+    """Returns value as a zero-padded "HH:MM" string, or None if it is not a time of day."""
+    if isinstance(value, datetime):
+        value = value.time()
+    if isinstance(value, time):
+        return f"{value.hour:02d}:{value.minute:02d}"
+    if value is None:
+        return None
+    parts = str(value).strip().split(":")
+    if len(parts) not in (2, 3):
+        return None
+    try:
+        hour, minute = int(parts[0]), int(parts[1])
+    except ValueError:
+        return None
+    if not (0 <= hour < 24 and 0 <= minute < 60):
+        return None
+    return f"{hour:02d}:{minute:02d}"
+
+
+def hhmm(minute):
+    return f"{minute // 60:02d}:{minute % 60:02d}"
+
+
+class Rule:
+    """A medication's Timing, compiled: when in the day, how often, on which weekdays and dates.
+
+    The first dose is at `minute` (minutes after midnight) and they repeat every `every` minutes
+    (a day unless the rule says "every Nh"), only on `weekdays` if given, and only from `start`
+    through `end` (dates, inclusive).
+    """
+
+    __slots__ = ("minute", "every", "weekdays", "start", "end", "course", "_step", "_anchor", "_times", "_cycle")
+
+    def __init__(self, minute, every=DAY, weekdays=None, start=None, end=None, course=None):
+        self.minute = minute
+        self.every = every
+        self.weekdays = weekdays
+        self.start = start
+        self.end = end
+        self.course = course
+        self._step = timedelta(minutes=every)
+        # Without a start date, the cadence divides a day evenly, so any anchor day gives the same times.
+        self._anchor = datetime.combine(start or date(2000, 1, 3), time(minute // 60, minute % 60))
+        step = gcd(every, DAY)
+        self._times = tuple(sorted(hhmm((minute + k * step) % DAY) for k in range(DAY // step)))
+        # How many steps before the weekday pattern repeats: past that, a weekday filter never matches.
+        self._cycle = WEEK // gcd(every, WEEK)
+
+    @property
+    def text(self):
+        parts = [hhmm(self.minute)]
+        if self.every != DAY:
+            parts.append(f"every {self.every // 60}h")
+        if self.weekdays is not None:
+            parts.append(",".join(WEEKDAYS[day] for day in sorted(self.weekdays)))
+        if self.start:
+            parts.append(f"from {self.start.isoformat()}")
+        if self.course:
+            parts.append(f"for {self.course}d")
+        elif self.end:
+            parts.append(f"until {self.end.isoformat()}")
+        return " ".join(parts)
+
+    def times(self):
+        """Every "HH:MM" this rule can ever fall on, sorted."""
+        return self._times
+
+    def per_day(self, day):
+        """The average number of doses a day from `day` on: 0 before the rule starts or once it has ended."""
+        if (self.start and day < self.start) or (self.end and day > self.end):
+            return 0.0
+        rate = DAY / self.every
+        if self.weekdays is not None:
+            rate *= len(self.weekdays) / 7
+        return rate
+
+    def occurs_at(self, when):
+        """Whether a dose falls exactly at `when` (a whole-minute datetime)."""
+        day = when.date()
+        if (self.start and when < self._anchor) or (self.end and day > self.end):
+            return False
+        if self.weekdays is not None and day.weekday() not in self.weekdays:
+            return False
+        return (when - self._anchor) % self._step == timedelta(0)
+
+    def occurrences(self, start):
+        """Yields every dose time at or after `start`, in order; forever, if the rule has no end date."""
+        if self.start and start < self._anchor:
+            start = self._anchor
+        when = self._anchor - ((self._anchor - start) // self._step) * self._step
+        last = datetime.combine(self.end, time.max) if self.end else None
+        skipped = 0
+        while last is None or when <= last:
+            if self.weekdays is None or when.weekday() in self.weekdays:
+                skipped = 0
+                yield when
+            else:
+                skipped += 1
+                if skipped > self._cycle:
+                    return
+            when += self._step
+
+
+def _weekdays(token):
+    days = set()
+    for part in token.split(","):
+        first, _, last = part.partition("-")
+        if first not in WEEKDAYS or (last and last not in WEEKDAYS):
+            return None
+        day, stop = WEEKDAYS.index(first), WEEKDAYS.index(last or first)
+        days.add(day)
+        while day != stop:
+            day = (day + 1) % 7
+            days.add(day)
+    return frozenset(days)
+
+
+def _count(tokens, suffix):
+    """Reads "8h" / "8 h" / "8 hours" (suffix "h") or "14d" / "14 days" (suffix "d") off the front of tokens."""
+    token = tokens.pop(0) if tokens else ""
+    if token.endswith(suffix) and token[:-1].isdigit():
+        return int(token[:-1])
+    if token.isdigit() and tokens and tokens[0] in (suffix, {"h": "hours", "d": "days"}[suffix]):
+        tokens.pop(0)
+        return int(token)
+    return None
+
+
+@lru_cache(maxsize=4096)
+def _parse(text):
+    tokens = text.lower().replace(" ,", ",").replace(", ", ",").split()
+    minute = normalize_time(tokens.pop(0)) if tokens else None
+    if minute is None:
+        return None
+    minute = int(minute[:2]) * 60 + int(minute[3:])
+    every, weekdays, start, end, course = DAY, None, None, None, None
+    while tokens:
+        token = tokens.pop(0)
+        try:
+            if token == "daily":
+                continue
+            if token == "every":
+                hours = _count(tokens, "h")
+                if not hours:
+                    return None
+                every = hours * 60
+            elif token == "from":
+                start = date.fromisoformat(tokens.pop(0))
+            elif token in ("until", "to"):
+                end = date.fromisoformat(tokens.pop(0))
+            elif token == "for":
+                course = _count(tokens, "d")
+                if not course:
+                    return None
+            else:
+                weekdays = _weekdays(token)
+                if not weekdays:
+                    return None
+        except (IndexError, ValueError):
+            return None
+    if course:
+        if start is None:
+            return None
+        end = start + timedelta(days=course - 1)
+    # An interval that doesn't divide a day needs a start date to count from.
+    if DAY % every and start is None:
+        return None
+    if start and end and end < start:
+        return None
+    return Rule(minute, every, weekdays, start, end, course)
+
+
+def parse_rule(value):
+    """Compiles a Timing cell into a Rule, or returns None if it isn't one.
+
+    A plain time ("08:00", or a time/datetime cell) is a daily dose, as before. After the time
+    can come, in any order: "every Nh", weekdays ("mon,wed,fri" or "mon-fri"), "from
+    YYYY-MM-DD", "until YYYY-MM-DD" and "for N days" (a course starting on the from date).
+    """
+    if isinstance(value, (datetime, time)):
+        value = normalize_time(value)
+    if value is None:
+        return None
+    return _parse(str(value).strip())
+
+
+def due_between(entries, start, end):
+    """Yields (when, item) for every dose from start through end, in time order.
+
+    entries are (rule, item) pairs. Each rule's occurrences are generated lazily and
+    heapq.merge holds just the next one per rule, so the work is one step per rule plus one per
+    dose actually in the window.
+    """
+    def stream(i, rule, item):
+        for when in takewhile(lambda when: when <= end, rule.occurrences(start)):
+            yield when, i, item
+
+    streams = [stream(i, rule, item) for i, (rule, item) in enumerate(entries)]
+    for when, _, item in heapq.merge(*streams):
+        yield when, item
@@ -0,0 +1,390 @@
+import itertools
+import threading
+from bisect import bisect_left, insort
+from dataclasses import dataclass
+from datetime import datetime, time, timedelta
+
+from recurrence import due_between, normalize_time, parse_rule
+
+
+@dataclass(slots=True)
+class MedRecord:
+    time: object
+    name: str
+    amount: object
+    container: object
+
+    def as_row(self):
+        return (self.time, self.name, self.amount, self.container)
+
+
+class TimeIndex:
+    """Buckets records under every "HH:MM" their recurrence rule can fall on, keeping the times sorted.
+
+    Each record's Timing is compiled into a Rule once, when it is added; at() and between() then
+    only check the rules of records that can be due in the window asked about.
+    """
+
+    def __init__(self, records=()):
+        self._by_time = {}
+        self._times = []
+        self._rules = {}
+        for record in records:
+            self.add(record)
+
+    def add(self, record):
+        rule = parse_rule(record.time)
+        if rule is None:
+            return
+        self._rules[id(record)] = (rule, record)
+        for key in rule.times():
+            bucket = self._by_time.get(key)
+            if bucket is None:
+                self._by_time[key] = [record]
+                insort(self._times, key)
+            else:
+                bucket.append(record)
+
+    def remove(self, record):
+        entry = self._rules.pop(id(record), None)
+        if entry is None:
+            return
+        for key in entry[0].times():
+            bucket = self._by_time.get(key)
+            if not bucket:
+                continue
+            for i, existing in enumerate(bucket):
+                if existing is record:
+                    del bucket[i]
+                    break
+            if not bucket:
+                del self._by_time[key]
+                del self._times[bisect_left(self._times, key)]
+
+    def at(self, hhmm, day=None):
+        """Returns the records due at this time of day: on `day` if given, else on any day."""
+        records = self._by_time.get(normalize_time(hhmm), ())
+        if day is None or not records:
+            return tuple(records)
+        hhmm = normalize_time(hhmm)
+        when = datetime.combine(day, time(int(hhmm[:2]), int(hhmm[3:])))
+        return tuple(record for record in records if self._rules[id(record)][0].occurs_at(when))
+
+    def times(self):
+        return tuple(self._times)
+
+    def between(self, start, end):
+        """Yields (when, record) for every dose from start through end, in time order."""
+        if end - start < timedelta(days=1):
+            # A short window: only records bucketed under one of its minutes can be due in it.
+            seen = {}
+            minute = start.replace(second=0, microsecond=0)
+            while minute <= end:
+                for record in self._by_time.get(f"{minute.hour:02d}:{minute.minute:02d}", ()):
+                    seen.setdefault(id(record), self._rules[id(record)])
+                minute += timedelta(minutes=1)
+            entries = seen.values()
+        else:
+            entries = self._rules.values()
+        return due_between(list(entries), start, end)
+
+    def near(self, now, window):
+        """Returns the records due within window of now, across midnight too."""
+        return tuple(record for _, record in self.between(now - window, now + window))
+
+
+def container_number(value):
+    """Returns the container as an int, or None if it is blank or not a number."""
+    text = str(value).strip() if value is not None else ""
+    return int(text) if text.isdigit() else None
+
+
+class NameIndex:
+    """Maps medication names to their records and keeps a bitmap of the containers in use.
+
+    Both are updated in place as records come and go, so lookups by name and the free
+    container list don't depend on how long the schedule is.
+    """
+
+    def __init__(self, records=()):
+        self._by_name = {}
+        self._container_counts = {}
+        self._used = 0
+        for record in records:
+            self.add(record)
+
+    def _count_container(self, record, delta):
+        number = container_number(record.container)
+        if number is None:
+            return
+        count = self._container_counts.get(number, 0) + delta
+        if count > 0:
+            self._container_counts[number] = count
+            self._used |= 1 << number
+        else:
+            self._container_counts.pop(number, None)
+            self._used &= ~(1 << number)
+
+    def add(self, record):
+        self._by_name.setdefault(record.name, []).append(record)
+        self._count_container(record, 1)
+
+    def remove(self, record):
+        bucket = self._by_name.get(record.name)
+        if not bucket:
+            return
+        for i, existing in enumerate(bucket):
+            if existing is record:
+                del bucket[i]
+                break
+        else:
+            return
+        if not bucket:
+            del self._by_name[record.name]
+        self._count_container(record, -1)
+
+    def replace(self, old, new, records):
+        """Swaps new in for old, keeping records that share a name in schedule order."""
+        bucket = self._by_name.get(old.name)
+        if old.name == new.name and bucket:
+            for i, existing in enumerate(bucket):
+                if existing is old:
+                    bucket[i] = new
+                    self._count_container(old, -1)
+                    self._count_container(new, 1)
+                    return
+        self.remove(old)
+        self.add(new)
+        if len(self._by_name[new.name]) > 1:
+            # Renamed onto a name that already exists: only then is the row's position needed.
+            self._by_name[new.name] = [record for record in records if record.name == new.name]
+
+    def find(self, name):
+        bucket = self._by_name.get(name)
+        return bucket[0] if bucket else None
+
+    def used_containers(self):
+        """Returns the bitmap of containers in use: bit n is set while container n holds something."""
+        return self._used
+
+    def free_containers(self, count):
+        """Returns the containers 1..count that nothing is scheduled from."""
+        used = self._used
+        return [n for n in range(1, count + 1) if not used >> n & 1]
+
+
+class ScheduleStore:
+    """Keeps the medication schedule in memory and re-reads the backend only when its version changes.
+
+    The backend is one of the classes in storage.py; writes go through it and are then
+    applied to the in-memory records and index without a full reload. The records live in an
+    insertion-ordered dict keyed by a sequence number, with a record -> key map beside it, so an
+    add, edit or delete is a few dict operations whatever the schedule's length. The tuple that
+    records() and page() hand out is rebuilt from it at most once per change, when first asked for.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+        self._lock = threading.RLock()
+        self._stamp = None
+        self._rows = {}
+        self._keys = {}
+        self._next_key = itertools.count()
+        self._records = ()
+        self._index = TimeIndex()
+        self._names = NameIndex()
+        self._name_list = None
+        self._listeners = []
+
+    def add_listener(self, callback):
+        """Registers callback() to be called after the schedule changes, whether through this store or on disk."""
+        self._listeners.append(callback)
+
+    def _changed(self):
+        for callback in self._listeners:
+            callback()
+
+    def _refresh(self):
+        stamp = self.backend.version()
+        if stamp is None:
+            return False
+        if stamp != self._stamp:
+            reloaded = self._stamp is not None
+            records = tuple(self.backend.load())
+            self._rows = dict(enumerate(records))
+            self._keys = {id(record): key for key, record in self._rows.items()}
+            self._next_key = itertools.count(len(records))
+            self._records = records
+            self._index = TimeIndex(records)
+            self._names = NameIndex(records)
+            self._name_list = None
+            self._stamp = stamp
+            if reloaded:
+                self._changed()
+        return True
+
+    def records(self):
+        """Returns the current schedule, or None if the workbook is missing."""
+        with self._lock:
+            if not self._refresh():
+                return None
+            return self._snapshot()
+
+    def _snapshot(self):
+        if self._records is None:
+            self._records = tuple(self._rows.values())
+        return self._records
+
+    def due_at(self, hhmm, day=None):
+        """Returns the records due at the given time of day (on `day`, if given), or None if the workbook is missing."""
+        with self._lock:
+            if not self._refresh():
+                return None
+            return self._index.at(hhmm, day)
+
+    def due_between(self, start, end):
+        """Returns [(when, record)] for every dose from start through end in time order, or None if the workbook is missing."""
+        with self._lock:
+            if not self._refresh():
+                return None
+            return list(self._index.between(start, end))
+
+    def times(self):
+        """Returns the distinct scheduled times as sorted "HH:MM" strings, or None if the workbook is missing."""
+        with self._lock:
+            if not self._refresh():
+                return None
+            return self._index.times()
+
+    def due_near(self, now, window=timedelta(minutes=5)):
+        """Returns the records due within window of now, or None if the workbook is missing."""
+        with self._lock:
+            if not self._refresh():
+                return None
+            return self._index.near(now, window)
+
+    def version(self):
+        """Returns a short string that changes whenever the schedule does, or None if the workbook is missing."""
+        with self._lock:
+            if not self._refresh():
+                return None
+            stamp = self._stamp
+            return "-".join(str(part) for part in stamp) if isinstance(stamp, tuple) else str(stamp)
+
+    def find(self, name):
+        """Returns the first record with this name, or None if there isn't one or the workbook is missing."""
+        with self._lock:
+            if not self._refresh():
+                return None
+            return self._names.find(name)
+
+    def names(self):
+        """Returns every medication name in schedule order, or None if the workbook is missing."""
+        with self._lock:
+            if not self._refresh():
+                return None
+            if self._name_list is None:
+                self._name_list = tuple(record.name for record in self._rows.values())
+            return self._name_list
+
+    def free_containers(self, count):
+        """Returns the containers 1..count with nothing scheduled from them, or None if the workbook is missing."""
+        with self._lock:
+            if not self._refresh():
+                return None
+            return self._names.free_containers(count)
+
+    def _apply(self, old, new, result):
+        change, before, after = result
+        if change is None:
+            return False
+        if before == self._stamp:
+            self._replace(old, new)
+            self._stamp = after
+        else:
+            self._stamp = None
+        self._changed()
+        return True
+
+    def _replace(self, old, new):
+        if old is not None:
+            self._index.remove(old)
+            key = self._keys.pop(id(old))
+            if new is None:
+                del self._rows[key]
+                self._names.remove(old)
+            else:
+                # Assigning to an existing key keeps the record's place in the schedule.
+                self._rows[key] = new
+                self._keys[id(new)] = key
+                self._names.replace(old, new, self._rows.values())
+        else:
+            key = next(self._next_key)
+            self._rows[key] = new
+            self._keys[id(new)] = key
+            self._names.add(new)
+        if new is not None:
+            self._index.add(new)
+        self._records = None
+        self._name_list = None
+
+    def add(self, time, name, amount, container):
+        record = MedRecord(time, name, amount, container)
+        with self._lock:
+            if not self._refresh():
+                return False
+            return self._apply(None, record, self.backend.add(record))
+
+    def update(self, name, time=None, new_name=None, amount=None, container=None):
+        with self._lock:
+            if not self._refresh():
+                return False
+            old = self.find(name)
+            result = self.backend.update(name, time=time, new_name=new_name, amount=amount, container=container)
+            return self._apply(old, result[0], result)
+
+    def delete(self, name):
+        with self._lock:
+            if not self._refresh():
+                return False
+            return self._apply(self.find(name), None, self.backend.delete(name))
+
+    def _bulk(self, result):
+        change, _, _ = result
+        if change is None:
+            return None
+        # Too many rows changed to patch the indexes; the next read reloads them once.
+        self._stamp = None
+        self._changed()
+        return change
+
+    def add_many(self, records):
+        """Appends records (any iterable) in one backend write; returns how many, or None if the workbook is missing.
+
+        If records raises part-way (see storage.validated) nothing is written.
+        """
+        with self._lock:
+            if not self._refresh():
+                return None
+            return self._bulk(self.backend.add_many(records))
+
+    def replace_all(self, records):
+        """Replaces the whole schedule in one backend write; returns the new row count, or None if the workbook is missing."""
+        with self._lock:
+            if not self._refresh():
+                return None
+            return self._bulk(self.backend.replace_all(records))
+
+    def page(self, number, size):
+        """Returns (records on 1-based page `number`, page count), or (None, 0) if the workbook is missing.
+
+        The page is a slice of the cached snapshot records() returns; the backend is only read
+        (whole) when its version has changed.
+        """
+        with self._lock:
+            if not self._refresh():
+                return None, 0
+            records = self._snapshot()
+            pages = max(1, -(-len(records) // size))
+            number = min(max(1, number), pages)
+            return records[(number - 1) * size:number * size], pages
@@ -0,0 +1,194 @@
+import json
+import logging
+import os
+import tempfile
+import threading
+from dataclasses import asdict, dataclass, fields
+
+log = logging.getLogger(__name__)
+
+CONFIG_FILE = "config.json"
+# NotificationAPI's documented US endpoint.
+NOTIFICATIONAPI_URL = "https://api.notificationapi.com"
+
+
+@dataclass(frozen=True, slots=True)
+class Settings:
+    """One immutable snapshot of the server configuration; field names are the credentials.py names, lowercased."""
+
+    login_username: str = ""
+    login_password: str = ""
+    patient_username: str = ""
+    patient_password: str = ""
+    secret_key_file: str = "secret_key.txt"
+    twilio_account_sid: str = ""
+    twilio_auth_token: str = ""
+    twilio_number: str = ""
+    recipient_number: str = ""
+    care_number: str = ""
+    arduino_port: str = ""
+    call_language: str = "English"
+    notificationapi1d: str = ""
+    notificationapi2d: str = ""
+    notificationapiid: str = ""
+    storage_backend: str = "xlsx"
+    database_path: str = "meds.db"
+    adherence_path: str = "adherence.db"
+    inventory_path: str = "inventory.db"
+    escalation_path: str = "escalations.db"
+    notify_gate_path: str = "notifications.db"
+    events_path: str = "events.db"
+    dispense_queue_path: str = "dispense.db"
+    notify_dedupe_window: int = 900
+    notify_rate_limit: int = 6
+    notify_rate_period: int = 3600
+    # Minutes after a dose fires without /taken_medication: remind, call again, tell the caregiver.
+    escalation_minutes: tuple = (10, 20, 30)
+    # Tell the caregiver when a container is projected to run out within this many days.
+    low_stock_days: int = 7
+    # Where the providers' APIs are; empty means Twilio's own default. benchmarks/harness.py points
+    # these at local stand-ins.
+    twilio_api_url: str = ""
+    notificationapi_url: str = NOTIFICATIONAPI_URL
+
+
+# Settings the running server can't swap in: the stores and the session key are opened once.
+RESTART_REQUIRED = frozenset({"storage_backend", "database_path", "adherence_path", "inventory_path",
+                              "escalation_path", "notify_gate_path", "events_path", "dispense_queue_path",
+                              "secret_key_file"})
+
+
+def from_dict(data):
+    names = {f.name for f in fields(Settings)}
+    values = {key: value for key, value in data.items() if key in names}
+    if "escalation_minutes" in values:
+        values["escalation_minutes"] = tuple(values["escalation_minutes"])
+    return Settings(**values)
+
+
+def from_module(module):
+    """Reads the UPPER_CASE names of an old credentials.py module; missing ones keep their defaults."""
+    return from_dict({f.name: getattr(module, f.name.upper()) for f in fields(Settings) if hasattr(module, f.name.upper())})
+
+
+def legacy_settings():
+    """The settings in credentials.py, for a server that hasn't saved a config.json yet."""
+    try:
+        import credentials
+    except ImportError:
+        return Settings()
+    return from_module(credentials)
+
+
+def secret_key(path):
+    """Reads the session key from path, creating it the first time.
+
+    The app's workers and the events server (events_wsgi.py) all start at once and must agree on
+    the key, so a new one is written to a temp file and linked into place: whoever links first wins
+    and everyone reads that.
+    """
+    if not os.path.exists(path):
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)))
+        try:
+            with os.fdopen(fd, "w") as f:
+                f.write(os.urandom(64).hex())
+            os.link(tmp, path)
+        except FileExistsError:
+            pass
+        finally:
+            os.unlink(tmp)
+    with open(path) as f:
+        return f.read().strip()
+
+
+def changed_fields(old, new):
+    return {f.name for f in fields(Settings) if getattr(old, f.name) != getattr(new, f.name)}
+
+
+class ConfigStore:
+    """Keeps the configuration in memory as a Settings snapshot and swaps it whole when config.json changes.
+
+    save() writes a temp file and renames it over config.json, so a reader sees either the old file
+    or the new one, never half of it. Every process notices the new file on its next refresh() (a
+    stat, like ScheduleStore's version check) and calls the listeners with (old, new) settings.
+    Until config.json exists, the settings come from fallback(), e.g. the old credentials.py.
+    """
+
+    def __init__(self, path, fallback=Settings):
+        self.path = path
+        self.fallback = fallback
+        self._lock = threading.Lock()
+        self._stamp = None
+        self._settings = None
+        self._listeners = []
+
+    def add_listener(self, callback):
+        """Registers callback(old, new) to be called after the settings change, whether through this store or on disk."""
+        self._listeners.append(callback)
+
+    def _version(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        # os.replace gives the file a new inode, so a save is seen even within the mtime resolution.
+        return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+    def _swap(self, settings, stamp):
+        old = self._settings
+        self._settings = settings
+        self._stamp = stamp
+        if old is not None and old != settings:
+            for callback in self._listeners:
+                try:
+                    callback(old, settings)
+                except Exception:
+                    log.exception("error applying configuration change")
+
+    def current(self):
+        """Returns the settings in effect. It is a single immutable object, so callers that hold on to it
+        see one consistent configuration even if a save lands meanwhile."""
+        if self._settings is None:
+            return self.refresh()
+        return self._settings
+
+    def refresh(self):
+        """Re-reads config.json if it changed on disk; returns the settings in effect."""
+        stamp = self._version()
+        if stamp == self._stamp and self._settings is not None:
+            return self._settings
+        with self._lock:
+            if stamp != self._stamp or self._settings is None:
+                if stamp is None:
+                    settings = self.fallback()
+                else:
+                    try:
+                        with open(self.path) as f:
+                            settings = from_dict(json.load(f))
+                    except (OSError, ValueError, TypeError) as e:
+                        # A hand edit gone wrong: keep running on the last good settings.
+                        log.error("ignoring unreadable config file", extra={"path": self.path, "error": str(e)})
+                        settings = self._settings or self.fallback()
+                self._swap(settings, stamp)
+            return self._settings
+
+    def save(self, settings):
+        """Writes settings to config.json atomically and makes them current; returns the names of the fields that changed."""
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, temp_path = tempfile.mkstemp(prefix=".config-", suffix=".json", dir=directory)
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(asdict(settings), f, indent=2)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_path, self.path)
+        except BaseException:
+            try:
+                os.unlink(temp_path)
+            except FileNotFoundError:
+                pass
+            raise
+        with self._lock:
+            old = self._settings or settings
+            self._swap(settings, self._version())
+        return changed_fields(old, settings)
@@ -0,0 +1,188 @@
+import itertools
+import random
+import statistics
+import time
+from concurrent.futures import Future
+from dataclasses import asdict, dataclass, field, replace
+from datetime import datetime, timedelta
+
+from dispenser import DispenserError
+from dose_scheduler import DoseScheduler
+from events import EventBus
+from notifier import Job, NotificationGate
+from patients import PatientRegistry
+from schedule_store import ScheduleStore
+from storage import MemoryBackend
+
+PERIODS = {"day": timedelta(days=1), "week": timedelta(weeks=1), "month": timedelta(days=30)}
+# Stands in for every patient's arduino_port, so PatientContext hands out the fake dispenser.
+SIMULATED_PORT = "simulated"
+
+
+class VirtualClock:
+    """A clock the simulation moves forward by hand; it only changes when it is told to."""
+
+    def __init__(self, start):
+        self.current = start
+
+    def now(self):
+        return self.current
+
+    def timestamp(self):
+        return self.current.timestamp()
+
+
+class FakeDispenser:
+    """Acknowledges every command at once, or fails a seeded random fraction of them."""
+
+    def __init__(self, fail_rate=0.0, seed=0):
+        self.fail_rate = fail_rate
+        self.rng = random.Random(seed)
+        self.dispensed = 0
+        self.failed = 0
+
+    def submit(self, container, quantity):
+        container, quantity = int(container), int(quantity)
+        future = Future()
+        if self.fail_rate and self.rng.random() < self.fail_rate:
+            self.failed += 1
+            future.set_exception(DispenserError(f"Container {container}: simulated failure"))
+        else:
+            self.dispensed += 1
+            future.set_result(True)
+        return future
+
+    def close(self):
+        pass
+
+
+class RecordingNotifier:
+    """Stands in for notifier.Dispatcher: jobs go through the same gate but are only counted."""
+
+    def __init__(self, gate=None):
+        self.gate = gate
+        self.sent = {"call": 0, "sms": 0}
+        self.suppressed = {}
+        self._ids = itertools.count(1)
+
+    def submit(self, kind, slot=None, urgent=False, **payload):
+        return self.submit_batch([(kind, payload)], slot, urgent)[0]
+
+    def submit_batch(self, jobs, slot=None, urgent=False):
+        batch = [Job(next(self._ids), kind, payload) for kind, payload in jobs]
+        decisions = self.gate.admit(batch, slot, limited=not urgent) if self.gate else [None] * len(batch)
+        ids = []
+        for job, decision in zip(batch, decisions):
+            if decision is None:
+                self.sent[job.kind] += 1
+                ids.append(job.id)
+            else:
+                self.suppressed[decision[0]] = self.suppressed.get(decision[0], 0) + 1
+                ids.append(decision[1])
+        return ids
+
+
+@dataclass
+class SimulationReport:
+    start: datetime
+    end: datetime
+    patients: int
+    ticks: int = 0
+    doses_fired: int = 0
+    doses_missed: int = 0
+    dispensed: int = 0
+    dispense_failures: int = 0
+    calls: int = 0
+    sms: int = 0
+    suppressed: dict = field(default_factory=dict)
+    tick_p50_ms: float = 0.0
+    tick_p99_ms: float = 0.0
+    tick_max_ms: float = 0.0
+    wall_seconds: float = 0.0
+
+    @property
+    def speedup(self):
+        return (self.end - self.start).total_seconds() / self.wall_seconds if self.wall_seconds else 0.0
+
+    def as_dict(self):
+        report = asdict(self)
+        report["start"] = self.start.isoformat(timespec="minutes")
+        report["end"] = self.end.isoformat(timespec="minutes")
+        report["speedup"] = round(self.speedup)
+        return report
+
+
+def snapshot(registry, fail_rate=0.0, seed=0):
+    """Copies every patient's current schedule into memory, with fake dispensers, so a run sees a
+    fixed schedule and never touches the real files, serial ports or live listeners.
+
+    Every patient gets the fake dispenser, including those with no arduino_port configured.
+    """
+    dispenser = FakeDispenser(fail_rate, seed)
+    contexts = list(registry)
+    stores = {context.id: ScheduleStore(MemoryBackend(context.store.records() or ())) for context in contexts}
+    patients = [replace(context.patient, arduino_port=SIMULATED_PORT) for context in contexts]
+    return PatientRegistry(patients, None, None, lambda port: dispenser, stores=stores), dispenser
+
+
+def simulate(registry, pipeline, start, end, lag=timedelta(0), fail_rate=0.0, gate_settings=None,
+             catch_up=timedelta(minutes=30), seed=0):
+    """Replays the schedule from start up to (not including) end in virtual time and returns a
+    SimulationReport. A dose due exactly at start is included, so back-to-back runs cover every
+    dose once.
+
+    pipeline(slot, registry, notifier, bus) is the app's real per-slot dispense job. The real
+    DoseScheduler decides what fires when; every wake happens `lag` after the slot it was aiming
+    for, so a lag beyond catch_up shows up as missed doses. Notifications pass through a
+    NotificationGate on the virtual clock (gate_settings are its window, rate and period) and
+    are counted rather than sent.
+    """
+    # A negative lag would never reach the next slot, and the loop below would spin forever.
+    if lag < timedelta(0):
+        raise ValueError(f"lag must not be negative: {lag}")
+    if not 0 <= fail_rate <= 1:
+        raise ValueError(f"fail_rate must be between 0 and 1: {fail_rate}")
+    sim_registry, dispenser = snapshot(registry, fail_rate, seed)
+    clock = VirtualClock(start)
+    gate = NotificationGate(*gate_settings, clock=clock.timestamp) if gate_settings else None
+    notifier = RecordingNotifier(gate)
+    bus = EventBus(capacity=16)
+    report = SimulationReport(start, end, len(sim_registry))
+    durations = []
+
+    def fire(slot):
+        began = time.perf_counter()
+        due = pipeline(slot, sim_registry, notifier, bus)
+        durations.append(time.perf_counter() - began)
+        report.doses_fired += sum(len(records) for _, records in due)
+
+    def missed(slot):
+        due = sim_registry.due_at(slot.strftime("%H:%M"), slot.date())
+        report.doses_missed += sum(len(records) for _, records in due)
+
+    scheduler = DoseScheduler(sim_registry.times, fire, clock=clock, catch_up=catch_up, on_missed=missed,
+                              record_metrics=False)
+    wall = time.perf_counter()
+    # Just before start, so that next_fire() and run_pending() include a slot due at start itself.
+    scheduler.last_run = start - timedelta(microseconds=1)
+    while True:
+        target = scheduler.next_fire(scheduler.last_run)
+        if target is None or target >= end:
+            break
+        # A late wake is cut short at the end of the run, without reaching a slot due at end itself.
+        clock.current = min(target + lag, end - timedelta(microseconds=1))
+        scheduler.run_pending(clock.current)
+    report.wall_seconds = time.perf_counter() - wall
+
+    report.ticks = len(durations)
+    report.dispensed = dispenser.dispensed
+    report.dispense_failures = dispenser.failed
+    report.calls = notifier.sent["call"]
+    report.sms = notifier.sent["sms"]
+    report.suppressed = notifier.suppressed
+    if durations:
+        durations.sort()
+        report.tick_p50_ms = statistics.median(durations) * 1000
+        report.tick_p99_ms = durations[min(len(durations) - 1, int(len(durations) * 0.99))] * 1000
+        report.tick_max_ms = durations[-1] * 1000
+    return report
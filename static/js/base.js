@@ -0,0 +1,42 @@
+// Shared by every page that extends base.html. The page passes its flash messages and the
+// logged-in user's role (empty when logged out) as data attributes on <body>.
+function showNotification(text) {
+    const notification = document.getElementById('notification');
+    notification.textContent = text;
+    notification.classList.add('show');
+
+    setTimeout(() => {
+        notification.classList.remove('show');
+    }, 3000); // Hide after 3 seconds
+}
+
+document.addEventListener('DOMContentLoaded', () => {
+    const messages = JSON.parse(document.body.dataset.flashes || '[]');
+
+    if (messages.length > 0) {
+        showNotification(messages[0]);
+    }
+});
+
+if (document.body.dataset.role) {
+    // One push connection per page; pages listen for 'medication-event' on window.
+    const medicationEvents = new EventSource('/events');
+    ['dose_due', 'dispensed', 'taken', 'dose_missed'].forEach(kind => {
+        medicationEvents.addEventListener(kind, event => {
+            const data = JSON.parse(event.data);
+            window.dispatchEvent(new CustomEvent('medication-event', { detail: { kind: kind, data: data } }));
+            if (document.body.dataset.role !== 'caregiver') {
+                return;
+            }
+            if (kind === 'taken') {
+                showNotification(`Medication taken at ${data.time}`);
+            } else if (kind === 'dose_missed') {
+                showNotification(`${data.name} has not taken the ${data.time} dose: ${data.meds.join(', ')}`);
+            } else if (kind === 'dose_due') {
+                showNotification(`Dose due at ${data.time}: ${data.meds.join(', ')}`);
+            } else {
+                showNotification(`Dispensed for ${data.time}: ${data.meds.join(', ')}`);
+            }
+        });
+    });
+}
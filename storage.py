@@ -0,0 +1,593 @@
+import csv
+import io
+import itertools
+import json
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+from bisect import insort
+
+from metrics import STORAGE_LOAD, STORAGE_SAVE
+from recurrence import EXAMPLE, hhmm, parse_rule
+from schedule_store import MedRecord
+
+log = logging.getLogger(__name__)
+
+HEADERS = ["Timing", "Name", "Quantity", "Container"]
+
+_connections = threading.local()
+_set_up = set()
+_set_up_lock = threading.Lock()
+
+
+def sqlite_connection(path, setup=None):
+    """This thread's connection to the SQLite database at path, opened on first use.
+
+    Every database the app keeps (schedules, escalations, adherence, inventory...) is opened the
+    same way: in autocommit mode, so callers BEGIN their own transactions, and in WAL mode with
+    synchronous=NORMAL, so readers in any worker process never block the writer.
+
+    setup, a schema script or a callable taking the connection, is run the first time this process
+    asks for path with it. The classes that own a database pass their schema here rather than
+    creating it in __init__, so building them (and importing the app) doesn't touch the files.
+    """
+    connections = getattr(_connections, "by_path", None)
+    if connections is None:
+        connections = _connections.by_path = {}
+    key = os.path.abspath(path)
+    conn = connections.get(key)
+    if conn is None:
+        conn = sqlite3.connect(path, timeout=30, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        connections[key] = conn
+    if setup is not None and (key, setup) not in _set_up:
+        with _set_up_lock:
+            if (key, setup) not in _set_up:
+                if callable(setup):
+                    setup(conn)
+                else:
+                    conn.executescript(setup)
+                _set_up.add((key, setup))
+    return conn
+
+
+class XlsxBackend:
+    """Reads and writes the schedule in the data.xlsx layout (Timing, Name, Quantity, Container).
+
+    Every write loads and saves the whole workbook, so writes cost O(file size).
+    Mutations return (change, version_before, version_after) so ScheduleStore can tell
+    whether anything else touched the file in between.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def version(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return (st.st_mtime_ns, st.st_size)
+
+    def load(self):
+        with STORAGE_LOAD.time("xlsx"):
+            return read_xlsx(self.path)
+
+    def _write(self, mutate):
+        with self._lock:
+            before = self.version()
+            if before is None:
+                return None, None, None
+            import openpyxl
+
+            with STORAGE_LOAD.time("xlsx"):
+                wb = openpyxl.load_workbook(self.path)
+            sheet = wb.active
+            change = mutate(sheet)
+            if change is None:
+                return None, before, before
+            headers = [cell.value for cell in sheet[1]]
+            if "Container" not in headers:
+                sheet.cell(row=1, column=5, value="Container")
+            with STORAGE_SAVE.time("xlsx"):
+                wb.save(self.path)
+            return change, before, self.version()
+
+    def _find_row(self, sheet, name):
+        for row_num in range(2, sheet.max_row + 1):
+            if sheet.cell(row=row_num, column=2).value == name:
+                return row_num
+        return None
+
+    def add(self, record):
+        def mutate(sheet):
+            sheet.append(list(record.as_row()))
+            return record
+        return self._write(mutate)
+
+    def update(self, name, time=None, new_name=None, amount=None, container=None):
+        def mutate(sheet):
+            row_num = self._find_row(sheet, name)
+            if row_num is None:
+                return None
+            for column, value in enumerate((time, new_name, amount, container), start=1):
+                if value:
+                    sheet.cell(row=row_num, column=column).value = value
+            return MedRecord(*(sheet.cell(row=row_num, column=c).value for c in range(1, 5)))
+        return self._write(mutate)
+
+    def delete(self, name):
+        def mutate(sheet):
+            row_num = self._find_row(sheet, name)
+            if row_num is None:
+                return None
+            sheet.delete_rows(row_num, 1)
+            return True
+        return self._write(mutate)
+
+    def _rewrite(self, records, keep_existing):
+        """Streams the (kept) rows and then records into a new workbook and swaps it in.
+
+        Both workbooks are opened in openpyxl's streaming modes, so memory doesn't grow with the
+        file, and the original is untouched if records raises part-way (e.g. ImportErrors).
+        """
+        import openpyxl
+
+        with self._lock:
+            before = self.version()
+            if before is None:
+                return None, None, None
+            fd, tmp = tempfile.mkstemp(suffix=".xlsx", dir=os.path.dirname(os.path.abspath(self.path)))
+            os.close(fd)
+            out = openpyxl.Workbook(write_only=True)
+            sheet = out.create_sheet()
+            try:
+                with STORAGE_SAVE.time("xlsx"):
+                    if keep_existing:
+                        wb = openpyxl.load_workbook(self.path, read_only=True)
+                        try:
+                            for row in wb.active.iter_rows(values_only=True):
+                                sheet.append(row)
+                        finally:
+                            wb.close()
+                    else:
+                        sheet.append(HEADERS)
+                    count = 0
+                    for record in records:
+                        sheet.append(list(record.as_row()))
+                        count += 1
+                    out.save(tmp)
+                os.replace(tmp, self.path)
+            except BaseException:
+                sheet.close()
+                os.unlink(tmp)
+                raise
+            return count, before, self.version()
+
+    def add_many(self, records):
+        """Appends every record in one rewrite of the workbook; returns (count, before, after)."""
+        return self._rewrite(records, keep_existing=True)
+
+    def replace_all(self, records):
+        """Replaces the whole schedule in one rewrite of the workbook."""
+        return self._rewrite(records, keep_existing=False)
+
+
+class MemoryBackend:
+    """A schedule held only in memory: a fixed snapshot for a simulation run, or a scratch schedule.
+
+    Rows are kept in an insertion-ordered dict with the keys of each name's rows beside it, so
+    writes are dict operations and cost the same at any size. Like the other backends, mutations
+    return (change, version_before, version_after).
+    """
+
+    def __init__(self, records):
+        self._rows = {}
+        self._by_name = {}
+        self._keys = itertools.count()
+        self._version = 0
+        self._lock = threading.Lock()
+        for record in records:
+            self._append(record)
+
+    def _append(self, record):
+        key = next(self._keys)
+        self._rows[key] = record
+        self._by_name.setdefault(record.name, []).append(key)
+
+    def _unname(self, name, key):
+        keys = self._by_name[name]
+        keys.remove(key)
+        if not keys:
+            del self._by_name[name]
+
+    def version(self):
+        return self._version
+
+    def load(self):
+        return list(self._rows.values())
+
+    def _write(self, mutate):
+        with self._lock:
+            before = self._version
+            change = mutate()
+            if change is None:
+                return None, before, before
+            self._version += 1
+            return change, before, self._version
+
+    def add(self, record):
+        def mutate():
+            self._append(record)
+            return record
+        return self._write(mutate)
+
+    def update(self, name, time=None, new_name=None, amount=None, container=None):
+        def mutate():
+            keys = self._by_name.get(name)
+            if not keys:
+                return None
+            key = keys[0]
+            old = self._rows[key]
+            record = MedRecord(time or old.time, new_name or old.name, amount or old.amount, container or old.container)
+            self._rows[key] = record
+            if record.name != old.name:
+                self._unname(old.name, key)
+                insort(self._by_name.setdefault(record.name, []), key)
+            return record
+        return self._write(mutate)
+
+    def delete(self, name):
+        def mutate():
+            keys = self._by_name.get(name)
+            if not keys:
+                return None
+            key = keys[0]
+            self._unname(name, key)
+            del self._rows[key]
+            return True
+        return self._write(mutate)
+
+    def add_many(self, records):
+        """Appends every record; if records raises part-way, nothing is kept."""
+        def mutate():
+            rows = list(records)
+            for record in rows:
+                self._append(record)
+            return len(rows)
+        return self._write(mutate)
+
+    def replace_all(self, records):
+        def mutate():
+            rows = list(records)
+            self._rows.clear()
+            self._by_name.clear()
+            for record in rows:
+                self._append(record)
+            return len(rows)
+        return self._write(mutate)
+
+
+class SqliteBackend:
+    """Keeps schedules in an SQLite database in WAL mode, one row per medication.
+
+    Each backend instance is scoped to one patient; all patients share the database file and,
+    per thread, one connection to it. Readers never block the writer. Each mutation is a
+    single-row statement in its own transaction, and it bumps that patient's version counter
+    so other processes can poll for changes cheaply.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS meds (
+            id INTEGER PRIMARY KEY,
+            patient_id TEXT NOT NULL DEFAULT 'default',
+            time TEXT,
+            slot TEXT,
+            name TEXT NOT NULL,
+            amount TEXT,
+            container TEXT
+        );
+        CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL);
+    """
+    INDEXES = """
+        DROP INDEX IF EXISTS meds_slot;
+        DROP INDEX IF EXISTS meds_name;
+        CREATE INDEX IF NOT EXISTS meds_patient_slot ON meds (patient_id, slot);
+        CREATE INDEX IF NOT EXISTS meds_patient_name ON meds (patient_id, name);
+    """
+
+    _initialized = set()
+    _init_lock = threading.Lock()
+
+    def __init__(self, path, patient_id="default"):
+        self.path = path
+        self.patient_id = patient_id
+        self._version_key = f"version:{patient_id}"
+        with self._init_lock:
+            if path not in self._initialized:
+                with self._connect() as conn:
+                    conn.executescript(self.SCHEMA)
+                    columns = {row[1] for row in conn.execute("PRAGMA table_info(meds)")}
+                    if "patient_id" not in columns:
+                        conn.execute("ALTER TABLE meds ADD COLUMN patient_id TEXT NOT NULL DEFAULT 'default'")
+                    conn.executescript(self.INDEXES)
+                self._initialized.add(path)
+        with self._connect() as conn:
+            conn.execute("INSERT OR IGNORE INTO meta (key, value) VALUES (?, 0)", (self._version_key,))
+
+    def _connect(self):
+        return _Transaction(sqlite_connection(self.path))
+
+    def _current_version(self, conn):
+        return conn.execute("SELECT value FROM meta WHERE key = ?", (self._version_key,)).fetchone()[0]
+
+    def version(self):
+        with self._connect() as conn:
+            return self._current_version(conn)
+
+    def is_empty(self):
+        with self._connect() as conn:
+            return conn.execute("SELECT 1 FROM meds WHERE patient_id = ? LIMIT 1", (self.patient_id,)).fetchone() is None
+
+    def load(self):
+        with STORAGE_LOAD.time("sqlite"), self._connect() as conn:
+            rows = conn.execute(
+                "SELECT time, name, amount, container FROM meds WHERE patient_id = ? ORDER BY id", (self.patient_id,)
+            ).fetchall()
+        return [MedRecord(*row) for row in rows]
+
+    def _write(self, mutate):
+        with STORAGE_SAVE.time("sqlite"), self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            before = self._current_version(conn)
+            change = mutate(conn)
+            if change is None:
+                return None, before, before
+            conn.execute("UPDATE meta SET value = value + 1 WHERE key = ?", (self._version_key,))
+            return change, before, before + 1
+
+    def _insert(self, conn, record):
+        conn.execute(
+            "INSERT INTO meds (patient_id, time, slot, name, amount, container) VALUES (?, ?, ?, ?, ?, ?)",
+            (self.patient_id, _text(record.time), _slot(record.time), record.name,
+             _text(record.amount), _text(record.container)),
+        )
+
+    def add(self, record):
+        def mutate(conn):
+            self._insert(conn, record)
+            return record
+        return self._write(mutate)
+
+    def update(self, name, time=None, new_name=None, amount=None, container=None):
+        def mutate(conn):
+            row = conn.execute(
+                "SELECT id, time, name, amount, container FROM meds WHERE patient_id = ? AND name = ? ORDER BY id LIMIT 1",
+                (self.patient_id, name),
+            ).fetchone()
+            if row is None:
+                return None
+            values = {"time": row[1], "name": row[2], "amount": row[3], "container": row[4]}
+            for key, value in (("time", time), ("name", new_name), ("amount", amount), ("container", container)):
+                if value:
+                    values[key] = _text(value)
+            conn.execute(
+                "UPDATE meds SET time = ?, slot = ?, name = ?, amount = ?, container = ? WHERE id = ?",
+                (values["time"], _slot(values["time"]), values["name"], values["amount"], values["container"], row[0]),
+            )
+            return MedRecord(values["time"], values["name"], values["amount"], values["container"])
+        return self._write(mutate)
+
+    def delete(self, name):
+        def mutate(conn):
+            cursor = conn.execute(
+                "DELETE FROM meds WHERE id = (SELECT id FROM meds WHERE patient_id = ? AND name = ? ORDER BY id LIMIT 1)",
+                (self.patient_id, name),
+            )
+            return True if cursor.rowcount else None
+        return self._write(mutate)
+
+    def _insert_many(self, conn, records):
+        count = 0
+
+        def rows():
+            nonlocal count
+            for record in records:
+                count += 1
+                yield (self.patient_id, _text(record.time), _slot(record.time), record.name,
+                       _text(record.amount), _text(record.container))
+
+        conn.executemany(
+            "INSERT INTO meds (patient_id, time, slot, name, amount, container) VALUES (?, ?, ?, ?, ?, ?)", rows()
+        )
+        return count
+
+    def add_many(self, records):
+        """Inserts every record in one transaction; if records raises part-way, nothing is kept."""
+        return self._write(lambda conn: self._insert_many(conn, records))
+
+    def replace_all(self, records):
+        """Replaces this patient's whole schedule in one transaction."""
+        def mutate(conn):
+            conn.execute("DELETE FROM meds WHERE patient_id = ?", (self.patient_id,))
+            return self._insert_many(conn, records)
+        return self._write(mutate)
+
+
+class _Transaction:
+    """Commits on success and rolls back on error, for a connection in autocommit mode."""
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.conn.in_transaction:
+            self.conn.execute("ROLLBACK" if exc_type else "COMMIT")
+        return False
+
+
+def _text(value):
+    return None if value is None else str(value)
+
+
+def _slot(value):
+    # The slot column holds the rule's first time of day, as it held the plain time before rules.
+    rule = parse_rule(value)
+    return None if rule is None else hhmm(rule.minute)
+
+
+def read_xlsx(path):
+    # openpyxl (and the numpy it pulls in) is the slowest import in the app, and the SQLite
+    # backend never needs it, so it is only loaded once an xlsx file is actually read or written.
+    import openpyxl
+
+    wb = openpyxl.load_workbook(path, read_only=True)
+    try:
+        return [
+            MedRecord(row[0], row[1], row[2], row[3])
+            for row in wb.active.iter_rows(min_row=2, max_col=4, values_only=True)
+            if row[1]
+        ]
+    finally:
+        wb.close()
+
+
+def write_xlsx(path, records):
+    import openpyxl
+
+    wb = openpyxl.Workbook(write_only=True)
+    sheet = wb.create_sheet()
+    sheet.append(HEADERS)
+    for record in records:
+        sheet.append(list(record.as_row()))
+    wb.save(path)
+
+
+class ImportErrors(ValueError):
+    """Raised at the end of a bulk import that had invalid rows; nothing was written."""
+
+    def __init__(self, errors, total):
+        super().__init__(f"{total} invalid row(s)")
+        self.errors = errors
+        self.total = total
+
+
+def validated(rows, containers=None, max_errors=20):
+    """Checks (time, name, quantity, container) rows and yields a MedRecord for each.
+
+    Rows are checked one at a time as the consumer asks for them, so a bulk write can stream
+    straight from the upload. Once the rows run out, any problems are raised together as
+    ImportErrors (the first max_errors of them, with row numbers), which rolls the write back.
+    """
+    errors = []
+    total = 0
+    for number, row in rows:
+        row = list(row) + [None] * (4 - len(row))
+        time, name, amount, container = (str(value).strip() if value is not None else "" for value in row[:4])
+        problems = []
+        rule = parse_rule(time)
+        if rule is None:
+            problems.append(f"timing {time!r} is not HH:MM or a rule like {EXAMPLE!r}")
+        if not name:
+            problems.append("name is empty")
+        if not amount.isdigit() or int(amount) < 1:
+            problems.append(f"quantity {amount!r} is not a positive whole number")
+        if not container.isdigit() or int(container) < 1 or (containers and int(container) > containers):
+            problems.append(f"container {container!r} is not a number from 1 to {containers or 'N'}")
+        if problems:
+            total += 1
+            if len(errors) < max_errors:
+                errors.append(f"row {number}: " + "; ".join(problems))
+            continue
+        yield MedRecord(rule.text, name, str(int(amount)), str(int(container)))
+    if total:
+        raise ImportErrors(errors, total)
+
+
+def read_csv(stream):
+    """Yields (row number, row) from a CSV text stream; a Timing,Name,Quantity,Container header is skipped."""
+    for number, row in enumerate(csv.reader(stream), start=1):
+        if number == 1 and [cell.strip().lower() for cell in row[:4]] == [h.lower() for h in HEADERS]:
+            continue
+        if any(cell.strip() for cell in row):
+            yield number, row
+
+
+def read_json(stream):
+    """Yields (row number, row) from a JSON array of {"time", "name", "amount", "container"} objects."""
+    items = json.load(stream)
+    if not isinstance(items, list):
+        raise ImportErrors(["expected a JSON array of medications"], 1)
+    for number, item in enumerate(items, start=1):
+        if isinstance(item, dict):
+            yield number, [item.get("time"), item.get("name"), item.get("amount"), item.get("container")]
+        else:
+            yield number, item if isinstance(item, list) else [item]
+
+
+def iter_csv(records, chunk=500):
+    """Yields the schedule as CSV text a chunk of rows at a time, for a streamed response."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(HEADERS)
+    for i, record in enumerate(records, start=1):
+        writer.writerow(["" if value is None else value for value in record.as_row()])
+        if i % chunk == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def iter_json(records, chunk=500):
+    """Yields the schedule as a JSON array a chunk of rows at a time."""
+    parts = ["["]
+    for i, record in enumerate(records):
+        parts.append(("," if i else "") + json.dumps(
+            {"time": record.time, "name": record.name, "amount": record.amount, "container": record.container},
+            default=str))
+        if len(parts) >= chunk:
+            yield "".join(parts)
+            parts = []
+    parts.append("]")
+    yield "".join(parts)
+
+
+def import_xlsx(backend, path):
+    records = read_xlsx(path)
+    backend.replace_all(records)
+    return len(records)
+
+
+def export_xlsx(backend, path):
+    records = backend.load()
+    write_xlsx(path, records)
+    return len(records)
+
+
+def open_backend(kind, xlsx_path="data.xlsx", db_path="meds.db", patient_id="default"):
+    """Returns the configured backend for one patient.
+
+    A patient with no rows yet in a new SQLite database is seeded from their xlsx file if it exists;
+    a patient on the xlsx backend gets an empty workbook if they don't have one.
+    """
+    if kind == "xlsx":
+        if not os.path.exists(xlsx_path) and patient_id != "default":
+            os.makedirs(os.path.dirname(xlsx_path) or ".", exist_ok=True)
+            write_xlsx(xlsx_path, [])
+        return XlsxBackend(xlsx_path)
+    if kind == "sqlite":
+        backend = SqliteBackend(db_path, patient_id)
+        if backend.is_empty() and backend.version() == 0 and os.path.exists(xlsx_path):
+            rows = import_xlsx(backend, xlsx_path)
+            log.info("imported xlsx schedule into sqlite",
+                     extra={"xlsx": xlsx_path, "db": db_path, "patient": patient_id, "rows": rows})
+        return backend
+    raise ValueError(f"Unknown storage backend: {kind}")
@@ -0,0 +1,18 @@
+"""Production entry point, run together with the /events server (events_wsgi.py), for example:
+
+    gunicorn --workers 4 --threads 8 --bind 127.0.0.1:5000 wsgi:app
+    gunicorn --config gunicorn_events.conf.py events_wsgi:app
+
+with the proxy in front sending /events to the second and everything else to the first:
+
+    location /events { proxy_pass http://127.0.0.1:5001; }
+    location / { proxy_pass http://127.0.0.1:5000; }
+
+Every logged-in page holds its /events stream open, and here each one would take one of the
+4 x 8 threads, so about 32 tabs would block every route; the events server runs on a gevent
+worker instead (pip install gunicorn gevent).
+Don't use --preload: each worker has to start its own background threads after it has been forked.
+"""
+from app import create_app
+
+app = create_app()